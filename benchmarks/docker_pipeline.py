@@ -0,0 +1,526 @@
+"""Benchmarks for the git to Docker build and push pipeline of
+`viki.fabric.docker`.
+
+`build_docker_image_from_git_repo`, `push_docker_image_to_registry` and
+`build_docker_image_from_git_repo_and_push_to_registry` are run against git
+repositories generated on this machine, with a configurable number and size
+of files and depth of history. Fake `docker` and `git-crypt` executables are
+put on the PATH, so that nothing touches the network or a Docker daemon: the
+fake `docker build` reads its build context (as the Docker daemon would) and
+sleeps for a simulated build time, and `docker push` sleeps for a simulated
+push time. `git` is the real one; repositories are cloned over `file://` URLs
+so that git packs objects as it would for a remote repository.
+
+For every benchmark case, the wall time, the time spent in each phase of the
+pipeline (`clone`, `fetch`, `checkout`, `git_crypt`, `build`, `cache`, `push`
+and `other`, which includes the library's own work), the bytes written to
+block devices by the pipeline and the commands it runs (reads are not
+measured, as they are mostly served from the page cache) and the peak
+temporary disk space (sampled in the temporary directory the
+library clones into) are recorded. Temporary files left behind after a case
+are reported as leaked. Each case runs in a forked process, like in
+`benchmarks/remote_helpers.py`.
+
+Usage (from the top level of the repository)::
+
+    # record the baseline
+    python benchmarks/docker_pipeline.py --save-baseline
+
+    # compare against the baseline; exits with a non-zero status on
+    # regressions, or if the baseline is missing or was recorded with other
+    # settings
+    python benchmarks/docker_pipeline.py
+
+    # the large repositories too (takes minutes), against a baseline of its
+    # own recorded with the same sizes
+    python benchmarks/docker_pipeline.py --repo-sizes small medium large \\
+      --baseline docker_pipeline_large_baseline.json
+
+    # a single repository of a custom size
+    python benchmarks/docker_pipeline.py --files 5000 --file-size 8192 \\
+      --history-depth 500 --cases build
+
+Leaked temporary space must not exceed the baseline; wall time and peak
+temporary space may exceed it by at most `--tolerance`.
+"""
+
+import argparse
+import base64
+import collections
+import contextlib
+import json
+import os
+import os.path
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _REPO_DIR)
+
+from fabric.api import env
+
+# Default file holding the baseline numbers
+_DEFAULT_BASELINE_PATH = os.path.join(_REPO_DIR, "benchmarks",
+  "docker_pipeline_baseline.json"
+)
+
+# Name of the Docker image built and pushed
+_DOCKER_IMAGE_NAME = "bench/app"
+
+# Fake executables put on the PATH. `docker` sleeps for
+# `$FAKE_DOCKER_BUILD_SECONDS` and `$FAKE_DOCKER_PUSH_SECONDS`.
+_FAKE_EXECUTABLES = {
+  "docker": """#!/bin/sh
+case "$1" in
+  build)
+    # the build context is the last argument; read it like the Docker daemon
+    for context in "$@"; do :; done
+    tar -cf - -C "$context" . | wc -c > /dev/null
+    echo "Step 1/3 : FROM ubuntu:14.04"
+    echo " ---> 1a2b3c4d5e6f"
+    echo "Step 2/3 : COPY . /app"
+    echo " ---> Using cache"
+    echo "Step 3/3 : RUN make"
+    echo " ---> Running in 6f5e4d3c2b1a"
+    sleep "$FAKE_DOCKER_BUILD_SECONDS"
+    ;;
+  push)
+    sleep "$FAKE_DOCKER_PUSH_SECONDS"
+    ;;
+  pull)
+    echo "Error response from daemon: manifest unknown" >&2
+    exit 1
+    ;;
+esac
+exit 0
+""",
+  "git-crypt": """#!/bin/sh
+# only `git-crypt init keyfile` is supported
+mkdir -p .git/git-crypt
+cp "$2" .git/git-crypt/key
+""",
+}
+
+# Substrings of the local commands of the pipeline identifying its phases, in
+# the order they are matched
+_PHASE_COMMANDS = [
+  ("clone", "git clone"),
+  ("fetch", "git fetch"),
+  ("checkout", "git checkout"),
+  ("git_crypt", "git-crypt"),
+  ("build", "docker build"),
+  ("cache", "docker pull"),
+  ("cache", "docker tag"),
+  ("push", "docker push"),
+  ("push", "docker login"),
+]
+
+# Phases reported, in order
+_PHASES = ["clone", "fetch", "checkout", "git_crypt", "build", "cache", "push",
+  "other"
+]
+
+# Sizes of the generated git repositories: (number of files, size of each
+# file in bytes, number of commits)
+_REPO_SIZES = collections.OrderedDict([
+  ("small", (50, 4 << 10, 10)),
+  ("medium", (500, 8 << 10, 20)),
+  ("large", (2000, 16 << 10, 50)),
+])
+
+# Sizes benchmarked by default; "large" takes minutes and hundreds of MB of
+# temporary space, so it must be asked for with `--repo-sizes`
+_DEFAULT_REPO_SIZES = ["small", "medium"]
+
+# Size of a block in `ru_oublock` and `st_blocks`
+_BLOCK_SIZE = 512
+
+def _get_phase(command):
+  for (phase, substring) in _PHASE_COMMANDS:
+    if substring in command:
+      return phase
+  return "other"
+
+def _get_bytes_written():
+  """Returns the number of bytes written to block devices by this process and
+  its waited-for children so far.
+  """
+  blocksOut = 0
+  for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+    blocksOut += resource.getrusage(who).ru_oublock
+  return blocksOut * _BLOCK_SIZE
+
+class PhaseRecorder(object):
+  """Times the local commands of the pipeline and measures their disk writes,
+  grouped by phase.
+  """
+
+  def __init__(self):
+    self.seconds = collections.Counter()
+    self.writeBytes = collections.Counter()
+    self._local = None
+
+  def local(self, command, *args, **kwargs):
+    phase = _get_phase(command)
+    writeBefore = _get_bytes_written()
+    start = time.time()
+    try:
+      return self._local(command, *args, **kwargs)
+    finally:
+      self.seconds[phase] += time.time() - start
+      self.writeBytes[phase] += _get_bytes_written() - writeBefore
+
+  @contextlib.contextmanager
+  def installed(self):
+    """Context manager replacing `fabric.operations.local` (which
+    `viki.fabric.operations` wraps) with the one of this recorder.
+    """
+    import fabric.operations
+    self._local = fabric.operations.local
+    fabric.operations.local = self.local
+    try:
+      yield self
+    finally:
+      fabric.operations.local = self._local
+
+def _get_disk_usage(path):
+  """Returns the disk space used by the files under a directory, in bytes."""
+  total = 0
+  for (dirPath, dirNames, fileNames) in os.walk(path):
+    for name in dirNames + fileNames:
+      try:
+        total += os.lstat(os.path.join(dirPath, name)).st_blocks * _BLOCK_SIZE
+      except OSError:
+        # removed while walking
+        pass
+  return total
+
+class TempSpaceSampler(threading.Thread):
+  """Samples the disk space used under a directory at a fixed interval, and
+  keeps the peak.
+  """
+
+  def __init__(self, path, interval):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.path = path
+    self.interval = interval
+    self.peakBytes = 0
+    self._stopped = threading.Event()
+
+  def run(self):
+    while not self._stopped.is_set():
+      self.peakBytes = max(self.peakBytes, _get_disk_usage(self.path))
+      self._stopped.wait(self.interval)
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+    self.peakBytes = max(self.peakBytes, _get_disk_usage(self.path))
+
+def _git(repoDir, *args):
+  subprocess.check_call(["git", "-C", repoDir] + list(args))
+
+def _generate_git_repo(repoDir, fileCount, fileSize, historyDepth):
+  """Generates a git repository with a Dockerfile and `fileCount` files of
+  `fileSize` random bytes, over `historyDepth` commits; the first commit adds
+  the files, and every later one rewrites a tenth of them.
+  """
+  subprocess.check_call(["git", "init", "-q", repoDir])
+  _git(repoDir, "config", "user.name", "Benchmark")
+  _git(repoDir, "config", "user.email", "benchmark@example.com")
+  srcDir = os.path.join(repoDir, "src")
+  os.makedirs(srcDir)
+  with open(os.path.join(repoDir, "Dockerfile"), "w") as f:
+    f.write("FROM ubuntu:14.04\nCOPY . /app\nRUN make\n")
+  for commit in range(max(historyDepth, 1)):
+    fileIdxs = range(fileCount) if commit == 0 \
+      else range(commit % 10, fileCount, 10)
+    for fileIdx in fileIdxs:
+      with open(os.path.join(srcDir, "file{}.txt".format(fileIdx)), "w") as f:
+        # random data, so that git cannot compress it away
+        f.write(base64.b64encode(os.urandom(fileSize))[:fileSize])
+    _git(repoDir, "add", "-A")
+    _git(repoDir, "commit", "-q", "-m", "Commit {}".format(commit))
+
+def _configure_env(sandboxDir, buildSeconds, pushSeconds):
+  """Sets up `fabric.api.env`, the PATH and the temporary directory for a
+  benchmark case.
+  """
+  from viki.fabric.config import clear_config_indexes
+  binDir = os.path.join(sandboxDir, "bin")
+  tempDir = os.path.join(sandboxDir, "tmp")
+  os.makedirs(binDir)
+  os.makedirs(tempDir)
+  for (name, contents) in _FAKE_EXECUTABLES.items():
+    path = os.path.join(binDir, name)
+    with open(path, "w") as f:
+      f.write(contents)
+    os.chmod(path, stat.S_IRWXU)
+  os.environ["PATH"] = os.pathsep.join([binDir, os.environ["PATH"]])
+  os.environ["FAKE_DOCKER_BUILD_SECONDS"] = str(buildSeconds)
+  os.environ["FAKE_DOCKER_PUSH_SECONDS"] = str(pushSeconds)
+  # the library clones into the temporary directory
+  os.environ["TMPDIR"] = tempDir
+  tempfile.tempdir = tempDir
+  env.hosts = []
+  env.roles = []
+  env.viki_fabric_config = {
+    "viki.fabric.output": {
+      "log_dir": os.path.join(sandboxDir, "logs"),
+    },
+  }
+  clear_config_indexes()
+  keyPath = os.path.join(sandboxDir, "git-crypt.key")
+  with open(keyPath, "wb") as f:
+    f.write(os.urandom(148))
+  return (tempDir, keyPath)
+
+def _bench_build(repoUrl, keyPath):
+  import viki.fabric.docker as docker
+  docker.build_docker_image_from_git_repo(repoUrl, _DOCKER_IMAGE_NAME,
+    runGitCryptInit=True, gitCryptKeyPath=keyPath
+  )
+
+def _bench_push(repoUrl, keyPath):
+  import viki.fabric.docker as docker
+  docker.push_docker_image_to_registry(_DOCKER_IMAGE_NAME, "latest")
+
+def _bench_build_and_push(repoUrl, keyPath):
+  import viki.fabric.docker as docker
+  docker.build_docker_image_from_git_repo_and_push_to_registry(repoUrl,
+    _DOCKER_IMAGE_NAME, runGitCryptInit=True, gitCryptKeyPath=keyPath
+  )
+
+# (case name, function, whether it needs a git repository)
+_CASES = [
+  ("build", _bench_build, True),
+  ("push", _bench_push, False),
+  ("build_and_push", _bench_build_and_push, True),
+]
+
+@contextlib.contextmanager
+def _silenced():
+  """Context manager sending the output of the pipeline, including that of
+  the commands it runs, to /dev/null.
+  """
+  sys.stdout.flush()
+  sys.stderr.flush()
+  savedFds = [os.dup(1), os.dup(2)]
+  devNullFd = os.open(os.devnull, os.O_WRONLY)
+  try:
+    os.dup2(devNullFd, 1)
+    os.dup2(devNullFd, 2)
+    yield
+  finally:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(savedFds[0], 1)
+    os.dup2(savedFds[1], 2)
+    for fd in savedFds + [devNullFd]:
+      os.close(fd)
+
+def _run_case(benchFunction, repoDir, args):
+  """Runs a benchmark case in a forked process and returns its measurements.
+  """
+  (readFd, writeFd) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(readFd)
+    exitCode = 0
+    sandboxDir = tempfile.mkdtemp(prefix="viki-fabric-bench-")
+    try:
+      import viki.fabric.docker
+      (tempDir, keyPath) = _configure_env(sandboxDir, args.build_seconds,
+        args.push_seconds
+      )
+      repoUrl = "file://{}".format(repoDir) if repoDir else None
+      recorder = PhaseRecorder()
+      sampler = TempSpaceSampler(tempDir, args.sample_interval)
+      writeBefore = _get_bytes_written()
+      sampler.start()
+      try:
+        with recorder.installed():
+          with _silenced():
+            start = time.time()
+            benchFunction(repoUrl, keyPath)
+            wallTime = time.time() - start
+      finally:
+        sampler.stop()
+      writeAfter = _get_bytes_written()
+      phaseSeconds = dict((phase, recorder.seconds[phase])
+        for phase in _PHASES
+      )
+      phaseSeconds["other"] += wallTime - sum(recorder.seconds.values())
+      result = {
+        "wall_time": wallTime,
+        "phase_seconds": phaseSeconds,
+        "phase_write_bytes": dict(recorder.writeBytes),
+        "write_bytes": writeAfter - writeBefore,
+        "peak_temp_bytes": sampler.peakBytes,
+        "leaked_temp_bytes": _get_disk_usage(tempDir),
+      }
+    except BaseException as e:
+      result = { "error": repr(e) }
+      exitCode = 1
+    finally:
+      shutil.rmtree(sandboxDir, ignore_errors=True)
+    with os.fdopen(writeFd, "w") as f:
+      json.dump(result, f)
+    os._exit(exitCode)
+  os.close(writeFd)
+  with os.fdopen(readFd, "r") as f:
+    result = json.load(f)
+  os.waitpid(pid, 0)
+  return result
+
+def _find_regressions(results, baseline, tolerance):
+  """Returns a list of strings describing regressions against the baseline."""
+  regressions = []
+  for (caseName, result) in sorted(results.items()):
+    if "error" in result:
+      regressions.append("{}: failed with {}".format(caseName, result["error"]))
+      continue
+    if caseName not in baseline:
+      continue
+    if result["leaked_temp_bytes"] > baseline[caseName]["leaked_temp_bytes"]:
+      regressions.append("{}: leaked_temp_bytes went from {} to {}".format(
+        caseName, baseline[caseName]["leaked_temp_bytes"],
+        result["leaked_temp_bytes"]
+      ))
+    for key in ["wall_time", "peak_temp_bytes"]:
+      if result[key] > baseline[caseName][key] * (1 + tolerance):
+        regressions.append("{}: {} went from {:.3f} to {:.3f}".format(caseName,
+          key, baseline[caseName][key], result[key]
+        ))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--build-seconds", type=float, default=0.5,
+    help="simulated `docker build` time in seconds (default: %(default)s)"
+  )
+  parser.add_argument("--push-seconds", type=float, default=0.5,
+    help="simulated `docker push` time in seconds (default: %(default)s)"
+  )
+  parser.add_argument("--repo-sizes", nargs="*", choices=_REPO_SIZES.keys(),
+    default=_DEFAULT_REPO_SIZES,
+    help="sizes of the generated git repositories (default: %(default)s)"
+  )
+  parser.add_argument("--files", type=int,
+    help="number of files of a single custom git repository"
+  )
+  parser.add_argument("--file-size", type=int, default=4 << 10,
+    help="size in bytes of the files of the custom git repository"
+      " (default: %(default)s)"
+  )
+  parser.add_argument("--history-depth", type=int, default=10,
+    help="number of commits of the custom git repository"
+      " (default: %(default)s)"
+  )
+  parser.add_argument("--sample-interval", type=float, default=0.05,
+    help="interval in seconds between samples of the temporary space"
+      " (default: %(default)s)"
+  )
+  parser.add_argument("--baseline", default=_DEFAULT_BASELINE_PATH,
+    help="file holding the baseline numbers (default: %(default)s)"
+  )
+  parser.add_argument("--save-baseline", action="store_true",
+    help="record the results as the new baseline"
+  )
+  parser.add_argument("--tolerance", type=float, default=0.25,
+    help="allowed relative increase in wall time and peak temporary space"
+      " (default: %(default)s)"
+  )
+  parser.add_argument("--cases", nargs="*",
+    help="only run the cases whose names start with these prefixes"
+  )
+  args = parser.parse_args()
+
+  if args.files is not None:
+    repoSizes = collections.OrderedDict([
+      ("custom", (args.files, args.file_size, args.history_depth)),
+    ])
+  else:
+    repoSizes = collections.OrderedDict(
+      (name, spec) for (name, spec) in _REPO_SIZES.items()
+      if name in args.repo_sizes
+    )
+
+  reposDir = tempfile.mkdtemp(prefix="viki-fabric-bench-repos-")
+  try:
+    results = {}
+    print(("{:<28} {:>8}" + " {:>8}" * len(_PHASES) + " {:>10} {:>10}"
+      " {:>8}").format("case", "wall(s)", *(_PHASES + ["write(KB)",
+        "peak tmp", "leaked"]
+      )
+    ))
+    for (caseName, benchFunction, needsRepo) in _CASES:
+      caseRepos = [("{}[{}]".format(caseName, sizeName), sizeName)
+        for sizeName in repoSizes] if needsRepo else [(caseName, None)]
+      for (fullCaseName, sizeName) in caseRepos:
+        if args.cases and \
+            not any(fullCaseName.startswith(c) for c in args.cases):
+          continue
+        repoDir = None
+        if sizeName is not None:
+          repoDir = os.path.join(reposDir, sizeName)
+          if not os.path.exists(repoDir):
+            _generate_git_repo(repoDir, *repoSizes[sizeName])
+        result = _run_case(benchFunction, repoDir, args)
+        results[fullCaseName] = result
+        if "error" in result:
+          print("{:<28} ERROR {}".format(fullCaseName, result["error"]))
+          continue
+        print(("{:<28} {:>8.3f}" + " {:>8.3f}" * len(_PHASES) +
+          " {:>10} {:>10} {:>8}").format(fullCaseName,
+          result["wall_time"],
+          *([result["phase_seconds"][phase] for phase in _PHASES] + [
+            result["write_bytes"] >> 10, result["peak_temp_bytes"] >> 10,
+            result["leaked_temp_bytes"] >> 10
+          ])
+        ))
+  finally:
+    shutil.rmtree(reposDir, ignore_errors=True)
+
+  settings = {
+    "build_seconds": args.build_seconds,
+    "push_seconds": args.push_seconds,
+    "repo_sizes": repoSizes,
+  }
+  if args.save_baseline:
+    with open(args.baseline, "w") as f:
+      json.dump({ "settings": settings, "results": results }, f, indent=2,
+        separators=(",", ": "), sort_keys=True
+      )
+    print("Baseline saved to `{}`".format(args.baseline))
+    return
+
+  if not os.path.exists(args.baseline):
+    print("No baseline at `{}`; run with --save-baseline to record one".format(
+      args.baseline
+    ))
+    sys.exit(1)
+  with open(args.baseline, "r") as f:
+    baseline = json.load(f)
+  # JSON turns the tuples of the repository sizes into lists
+  if baseline["settings"] != json.loads(json.dumps(settings)):
+    print("Baseline was recorded with other settings ({}); not comparing"
+      .format(baseline["settings"])
+    )
+    sys.exit(1)
+  regressions = _find_regressions(results, baseline["results"], args.tolerance)
+  for regression in regressions:
+    print("REGRESSION: {}".format(regression))
+  if regressions:
+    sys.exit(1)
+  print("OK: no regressions against `{}`".format(args.baseline))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,83 @@
+"""Import-time benchmark for the viki.fabric package.
+
+Measures the time taken by a cold `import viki.fabric.docker` in a fresh Python
+interpreter, and exits with a non-zero status if it goes over a budget.
+
+Usage (from the top level of the repository)::
+
+    python benchmarks/import_time.py [--budget-ms 250] [--runs 15]
+
+The reported times exclude interpreter startup. The time taken to import
+`fabric.api` (which every module in the package needs) is reported
+separately, so that regressions in our own code are easy to tell apart from
+changes in Fabric.
+"""
+
+import argparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Top level of the repository, so that the working copy of `viki` is imported
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Default budget for a cold `import viki.fabric.docker`, in milliseconds
+_DEFAULT_BUDGET_MS = 250
+
+def _time_import(statement, runs):
+  """Returns the median wall time (in milliseconds) of running a Python
+  statement in a fresh interpreter.
+  """
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.pathsep.join(
+    [_REPO_DIR] + [p for p in [env.get("PYTHONPATH")] if p]
+  )
+  # do not write .pyc files into the working copy
+  env["PYTHONDONTWRITEBYTECODE"] = "1"
+  # run in an empty directory, so that a `viki_fabric_config.yml` in the
+  # current directory does not affect the measurement
+  workDir = tempfile.mkdtemp(prefix="viki-fabric-import-time-")
+  timings = []
+  devNull = open(os.devnull, "w")
+  try:
+    for _ in range(runs):
+      start = time.time()
+      subprocess.check_call([sys.executable, "-c", statement], env=env,
+        cwd=workDir, stdout=devNull
+      )
+      timings.append((time.time() - start) * 1000)
+  finally:
+    devNull.close()
+    shutil.rmtree(workDir, ignore_errors=True)
+  timings.sort()
+  return timings[len(timings) // 2]
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--budget-ms", type=float, default=_DEFAULT_BUDGET_MS,
+    help="budget for a cold `import viki.fabric.docker` (default: %(default)s)"
+  )
+  parser.add_argument("--runs", type=int, default=15,
+    help="number of runs; the median is reported (default: %(default)s)"
+  )
+  args = parser.parse_args()
+
+  startup = _time_import("pass", args.runs)
+  fabric = _time_import("import fabric.api", args.runs) - startup
+  docker = _time_import("import viki.fabric.docker", args.runs) - startup
+  print("interpreter startup:             {:8.1f} ms".format(startup))
+  print("import fabric.api:               {:8.1f} ms".format(fabric))
+  print("import viki.fabric.docker:       {:8.1f} ms".format(docker))
+  print("  of which viki.fabric:          {:8.1f} ms".format(docker - fabric))
+  print("budget:                          {:8.1f} ms".format(args.budget_ms))
+  if docker > args.budget_ms:
+    print("FAIL: `import viki.fabric.docker` is over budget")
+    sys.exit(1)
+  print("OK")
+
+if __name__ == "__main__":
+  main()
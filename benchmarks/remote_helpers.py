@@ -0,0 +1,435 @@
+"""Round-trip benchmarks for the helpers in `viki.fabric.helpers` and
+`viki.fabric.git`.
+
+The helpers are run against a simulated transport instead of a real SSH
+server: every Fabric remote operation they issue through
+`viki.fabric.operations` (`run`, `sudo`, `get`, `put`, `exists`,
+`upload_template`) is executed on this machine, inside a sandbox
+directory standing in for the remote filesystem, after sleeping for an
+injected round-trip latency. Fake `git`, `vim`, `dpkg` and `apt-get`
+executables are put on the PATH of the sandbox so that nothing touches the
+network or the package manager.
+
+For every benchmark case, the wall time, number of round trips, bytes sent and
+received, and peak memory (maximum resident set size) are recorded. Each case
+runs in a forked process, so that caches in the library (such as the fact
+inventory) and memory usage do not leak from one case to the next. Cases which
+find that a helper did the wrong thing (such as overwriting an existing file)
+fail, like cases which raise.
+
+Usage (from the top level of the repository)::
+
+    # record the baseline
+    python benchmarks/remote_helpers.py --save-baseline
+
+    # compare against the baseline; exits with a non-zero status on
+    # regressions, or if the baseline is missing or was recorded with another
+    # latency
+    python benchmarks/remote_helpers.py
+
+Round trips and bytes are deterministic and must not exceed the baseline;
+wall time and peak memory may exceed it by at most `--tolerance`.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import os.path
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _REPO_DIR)
+
+from fabric.api import env
+from fabric.utils import abort
+
+# Default file holding the baseline numbers
+_DEFAULT_BASELINE_PATH = os.path.join(_REPO_DIR, "benchmarks",
+  "remote_helpers_baseline.json"
+)
+
+# Host string used for the simulated host
+_HOST = "bench-host"
+
+# Fake executables put on the PATH of the sandbox. `dpkg` and `apt-get` keep
+# the list of installed packages in `$FAKE_DPKG_DB`.
+_FAKE_EXECUTABLES = {
+  "git": """#!/bin/sh
+if [ "$1" = "clone" ]; then
+  mkdir -p "$3/.git"
+fi
+exit 0
+""",
+  "vim": """#!/bin/sh
+exit 0
+""",
+  "dpkg": """#!/bin/sh
+# only `dpkg -s package` is supported
+if grep -qx "$2" "$FAKE_DPKG_DB" 2>/dev/null; then
+  printf 'Package: %s\\nStatus: install ok installed\\n' "$2"
+  exit 0
+fi
+echo "dpkg-query: package '$2' is not installed" >&2
+exit 1
+""",
+  "apt-get": """#!/bin/sh
+# only `apt-get install -y package...` is supported
+shift 2
+for package in "$@"; do
+  echo "$package" >> "$FAKE_DPKG_DB"
+done
+""",
+}
+
+class _Result(str):
+  """Stand-in for the return value of Fabric's `run` and `sudo`."""
+  pass
+
+class SimulatedTransport(object):
+  """Executes Fabric remote operations locally inside a sandbox directory,
+  sleeping for an injected latency on every round trip and counting round
+  trips and bytes.
+  """
+
+  def __init__(self, sandboxDir, latency):
+    self.sandboxDir = sandboxDir
+    self.homeDir = os.path.join(sandboxDir, "home")
+    self.latency = latency
+    self.roundTrips = 0
+    self.bytesOut = 0
+    self.bytesIn = 0
+    binDir = os.path.join(sandboxDir, "bin")
+    os.makedirs(self.homeDir)
+    os.makedirs(binDir)
+    for (name, contents) in _FAKE_EXECUTABLES.items():
+      path = os.path.join(binDir, name)
+      with open(path, "w") as f:
+        f.write(contents)
+      os.chmod(path, stat.S_IRWXU)
+    self._shellEnv = dict(os.environ)
+    self._shellEnv["HOME"] = self.homeDir
+    self._shellEnv["PATH"] = os.pathsep.join([binDir, os.environ["PATH"]])
+    self._shellEnv["FAKE_DPKG_DB"] = os.path.join(sandboxDir, "dpkg-db")
+
+  def _round_trip(self, bytesOut, bytesIn):
+    time.sleep(self.latency)
+    self.roundTrips += 1
+    self.bytesOut += bytesOut
+    self.bytesIn += bytesIn
+
+  def run(self, command, shell=True, pty=True, combine_stderr=None,
+      quiet=False, warn_only=False, stdout=None, stderr=None, timeout=None,
+      shell_escape=None, **kwargs):
+    if env.cwd:
+      command = "cd {} && {}".format(env.cwd, command)
+    proc = subprocess.Popen(command, shell=True, env=self._shellEnv,
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    (out, err) = proc.communicate()
+    self._round_trip(len(command), len(out) + len(err))
+    # Fabric prefixes every line it writes to the `stdout` and `stderr` streams
+    for (stream, data, kind) in [(stdout or sys.stdout, out, "out"),
+        (stderr or sys.stderr, err, "err")]:
+      for line in data.splitlines():
+        stream.write("[{}] {}: {}\n".format(env.host_string, kind, line))
+    result = _Result(out.rstrip("\n"))
+    result.stderr = err.rstrip("\n")
+    result.return_code = proc.returncode
+    result.succeeded = proc.returncode == 0
+    result.failed = not result.succeeded
+    if result.failed and not (warn_only or env.warn_only):
+      abort("run() received nonzero return code {} while executing `{}`"
+        .format(proc.returncode, command)
+      )
+    return result
+
+  def sudo(self, command, user=None, group=None, **kwargs):
+    return self.run(command, **kwargs)
+
+  def exists(self, path, use_sudo=False, verbose=False):
+    self._round_trip(len(path), 0)
+    return os.path.exists(os.path.expandvars(path))
+
+  def put(self, local_path, remote_path, use_sudo=False,
+      mirror_local_mode=False, mode=None, **kwargs):
+    shutil.copyfile(local_path, remote_path)
+    if mirror_local_mode:
+      shutil.copymode(local_path, remote_path)
+    if mode is not None:
+      os.chmod(remote_path, mode)
+    self._round_trip(os.path.getsize(local_path), 0)
+    return [remote_path]
+
+  def get(self, remote_path, local_path=None, **kwargs):
+    shutil.copyfile(remote_path, local_path)
+    self._round_trip(len(remote_path), os.path.getsize(remote_path))
+    return [local_path]
+
+  def upload_template(self, filename, destination, context=None,
+      use_jinja=False, template_dir=None, use_sudo=False, backup=True,
+      mirror_local_mode=False, mode=None, **kwargs):
+    import jinja2
+    jinjaEnv = jinja2.Environment(
+      loader=jinja2.FileSystemLoader(template_dir or ".")
+    )
+    rendered = jinjaEnv.get_template(filename).render(**(context or {}))
+    with open(destination, "w") as f:
+      f.write(rendered)
+    if mode is not None:
+      os.chmod(destination, mode)
+    self._round_trip(len(rendered), 0)
+
+  @contextlib.contextmanager
+  def installed(self):
+    """Context manager replacing the Fabric operations (which
+    `viki.fabric.operations` wraps) with those of this transport.
+    """
+    import fabric.contrib.files
+    import fabric.operations
+    saved = []
+    for (module, names) in [
+        (fabric.operations, ["run", "sudo", "put", "get"]),
+        (fabric.contrib.files, ["exists", "upload_template"])]:
+      for name in names:
+        saved.append((module, name, getattr(module, name)))
+        setattr(module, name, getattr(self, name))
+    try:
+      yield self
+    finally:
+      for (module, name, value) in saved:
+        setattr(module, name, value)
+
+def _configure_env(sandboxDir):
+  """Sets up `fabric.api.env` for the simulated host, including a
+  `viki_fabric_config` for the `viki.fabric.git` module.
+  """
+  from viki.fabric.config import clear_config_indexes
+  keysDir = os.path.join(sandboxDir, "local-keys")
+  templatesDir = os.path.join(sandboxDir, "local-templates")
+  os.makedirs(keysDir)
+  os.makedirs(templatesDir)
+  for keyName in ["id_bench", "id_bench.pub"]:
+    with open(os.path.join(keysDir, keyName), "w") as f:
+      f.write("not a real key\n" * 20)
+  with open(os.path.join(templatesDir, "gitwrap.sh"), "w") as f:
+    f.write("#!/bin/bash\n\nssh -i {{ ssh_private_key_path }} $@\n")
+  env.host_string = _HOST
+  env.host = _HOST
+  env.user = "bench"
+  env.viki_fabric_config = {
+    "viki.fabric.git": {
+      "ssh_private_key": "id_bench",
+      "ssh_public_key": "id_bench.pub",
+      "ssh_keys_local_copy_dir": keysDir,
+      "ssh_keys_dir": ".ssh",
+      "git_ssh_script_name": "gitwrap.sh",
+      "git_ssh_script_local_folder": templatesDir,
+    },
+    "viki.fabric.inventory": {
+      "path": os.path.join(sandboxDir, "inventory.json"),
+    },
+    "viki.fabric.output": {
+      "log_dir": os.path.join(sandboxDir, "logs"),
+    },
+  }
+  clear_config_indexes()
+
+def _bench_run_and_get_output(transport, size):
+  import viki.fabric.helpers as helpers
+  helpers.run_and_get_output(
+    "head -c {} /dev/zero | tr '\\0' 'a' | fold -w 99".format(size)
+  )
+
+def _bench_install_software(transport, count):
+  import viki.fabric.helpers as helpers
+  packages = ["package{}".format(i) for i in range(count)]
+  # half of the packages are already installed
+  with open(transport._shellEnv["FAKE_DPKG_DB"], "w") as f:
+    f.write("\n".join(packages[::2]) + "\n")
+  helpers.install_software_using_package_manager(packages)
+
+def _bench_setup_server_for_git_clone(transport, _):
+  import viki.fabric.git as git
+  os.makedirs(os.path.join(transport.homeDir, ".ssh"))
+  git.setup_server_for_git_clone()
+
+def _bench_setup_vundle(transport, _):
+  import viki.fabric.helpers as helpers
+  helpers.setup_vundle()
+
+def _bench_copy_files_to_symlinked_dir(transport, count):
+  import viki.fabric.helpers as helpers
+  # the directory is a symbolic link, and the first file already exists in it;
+  # the stat cache must not take it for missing and overwrite it
+  realDir = os.path.join(transport.homeDir, "real-config")
+  os.makedirs(realDir)
+  os.symlink(realDir, os.path.join(transport.homeDir, "config"))
+  with open(os.path.join(realDir, "file0"), "w") as f:
+    f.write("remote\n")
+  localDir = os.path.join(transport.sandboxDir, "local-files")
+  os.makedirs(localDir)
+  for i in range(count):
+    localFileName = os.path.join(localDir, "file{}".format(i))
+    with open(localFileName, "w") as f:
+      f.write("local\n")
+    helpers.copy_file_to_server_if_not_exists(localFileName,
+      os.path.join(transport.homeDir, "config", "file{}".format(i))
+    )
+  with open(os.path.join(realDir, "file0"), "r") as f:
+    if f.read() != "remote\n":
+      raise RuntimeError("an existing file in a symlinked dir was overwritten")
+
+# (case name, function, parameter)
+_CASES = [
+  ("run_and_get_output[1KB]", _bench_run_and_get_output, 1 << 10),
+  ("run_and_get_output[100KB]", _bench_run_and_get_output, 100 << 10),
+  ("run_and_get_output[1MB]", _bench_run_and_get_output, 1 << 20),
+  ("run_and_get_output[10MB]", _bench_run_and_get_output, 10 << 20),
+  ("install_software_using_package_manager[1]", _bench_install_software, 1),
+  ("install_software_using_package_manager[10]", _bench_install_software, 10),
+  ("install_software_using_package_manager[50]", _bench_install_software, 50),
+  ("setup_server_for_git_clone", _bench_setup_server_for_git_clone, None),
+  ("setup_vundle", _bench_setup_vundle, None),
+  ("copy_file_to_server_if_not_exists[symlink]",
+    _bench_copy_files_to_symlinked_dir, 5),
+]
+
+def _run_case(benchFunction, parameter, latency):
+  """Runs a benchmark case in a forked process and returns its measurements.
+  """
+  (readFd, writeFd) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(readFd)
+    exitCode = 0
+    sandboxDir = tempfile.mkdtemp(prefix="viki-fabric-bench-")
+    try:
+      import viki.fabric.git
+      import viki.fabric.helpers
+      _configure_env(sandboxDir)
+      transport = SimulatedTransport(sandboxDir, latency)
+      devNull = open(os.devnull, "w")
+      with transport.installed():
+        # keep the helpers' own output out of the report
+        (realStdout, sys.stdout) = (sys.stdout, devNull)
+        start = time.time()
+        try:
+          benchFunction(transport, parameter)
+        finally:
+          sys.stdout = realStdout
+        wallTime = time.time() - start
+      result = {
+        "wall_time": wallTime,
+        "round_trips": transport.roundTrips,
+        "bytes_out": transport.bytesOut,
+        "bytes_in": transport.bytesIn,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      }
+    except BaseException as e:
+      result = { "error": repr(e) }
+      exitCode = 1
+    finally:
+      shutil.rmtree(sandboxDir, ignore_errors=True)
+    with os.fdopen(writeFd, "w") as f:
+      json.dump(result, f)
+    os._exit(exitCode)
+  os.close(writeFd)
+  with os.fdopen(readFd, "r") as f:
+    result = json.load(f)
+  os.waitpid(pid, 0)
+  return result
+
+def _find_regressions(results, baseline, tolerance):
+  """Returns a list of strings describing regressions against the baseline."""
+  regressions = []
+  for (caseName, result) in sorted(results.items()):
+    if "error" in result:
+      regressions.append("{}: failed with {}".format(caseName, result["error"]))
+      continue
+    if caseName not in baseline:
+      continue
+    for key in ["round_trips", "bytes_out", "bytes_in"]:
+      if result[key] > baseline[caseName][key]:
+        regressions.append("{}: {} went from {} to {}".format(caseName, key,
+          baseline[caseName][key], result[key]
+        ))
+    for key in ["wall_time", "peak_rss_kb"]:
+      if result[key] > baseline[caseName][key] * (1 + tolerance):
+        regressions.append("{}: {} went from {:.3f} to {:.3f}".format(caseName,
+          key, baseline[caseName][key], result[key]
+        ))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--latency", type=float, default=0.02,
+    help="simulated round-trip latency in seconds (default: %(default)s)"
+  )
+  parser.add_argument("--baseline", default=_DEFAULT_BASELINE_PATH,
+    help="file holding the baseline numbers (default: %(default)s)"
+  )
+  parser.add_argument("--save-baseline", action="store_true",
+    help="record the results as the new baseline"
+  )
+  parser.add_argument("--tolerance", type=float, default=0.25,
+    help="allowed relative increase in wall time and peak memory"
+      " (default: %(default)s)"
+  )
+  parser.add_argument("--cases", nargs="*",
+    help="only run the cases whose names start with these prefixes"
+  )
+  args = parser.parse_args()
+
+  results = {}
+  print("{:<45} {:>9} {:>6} {:>10} {:>10} {:>9}".format("case", "wall(s)",
+    "trips", "bytes out", "bytes in", "rss(KB)"
+  ))
+  for (caseName, benchFunction, parameter) in _CASES:
+    if args.cases and not any(caseName.startswith(c) for c in args.cases):
+      continue
+    result = _run_case(benchFunction, parameter, args.latency)
+    results[caseName] = result
+    if "error" in result:
+      print("{:<45} ERROR {}".format(caseName, result["error"]))
+      continue
+    print("{:<45} {:>9.3f} {:>6} {:>10} {:>10} {:>9}".format(caseName,
+      result["wall_time"], result["round_trips"], result["bytes_out"],
+      result["bytes_in"], result["peak_rss_kb"]
+    ))
+
+  if args.save_baseline:
+    with open(args.baseline, "w") as f:
+      json.dump({ "latency": args.latency, "results": results }, f, indent=2,
+        sort_keys=True
+      )
+    print("Baseline saved to `{}`".format(args.baseline))
+    return
+
+  if not os.path.exists(args.baseline):
+    print("No baseline at `{}`; run with --save-baseline to record one".format(
+      args.baseline
+    ))
+    sys.exit(1)
+  with open(args.baseline, "r") as f:
+    baseline = json.load(f)
+  if baseline["latency"] != args.latency:
+    print("Baseline was recorded with a latency of {}s, not {}s".format(
+      baseline["latency"], args.latency
+    ))
+    sys.exit(1)
+  regressions = _find_regressions(results, baseline["results"], args.tolerance)
+  for regression in regressions:
+    print("REGRESSION: {}".format(regression))
+  if regressions:
+    sys.exit(1)
+  print("OK: no regressions against `{}`".format(args.baseline))
+
+if __name__ == "__main__":
+  main()
@@ -8,8 +8,10 @@ __VIKI_FABRIC_CONFIG_FILE_PATH__ = "viki_fabric_config.yml"
 # the `__VIKI_FABRIC_CONFIG_FILE_PATH__` YAML file
 VIKI_FABRIC_CONFIG_KEY_NAME = "viki_fabric_config"
 
+# The YAML file is only read on first access to
+# `env[VIKI_FABRIC_CONFIG_KEY_NAME]`
 if os.path.exists(__VIKI_FABRIC_CONFIG_FILE_PATH__):
-  with open(__VIKI_FABRIC_CONFIG_FILE_PATH__, "r") as f:
-    from fabric.api import env
-    import yaml
-    env[VIKI_FABRIC_CONFIG_KEY_NAME] = yaml.load(f.read())
+  from fabric.api import env
+  from viki.fabric.config import LazyYAMLConfig
+  env[VIKI_FABRIC_CONFIG_KEY_NAME] = \
+    LazyYAMLConfig(__VIKI_FABRIC_CONFIG_FILE_PATH__)
@@ -0,0 +1,320 @@
+import atexit
+import base64
+import hashlib
+import json
+import os
+import os.path
+import pipes
+import struct
+import subprocess
+import sys
+
+from fabric.api import env
+from fabric.colors import yellow
+from fabric.context_managers import hide, settings
+from fabric.exceptions import CommandTimeout
+
+import viki.fabric.agent_server as agent_server
+
+from viki.fabric.backends import LOCAL_BACKEND, get_backend
+from viki.fabric.config import get_module_config
+from viki.fabric.operations import agent_request, exists, put, run
+
+# Path of the source of the agent, which is uploaded to the hosts
+_AGENT_SOURCE_PATH = os.path.splitext(agent_server.__file__)[0] + ".py"
+
+# Default directory on the hosts (relative to the home directory) holding the
+# agent
+_DEFAULT_REMOTE_DIR = ".viki_fabric_agent"
+
+# Size of the chunks in which files are read through the agent
+_READ_CHUNK_SIZE = 1024 * 1024
+
+# Running agents, keyed by host string
+_AGENTS = {}
+
+# Hosts where the agent could not be started, keyed by host string, with the
+# reason; they are not tried again in this process
+_UNAVAILABLE_HOSTS = {}
+
+class AgentError(RuntimeError):
+  """Raised when the agent fails to serve a request, or cannot be reached."""
+  pass
+
+def _get_agent_source_hash():
+  """Returns the hash of the source of the agent, which is part of the name of
+  the agent on the hosts, so that a changed agent is uploaded again.
+  """
+  with open(_AGENT_SOURCE_PATH, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()[:12]
+
+class _ProcessChannel(object):
+  """Channel to an agent running in a local process, with the interface of the
+  parts of `paramiko.Channel` used by `RemoteAgent`.
+  """
+
+  def __init__(self, args):
+    self._process = subprocess.Popen(args, stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE, cwd=os.path.expanduser("~")
+    )
+
+  def sendall(self, data):
+    self._process.stdin.write(data)
+    self._process.stdin.flush()
+
+  def recv(self, size):
+    return os.read(self._process.stdout.fileno(), size)
+
+  def close(self):
+    self._process.stdin.close()
+    self._process.wait()
+
+class RemoteAgent(object):
+  """A connection to the agent running on a host (see `start_agent`).
+
+  Requests are sent over a single channel (an SSH exec channel, or the pipes
+  of a local process for hosts using the local execution backend), as JSON
+  objects preceded by their length; the requests made through `call` go
+  through `viki.fabric.operations`, like every other operation.
+
+  Args:
+    hostString(str): The host the agent runs on
+
+    channel(obj): The channel to the agent
+  """
+
+  def __init__(self, hostString, channel):
+    self.hostString = hostString
+    self._channel = channel
+    self._nextId = 1
+    # processes forked by a parallel run must not share the channel
+    self.pid = os.getpid()
+    # sizes of the last request and response, for the metrics
+    self.lastRequestSize = 0
+    self.lastResponseSize = 0
+
+  def _recv_exactly(self, size):
+    data = ""
+    while len(data) < size:
+      chunk = self._channel.recv(size - len(data))
+      if not chunk:
+        raise AgentError("The agent on `{}` exited".format(self.hostString))
+      data += chunk
+    return data
+
+  def request(self, method, **params):
+    """Sends a request to the agent and returns its result, without going
+    through `viki.fabric.operations`; use `call` instead.
+
+    Raises:
+      AgentError: if the agent failed to serve the request
+      CommandTimeout: if an `exec` request timed out
+    """
+    requestId = self._nextId
+    self._nextId += 1
+    body = json.dumps({
+      "id": requestId,
+      "protocol_version": agent_server.PROTOCOL_VERSION,
+      "method": method,
+      "params": params,
+    })
+    self.lastRequestSize = len(body)
+    self._channel.sendall(struct.pack(">I", len(body)) + body)
+    (length,) = struct.unpack(">I", self._recv_exactly(4))
+    self.lastResponseSize = length
+    response = json.loads(self._recv_exactly(length))
+    if response.get("id") != requestId:
+      raise AgentError("Unexpected response from the agent on `{}`".format(
+        self.hostString
+      ))
+    if "error" in response:
+      raise AgentError("The agent on `{}` failed to serve `{}`: {}".format(
+        self.hostString, method, response["error"]
+      ))
+    result = response["result"]
+    if method == "exec" and result["timed_out"]:
+      raise CommandTimeout(params.get("timeout"))
+    return result
+
+  def call(self, method, **params):
+    """Sends a request to the agent through `viki.fabric.operations`, and
+    returns its result.
+
+    Args:
+      method(str): One of `ping`, `stat`, `exists`, `list_dir`, `read`, `exec`
+        and `dpkg_query` (see `viki.fabric.agent_server`)
+
+      \*\*params: Parameters of the method
+
+    >>> agent.call("stat", paths=["/etc/hosts"])
+    [{"type": "f", "size": 221, "mode": 420, "mtime": 1414141414.0}]
+    """
+    return agent_request(self, method, params)
+
+  def run_command(self, command, timeout=None):
+    """Runs a shell command on the host through the agent, honouring the
+    `cd`, `prefix`, `shell_env` and `shell` Fabric settings like `run` does.
+
+    Args:
+      command(str): The command
+
+      timeout(float, optional): Number of seconds after which the command is
+        killed, raising `fabric.exceptions.CommandTimeout`. Defaults to the
+        configured command timeout and the deadline of the running task, if
+        any (see `viki.fabric.deadlines`)
+
+    Returns:
+      dict: with the keys `return_code`, `stdout` and `stderr` (the output, as
+        it was written by the command)
+    """
+    prefixes = list(env.command_prefixes)
+    if env.cwd:
+      # not quoted, like Fabric does: `cd` has already escaped the path, and a
+      # leading `~` must be expanded
+      prefixes.insert(0, "cd {} >/dev/null".format(env.cwd))
+    if prefixes:
+      command = " && ".join(prefixes + [command])
+    result = self.call("exec", command=command, shell=env.shell,
+      environment=dict(env.shell_env) or None, timeout=timeout
+    )
+    # the agent sends the output in base64
+    return dict(result, stdout=base64.b64decode(result["stdout"]),
+      stderr=base64.b64decode(result["stderr"])
+    )
+
+  def read_file(self, path, localFile):
+    """Copies a file of the host to a local file object, in chunks.
+
+    Args:
+      path(str): Path of the file on the host
+
+      localFile(file): Local file object opened for writing in binary mode
+
+    Returns:
+      int: the number of bytes copied
+    """
+    offset = 0
+    while True:
+      chunk = self.call("read", path=path, offset=offset,
+        length=_READ_CHUNK_SIZE
+      )
+      localFile.write(base64.b64decode(chunk["data"]))
+      offset += chunk["size"]
+      if chunk["size"] < _READ_CHUNK_SIZE:
+        return offset
+
+  def close(self):
+    """Stops the agent, by closing its channel."""
+    try:
+      self._channel.close()
+    except Exception:
+      pass
+
+def _open_channel(hostString):
+  """Uploads the agent to a host if needed, starts it and returns a channel to
+  it.
+  """
+  if get_backend(hostString) is LOCAL_BACKEND:
+    return _ProcessChannel([sys.executable, "-u", _AGENT_SOURCE_PATH])
+  remoteDir = get_module_config("viki.fabric.agent", "remote_dir",
+    _DEFAULT_REMOTE_DIR
+  )
+  remotePath = "{}/agent-{}.py".format(remoteDir, _get_agent_source_hash())
+  with settings(hide("everything"), host_string=hostString):
+    if not exists(remotePath):
+      run("mkdir -p {}".format(pipes.quote(remoteDir)))
+      put(_AGENT_SOURCE_PATH, remotePath)
+  from fabric.state import connections
+  channel = connections[hostString].get_transport().open_session()
+  channel.exec_command(
+    'cd && exec "$(command -v python3 || command -v python)" -u {}'.format(
+      pipes.quote(remotePath)
+    )
+  )
+  return channel
+
+def start_agent(hostString=None):
+  """Starts the agent on a host, uploading it first if needed, unless it is
+  already running. The agent is a small pure-Python program (see
+  `viki.fabric.agent_server`) serving `stat`, `exists`, `list_dir`, `read`,
+  `exec` and `dpkg_query` requests over a single long-lived SSH channel, so
+  that helpers do not start a remote shell for each request.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    RemoteAgent: the agent
+
+  Raises:
+    AgentError: if the agent does not respond
+
+  >>> start_agent().call("exists", paths=["/etc/hosts", "/etc/nope"])
+  [True, False]
+  """
+  if hostString is None:
+    hostString = env.host_string
+  agent = _AGENTS.get(hostString)
+  if agent is not None and agent.pid == os.getpid():
+    return agent
+  agent = RemoteAgent(hostString, _open_channel(hostString))
+  with settings(host_string=hostString):
+    agent.call("ping")
+  _AGENTS[hostString] = agent
+  _UNAVAILABLE_HOSTS.pop(hostString, None)
+  return agent
+
+def get_agent(hostString=None):
+  """Returns the agent of a host if it is running. If it is not, it is started
+  if the `enabled` key of the `viki.fabric.agent` dict in
+  `viki_fabric_config.yml` is `true`; if it cannot be started, a warning is
+  printed and the host is not tried again.
+
+  The helpers of `viki.fabric.helpers` and `viki.fabric.statcache` use the
+  agent when this returns one, and fall back to shell commands otherwise.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    RemoteAgent: the agent, or `None`
+  """
+  if hostString is None:
+    hostString = env.host_string
+  agent = _AGENTS.get(hostString)
+  if agent is not None and agent.pid == os.getpid():
+    return agent
+  if hostString in _UNAVAILABLE_HOSTS or \
+      not get_module_config("viki.fabric.agent", "enabled", False):
+    return None
+  try:
+    return start_agent(hostString)
+  except (AgentError, EnvironmentError, ValueError) as e:
+    _UNAVAILABLE_HOSTS[hostString] = str(e)
+    print(yellow(
+      "Could not start the agent on `{}`, using shell commands: {}".format(
+        hostString, e
+      )
+    ))
+    return None
+
+def stop_agent(hostString=None):
+  """Stops the agent of a host, if it is running.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+  """
+  if hostString is None:
+    hostString = env.host_string
+  agent = _AGENTS.pop(hostString, None)
+  if agent is not None and agent.pid == os.getpid():
+    agent.close()
+
+def _stop_agents_at_exit():
+  for hostString in list(_AGENTS):
+    stop_agent(hostString)
+
+atexit.register(_stop_agents_at_exit)
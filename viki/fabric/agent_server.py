@@ -0,0 +1,207 @@
+# Remote agent of `viki.fabric.agent`.
+#
+# This script is uploaded to the hosts and run over a single SSH exec channel;
+# it must only use the standard library of Python 2.6+ and Python 3. It reads
+# requests from stdin and writes responses to stdout, each one a JSON object
+# preceded by its length as a 4-byte big-endian unsigned integer:
+#
+#   request:  {"id": 1, "method": "stat", "params": {"paths": ["/etc"]}}
+#   response: {"id": 1, "result": [...]} or {"id": 1, "error": "..."}
+#
+# The agent exits when stdin is closed.
+
+import base64
+import json
+import os
+import signal
+import stat
+import struct
+import subprocess
+import sys
+import threading
+
+# Version of the protocol; requests of clients of other versions are refused
+PROTOCOL_VERSION = 2
+
+# Format of the length prefix of the messages
+_LENGTH_FORMAT = ">I"
+_LENGTH_SIZE = struct.calcsize(_LENGTH_FORMAT)
+
+def _get_type(mode):
+  """Returns the type of a file as printed by `find -printf %y`."""
+  if stat.S_ISREG(mode):
+    return "f"
+  elif stat.S_ISDIR(mode):
+    return "d"
+  elif stat.S_ISLNK(mode):
+    return "l"
+  elif stat.S_ISFIFO(mode):
+    return "p"
+  elif stat.S_ISSOCK(mode):
+    return "s"
+  elif stat.S_ISCHR(mode):
+    return "c"
+  elif stat.S_ISBLK(mode):
+    return "b"
+  return "?"
+
+def _stat_path(path):
+  """Returns the type, size, mode and modification time of a path (following
+  symbolic links), or `None` if it does not exist.
+  """
+  try:
+    st = os.stat(os.path.expanduser(path))
+  except OSError:
+    return None
+  return {
+    "type": _get_type(st.st_mode),
+    "size": st.st_size,
+    "mode": stat.S_IMODE(st.st_mode),
+    "mtime": st.st_mtime,
+  }
+
+def ping():
+  return {"protocol_version": PROTOCOL_VERSION, "pid": os.getpid()}
+
+def stat_paths(paths):
+  return [_stat_path(path) for path in paths]
+
+def exists(paths):
+  return [_stat_path(path) is not None for path in paths]
+
+def list_dir(path, limit=None):
+  """Returns the type of a directory and of its entries (following symbolic
+  links), and whether all the entries are listed.
+  """
+  path = os.path.expanduser(path)
+  dirStat = _stat_path(path)
+  if dirStat is None or dirStat["type"] != "d":
+    return {"type": dirStat and dirStat["type"], "entries": {},
+      "complete": True}
+  try:
+    names = os.listdir(path)
+  except OSError:
+    return {"type": "d", "entries": {}, "complete": False}
+  complete = limit is None or len(names) <= limit
+  entries = {}
+  for name in sorted(names)[:limit]:
+    entryStat = _stat_path(os.path.join(path, name))
+    entries[name] = entryStat and entryStat["type"]
+  return {"type": "d", "entries": entries, "complete": complete}
+
+def read(path, offset=0, length=None):
+  """Returns a range of bytes of a file, encoded in base64."""
+  f = open(os.path.expanduser(path), "rb")
+  try:
+    f.seek(offset)
+    data = f.read() if length is None else f.read(length)
+  finally:
+    f.close()
+  return {"data": base64.b64encode(data).decode("ascii"), "size": len(data)}
+
+def _decode(data):
+  return data.decode("utf-8", "replace")
+
+def run_command(command, shell="/bin/bash -l -c", cwd=None, environment=None,
+    timeout=None):
+  """Runs a shell command and returns its exit code and output, encoded in
+  base64 so that output which is not UTF-8 is returned unchanged.
+  """
+  processEnv = None
+  if environment:
+    processEnv = dict(os.environ)
+    processEnv.update(environment)
+  process = subprocess.Popen(shell.split() + [command], cwd=cwd,
+    env=processEnv, stdin=open(os.devnull, "rb"), stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE, preexec_fn=os.setsid
+  )
+  timedOut = []
+  timer = None
+  if timeout is not None:
+    def kill():
+      timedOut.append(True)
+      try:
+        os.killpg(process.pid, signal.SIGKILL)
+      except OSError:
+        pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+  try:
+    (stdout, stderr) = process.communicate()
+  finally:
+    if timer is not None:
+      timer.cancel()
+  return {
+    "return_code": process.returncode,
+    "stdout": base64.b64encode(stdout).decode("ascii"),
+    "stderr": base64.b64encode(stderr).decode("ascii"),
+    "timed_out": bool(timedOut),
+  }
+
+def dpkg_query(packages=None):
+  """Returns the installed packages known to dpkg, or the given ones."""
+  command = ["dpkg-query", "-W", "-f", "${Package}\t${Version}\t${Status}\n"]
+  process = subprocess.Popen(command + list(packages or []),
+    stdout=subprocess.PIPE, stderr=open(os.devnull, "wb")
+  )
+  (stdout, _) = process.communicate()
+  result = []
+  for line in _decode(stdout).splitlines():
+    fields = line.split("\t")
+    if len(fields) == 3:
+      result.append({"package": fields[0], "version": fields[1],
+        "status": fields[2]})
+  return result
+
+_METHODS = {
+  "ping": ping,
+  "stat": stat_paths,
+  "exists": exists,
+  "list_dir": list_dir,
+  "read": read,
+  "exec": run_command,
+  "dpkg_query": dpkg_query,
+}
+
+def _read_exactly(stream, size):
+  data = b""
+  while len(data) < size:
+    chunk = stream.read(size - len(data))
+    if not chunk:
+      return None
+    data += chunk
+  return data
+
+def _write_message(stream, message):
+  body = json.dumps(message).encode("utf-8")
+  stream.write(struct.pack(_LENGTH_FORMAT, len(body)) + body)
+  stream.flush()
+
+def serve(inStream, outStream):
+  while True:
+    header = _read_exactly(inStream, _LENGTH_SIZE)
+    if header is None:
+      return
+    body = _read_exactly(inStream, struct.unpack(_LENGTH_FORMAT, header)[0])
+    if body is None:
+      return
+    request = json.loads(body.decode("utf-8"))
+    response = {"id": request.get("id")}
+    try:
+      if request.get("protocol_version") != PROTOCOL_VERSION:
+        raise ValueError("unsupported protocol version {0}".format(
+          request.get("protocol_version")
+        ))
+      method = _METHODS[request["method"]]
+      response["result"] = method(**(request.get("params") or {}))
+    except Exception:
+      response["error"] = "{0}: {1}".format(sys.exc_info()[0].__name__,
+        sys.exc_info()[1]
+      )
+    _write_message(outStream, response)
+
+if __name__ == "__main__":
+  # binary streams on Python 3
+  serve(getattr(sys.stdin, "buffer", sys.stdin),
+    getattr(sys.stdout, "buffer", sys.stdout)
+  )
@@ -0,0 +1,405 @@
+import getpass
+import os
+import os.path
+import pipes
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+from fabric import operations as fabric_operations
+from fabric.api import env
+from fabric.contrib import files as fabric_files
+from fabric.exceptions import CommandTimeout
+from fabric.state import output
+from fabric.utils import abort, warn
+
+from viki.fabric.config import get_config_index
+
+# Host names which refer to this machine
+_LOCAL_HOST_NAMES = frozenset(["localhost", "127.0.0.1", "::1"])
+
+# Backends registered using `register_backend`; a list of
+# `(matches function, backend)` tuples, consulted in order
+_REGISTERED_BACKENDS = []
+
+class _AttributeList(list):
+  """Stand-in for the return value of Fabric's `put` and `get`."""
+
+  def __init__(self, paths):
+    list.__init__(self, paths)
+    self.failed = []
+    self.succeeded = True
+
+class SSHBackend(object):
+  """Execution backend which runs operations on the host over SSH, using
+  Fabric. This is the default backend.
+  """
+
+  # Fabric prefixes every line of output with `[host] out: `
+  prefixesOutput = True
+
+  # files are transferred over the network, so compressing them can pay off
+  transfersOverNetwork = True
+
+  def run(self, *args, **kwargs):
+    return fabric_operations.run(*args, **kwargs)
+
+  def sudo(self, *args, **kwargs):
+    return fabric_operations.sudo(*args, **kwargs)
+
+  def get(self, *args, **kwargs):
+    return fabric_operations.get(*args, **kwargs)
+
+  def put(self, *args, **kwargs):
+    return fabric_operations.put(*args, **kwargs)
+
+  def exists(self, *args, **kwargs):
+    return fabric_files.exists(*args, **kwargs)
+
+  def upload_template(self, *args, **kwargs):
+    return fabric_files.upload_template(*args, **kwargs)
+
+def render_template(filename, context=None, use_jinja=False,
+    template_dir=None):
+  """Renders a template locally the way `fabric.contrib.files.upload_template`
+  does.
+
+  Args:
+    filename(str): Name of the template
+
+    context(dict, optional): Variables of the template
+
+    use_jinja(bool, optional): If `True`, the template is rendered with Jinja2,
+      otherwise with Python string interpolation
+
+    template_dir(str, optional): Directory holding the template
+
+  Returns:
+    tuple: the rendered template (str), and the path of the template (str)
+  """
+  if use_jinja:
+    import jinja2
+    jinjaEnv = jinja2.Environment(
+      loader=jinja2.FileSystemLoader(template_dir or os.getcwd())
+    )
+    rendered = jinjaEnv.get_template(filename).render(**(context or {}))
+    templatePath = os.path.join(template_dir or os.getcwd(), filename)
+  else:
+    templatePath = os.path.join(template_dir or "", filename)
+    with open(os.path.expanduser(templatePath), "r") as f:
+      rendered = f.read()
+    if context:
+      rendered = rendered % context
+  return (rendered, templatePath)
+
+class _LocalResult(str):
+  """Stand-in for the return value of Fabric's `run` and `sudo`."""
+  pass
+
+class LocalBackend(object):
+  """Execution backend which runs operations on this machine using
+  subprocesses and file copies, without SSH. It honours the `cd`, `prefix`,
+  `shell_env` and `warn_only` Fabric settings, and writes output to the
+  `stdout` and `stderr` streams without Fabric's `[host] out: ` prefix.
+  """
+
+  prefixesOutput = False
+
+  transfersOverNetwork = False
+
+  def _wrap_command(self, command, shell, useSudo, user=None, group=None):
+    """Returns the argument list of the process running a command, applying
+    the Fabric settings which affect how commands are run.
+    """
+    prefixes = list(env.command_prefixes)
+    if env.cwd:
+      # not quoted, like Fabric does: `cd` has already escaped the path, and a
+      # leading `~` must be expanded
+      prefixes.insert(0, "cd {} >/dev/null".format(env.cwd))
+    if env.shell_env:
+      prefixes.insert(0, "export {}".format(" ".join(
+        "{}={}".format(k, pipes.quote(v)) for (k, v) in env.shell_env.items()
+      )))
+    fullCommand = " && ".join(prefixes + [command])
+    argv = env.shell.split() + [fullCommand] if shell \
+      else ["/bin/sh", "-c", fullCommand]
+    if useSudo and (os.geteuid() != 0 or user is not None):
+      sudoArgv = ["sudo", "-S", "-p", ""]
+      if user is not None:
+        sudoArgv.extend(["-H", "-u", str(user)])
+      if group is not None:
+        sudoArgv.extend(["-g", str(group)])
+      argv = sudoArgv + argv
+    return argv
+
+  def _run_command(self, command, useSudo, shell=True, pty=True,
+      combine_stderr=None, quiet=False, warn_only=False, stdout=None,
+      stderr=None, timeout=None, shell_escape=None, user=None, group=None,
+      **kwargs):
+    if quiet:
+      warn_only = True
+    warn_only = warn_only or env.warn_only
+    if combine_stderr is None:
+      combine_stderr = env.combine_stderr
+    if timeout is None:
+      timeout = env.command_timeout
+    operationName = "sudo" if useSudo else "run"
+    if output.running and not quiet:
+      print("[{}] {}: {}".format(env.host_string, operationName, command))
+    argv = self._wrap_command(command, shell, useSudo, user=user, group=group)
+    password = env.sudo_password or env.password
+    # the command runs in a process group of its own, so that a timeout kills
+    # the commands it started too, which would otherwise hold its output open
+    proc = subprocess.Popen(argv,
+      stdin=subprocess.PIPE if (useSudo and password) else None,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.STDOUT if combine_stderr else subprocess.PIPE,
+      preexec_fn=os.setsid
+    )
+    timedOut = []
+    timer = None
+    if timeout:
+      def _kill():
+        timedOut.append(True)
+        try:
+          os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+          pass
+      timer = threading.Timer(timeout, _kill)
+      timer.start()
+    try:
+      (out, err) = proc.communicate(
+        "{}\n".format(password) if (useSudo and password) else None
+      )
+    finally:
+      if timer is not None:
+        timer.cancel()
+    if timedOut:
+      raise CommandTimeout(timeout=timeout)
+    err = err or ""
+    # Fabric writes output to the given streams, or to the terminal unless
+    # hidden
+    if stdout is not None:
+      stdout.write(out)
+    elif output.stdout and not quiet:
+      sys.stdout.write(out)
+    if stderr is not None:
+      stderr.write(err)
+    elif output.stderr and not quiet:
+      sys.stderr.write(err)
+
+    result = _LocalResult(out.rstrip("\r\n"))
+    result.stdout = result
+    result.stderr = err.rstrip("\r\n")
+    result.return_code = proc.returncode
+    result.succeeded = proc.returncode == 0
+    result.failed = not result.succeeded
+    result.command = command
+    result.real_command = " ".join(pipes.quote(arg) for arg in argv)
+    if result.failed:
+      message = "{}() received nonzero return code {} while executing!".format(
+        operationName, proc.returncode
+      )
+      if warn_only:
+        if not quiet:
+          warn(message)
+      else:
+        abort("{}\n\nRequested: {}".format(message, command))
+    return result
+
+  def run(self, command, *args, **kwargs):
+    return self._run_command(command, False, *args, **kwargs)
+
+  def sudo(self, command, *args, **kwargs):
+    return self._run_command(command, True, *args, **kwargs)
+
+  def _expand_path(self, path):
+    """Expands `~` and environment variables in a path, like the remote shell
+    would.
+    """
+    path = os.path.expandvars(os.path.expanduser(path))
+    if env.cwd and not os.path.isabs(path):
+      path = os.path.join(os.path.expanduser(env.cwd), path)
+    return path
+
+  def exists(self, path, use_sudo=False, verbose=False):
+    if use_sudo:
+      return self.sudo("test -e \"$(echo {})\"".format(path),
+        quiet=True
+      ).succeeded
+    return os.path.exists(self._expand_path(path))
+
+  def _copy(self, sourcePath, destinationPath, use_sudo=False, mode=None):
+    """Copies a file, optionally with sudo, and sets its mode."""
+    if os.path.isdir(destinationPath):
+      destinationPath = os.path.join(destinationPath,
+        os.path.basename(sourcePath)
+      )
+    if use_sudo:
+      self.sudo("cp {} {}".format(pipes.quote(sourcePath),
+        pipes.quote(destinationPath)
+      ))
+      if mode is not None:
+        self.sudo("chmod {:o} {}".format(mode, pipes.quote(destinationPath)))
+    else:
+      shutil.copyfile(sourcePath, destinationPath)
+      if mode is not None:
+        os.chmod(destinationPath, mode)
+    return destinationPath
+
+  def put(self, local_path=None, remote_path=None, use_sudo=False,
+      mirror_local_mode=False, mode=None, **kwargs):
+    remotePath = self._expand_path(remote_path or ".")
+    if hasattr(local_path, "read"):
+      # a file-like object
+      if os.path.isdir(remotePath):
+        abort("put() needs a file name when given a file-like object")
+      with open(remotePath, "wb") as f:
+        shutil.copyfileobj(local_path, f)
+      if mode is not None:
+        os.chmod(remotePath, mode)
+      return _AttributeList([remotePath])
+    localPath = os.path.expanduser(local_path)
+    if mirror_local_mode and mode is None:
+      mode = os.stat(localPath).st_mode & 07777
+    return _AttributeList([
+      self._copy(localPath, remotePath, use_sudo=use_sudo, mode=mode)
+    ])
+
+  def get(self, remote_path, local_path=None, use_sudo=False, **kwargs):
+    remotePath = self._expand_path(remote_path)
+    if local_path is None:
+      local_path = os.path.basename(remotePath)
+    if hasattr(local_path, "write"):
+      # a file-like object
+      with open(remotePath, "rb") as f:
+        shutil.copyfileobj(f, local_path)
+      return _AttributeList([])
+    # Fabric interpolates these keys into the local path
+    localPath = local_path % {
+      "host": env.host,
+      "basename": os.path.basename(remotePath),
+      "dirname": os.path.dirname(remotePath),
+      "path": remotePath.lstrip("/"),
+    }
+    localDir = os.path.dirname(localPath)
+    if localDir and not os.path.isdir(localDir):
+      os.makedirs(localDir)
+    return _AttributeList([self._copy(remotePath, localPath,
+      use_sudo=use_sudo
+    )])
+
+  def upload_template(self, filename, destination, context=None,
+      use_jinja=False, template_dir=None, use_sudo=False, backup=True,
+      mirror_local_mode=False, mode=None, **kwargs):
+    destinationPath = self._expand_path(destination)
+    if os.path.isdir(destinationPath):
+      destinationPath = os.path.join(destinationPath,
+        os.path.basename(filename)
+      )
+    (rendered, templatePath) = render_template(filename, context=context,
+      use_jinja=use_jinja, template_dir=template_dir
+    )
+    if mirror_local_mode and mode is None:
+      mode = os.stat(os.path.expanduser(templatePath)).st_mode & 07777
+    if backup and os.path.exists(destinationPath):
+      self._copy(destinationPath, "{}.bak".format(destinationPath),
+        use_sudo=use_sudo
+      )
+    if use_sudo:
+      (fd, tmpPath) = tempfile.mkstemp()
+      try:
+        with os.fdopen(fd, "w") as f:
+          f.write(rendered)
+        return _AttributeList([
+          self._copy(tmpPath, destinationPath, use_sudo=True, mode=mode)
+        ])
+      finally:
+        os.unlink(tmpPath)
+    with open(destinationPath, "w") as f:
+      f.write(rendered)
+    if mode is not None:
+      os.chmod(destinationPath, mode)
+    return _AttributeList([destinationPath])
+
+# Instances of the built-in backends
+SSH_BACKEND = SSHBackend()
+LOCAL_BACKEND = LocalBackend()
+
+def is_local_target(hostString=None):
+  """Determines if a host string refers to this machine as the current user
+  on the default SSH port, so that operations can run without SSH.
+
+  Args:
+    hostString(str, optional): The host string of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    bool: True if the host string refers to this machine, False otherwise
+
+  >>> is_local_target("localhost")
+  True
+  >>> is_local_target("root@localhost")  # when running as `ubuntu`
+  False
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if not hostString:
+    return False
+  (user, _, hostPort) = hostString.rpartition("@")
+  if hostPort.startswith("["):
+    # IPv6 address in `[address]:port` format
+    (host, _, port) = hostPort[1:].partition("]")
+    port = port.lstrip(":")
+  elif hostPort.count(":") == 1:
+    (host, _, port) = hostPort.partition(":")
+  else:
+    (host, port) = (hostPort, "")
+  return host in _LOCAL_HOST_NAMES and \
+    user in ("", getpass.getuser()) and port in ("", "22")
+
+def register_backend(backend, matches):
+  """Registers an execution backend for the hosts it matches; registered
+  backends take precedence over the built-in ones, and are consulted in the
+  order they were registered.
+
+  Args:
+    backend(obj): An object with the same methods as `SSHBackend`, and a
+      `prefixesOutput` attribute which is True if output written to the
+      `stdout` and `stderr` streams has Fabric's `[host] out: ` prefix
+
+    matches(function): A function which takes a host string and returns True
+      if the backend should be used for that host
+
+  >>> register_backend(MyContainerBackend(),
+        lambda hostString: hostString.startswith("container-"))
+  """
+  _REGISTERED_BACKENDS.append((matches, backend))
+
+def get_backend(hostString=None):
+  """Returns the execution backend for a host: the first backend registered
+  using `register_backend` which matches the host, otherwise `LOCAL_BACKEND` if
+  the host is this machine (see `is_local_target`), otherwise `SSH_BACKEND`.
+
+  The local backend can be turned off by setting the `use_local_backend` key
+  of the `viki.fabric.backends` dict in `viki_fabric_config.yml` to `false`.
+
+  Args:
+    hostString(str, optional): The host string of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    obj: the execution backend
+  """
+  if hostString is None:
+    hostString = env.host_string
+  for (matches, backend) in _REGISTERED_BACKENDS:
+    if matches(hostString):
+      return backend
+  if is_local_target(hostString) and get_config_index(hostString).get(
+      ("viki.fabric.backends", "use_local_backend"), True):
+    return LOCAL_BACKEND
+  return SSH_BACKEND
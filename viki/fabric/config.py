@@ -0,0 +1,337 @@
+import cPickle
+import hashlib
+import os
+import os.path
+import tempfile
+
+from fabric.api import env
+
+from viki.fabric import VIKI_FABRIC_CONFIG_KEY_NAME
+
+# Key in `viki_fabric_config.yml` holding per-role config overrides; its value
+# is a dict mapping role names to dicts with the same layout as
+# `viki_fabric_config.yml`
+ROLES_CONFIG_KEY_NAME = "viki.fabric.roles"
+
+# Key in `viki_fabric_config.yml` holding per-host config overrides; its value
+# is a dict mapping host names (or host strings) to dicts with the same layout
+# as `viki_fabric_config.yml`
+HOSTS_CONFIG_KEY_NAME = "viki.fabric.hosts"
+
+# Resolved config indexes (see `get_config_index`), keyed by host string
+_CONFIG_INDEXES = {}
+
+# The `env[VIKI_FABRIC_CONFIG_KEY_NAME]` object the `_CONFIG_INDEXES` were
+# resolved from
+_CONFIG_INDEXES_SOURCE = None
+
+# Version of the format of the compiled config cache file; bump this whenever
+# the format changes so that stale caches are ignored
+_CACHE_FORMAT_VERSION = 1
+
+def get_config_cache_path(configFilePath):
+  """Returns the path of the compiled cache of a YAML config file; this is a
+  hidden file in the same directory as the config file.
+
+  Args:
+    configFilePath(str): path of the YAML config file
+
+  Returns:
+    str: path of the compiled cache
+
+  >>> get_config_cache_path("viki_fabric_config.yml")
+  ".viki_fabric_config.yml.cache"
+  """
+  (dirName, baseName) = os.path.split(configFilePath)
+  return os.path.join(dirName, ".{}.cache".format(baseName))
+
+def _parse_yaml(contents):
+  """Parses a YAML string using the C loader of PyYAML if it is available, and
+  the pure Python loader otherwise.
+  """
+  import yaml
+  return yaml.load(contents, Loader=getattr(yaml, "CLoader", yaml.Loader))
+
+def _read_config_cache(cachePath):
+  """Returns the contents of a compiled config cache, or `None` if it cannot be
+  read.
+  """
+  try:
+    with open(cachePath, "rb") as f:
+      cache = cPickle.load(f)
+  except Exception:
+    return None
+  if not isinstance(cache, dict) or \
+      cache.get("version") != _CACHE_FORMAT_VERSION:
+    return None
+  return cache
+
+def _write_config_cache(cachePath, cache):
+  """Atomically writes a compiled config cache. Failures (such as a read-only
+  directory) are ignored since the cache is only an optimization.
+  """
+  try:
+    fd, tmpPath = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(cachePath)), prefix=".config-"
+    )
+    with os.fdopen(fd, "wb") as f:
+      cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmpPath, cachePath)
+  except (IOError, OSError):
+    pass
+
+def load_yaml_config(configFilePath):
+  """Loads a YAML config file, using its compiled cache when the file has not
+  changed.
+
+  The compiled cache is keyed by the modification time and size of the file;
+  if either differs, the SHA1 hash of the file contents is compared before the
+  YAML is parsed again.
+
+  Args:
+    configFilePath(str): path of the YAML config file
+
+  Returns:
+    obj: the parsed contents of the YAML config file
+
+  >>> load_yaml_config("viki_fabric_config.yml")
+  {'viki.fabric.git': {'ssh_private_key': 'id_github_ssh_key', ...}}
+  """
+  cachePath = get_config_cache_path(configFilePath)
+  configStat = os.stat(configFilePath)
+  cache = _read_config_cache(cachePath)
+  if cache is not None and cache["mtime"] == configStat.st_mtime and \
+      cache["size"] == configStat.st_size:
+    return cache["config"]
+
+  with open(configFilePath, "rb") as f:
+    contents = f.read()
+  sha1 = hashlib.sha1(contents).hexdigest()
+  if cache is not None and cache["sha1"] == sha1:
+    config = cache["config"]
+  else:
+    config = _parse_yaml(contents)
+  _write_config_cache(cachePath, {
+    "version": _CACHE_FORMAT_VERSION,
+    "mtime": configStat.st_mtime,
+    "size": configStat.st_size,
+    "sha1": sha1,
+    "config": config,
+  })
+  return config
+
+class LazyYAMLConfig(dict):
+  """A dict holding the contents of a YAML config file, which is only loaded
+  (using `load_yaml_config`) when the dict is first accessed.
+
+  >>> config = LazyYAMLConfig("viki_fabric_config.yml") # file not read yet
+  >>> config["viki.fabric.git"] # file read here
+  {'ssh_private_key': 'id_github_ssh_key', ...}
+  """
+
+  def __init__(self, configFilePath):
+    dict.__init__(self)
+    self._configFilePath = configFilePath
+    self._loaded = False
+
+  def _load(self):
+    """Loads the YAML config file into this dict, if it has not been loaded.
+    """
+    if self._loaded:
+      return
+    config = load_yaml_config(self._configFilePath)
+    if config is not None and not isinstance(config, dict):
+      raise ValueError(
+        "`{}` should contain a dict at its top level".format(
+          self._configFilePath
+        )
+      )
+    # an empty file holds `None`
+    if config is not None:
+      dict.update(self, config)
+    # only set once loaded, so that a failed load is retried (and raises
+    # again) on the next access rather than leaving the config empty
+    self._loaded = True
+
+def _loading_method(methodName):
+  """Returns a method for the `LazyYAMLConfig` class which loads the YAML
+  config file before calling the `dict` method of the same name.
+  """
+  dictMethod = getattr(dict, methodName)
+  def method(self, *args, **kwargs):
+    self._load()
+    return dictMethod(self, *args, **kwargs)
+  method.__name__ = methodName
+  method.__doc__ = dictMethod.__doc__
+  return method
+
+for _methodName in ["__contains__", "__delitem__", "__eq__", "__getitem__",
+    "__iter__", "__len__", "__ne__", "__repr__", "__setitem__", "clear", "copy",
+    "get", "has_key", "items", "iteritems", "iterkeys", "itervalues", "keys",
+    "pop", "popitem", "setdefault", "update", "values"]:
+  setattr(LazyYAMLConfig, _methodName, _loading_method(_methodName))
+
+def _deep_merge(base, override):
+  """Returns a new dict with the contents of the `override` dict merged into
+  (a copy of) the `base` dict; nested dicts are merged recursively, while other
+  values in `override` replace those in `base`.
+  """
+  merged = dict(base)
+  for (k, v) in override.items():
+    if isinstance(v, dict) and isinstance(merged.get(k), dict):
+      merged[k] = _deep_merge(merged[k], v)
+    else:
+      merged[k] = v
+  return merged
+
+def _get_roles_of_host(hostString):
+  """Returns the names of the roles in `env.roledefs` containing a host."""
+  hostName = hostString.split("@")[-1].split(":")[0]
+  roles = []
+  for (roleName, roleHosts) in sorted(env.roledefs.items()):
+    if callable(roleHosts):
+      roleHosts = roleHosts()
+    if isinstance(roleHosts, dict):
+      roleHosts = roleHosts.get("hosts", [])
+    if hostString in roleHosts or hostName in roleHosts:
+      roles.append(roleName)
+  return roles
+
+def resolve_config(config, hostString=None):
+  """Resolves the layered config for a host: the global config, overridden by
+  the config of every role containing the host (see the
+  `ROLES_CONFIG_KEY_NAME` key), overridden by the config of the host itself
+  (see the `HOSTS_CONFIG_KEY_NAME` key).
+
+  Args:
+    config(dict): the contents of `viki_fabric_config.yml`
+
+    hostString(str, optional): The host to resolve the config for; if `None`,
+      only the global config is used
+
+  Returns:
+    dict: the resolved config, without the `ROLES_CONFIG_KEY_NAME` and
+      `HOSTS_CONFIG_KEY_NAME` keys
+
+  >>> config
+  {'a': {'b': 1, 'c': 2}, 'viki.fabric.hosts': {'hostOne': {'a': {'c': 3}}}}
+  >>> resolve_config(config, "ubuntu@hostOne")
+  {'a': {'b': 1, 'c': 3}}
+  """
+  resolved = dict((k, v) for (k, v) in config.items()
+    if k not in (ROLES_CONFIG_KEY_NAME, HOSTS_CONFIG_KEY_NAME)
+  )
+  if hostString is None:
+    return resolved
+  rolesConfig = config.get(ROLES_CONFIG_KEY_NAME) or {}
+  for roleName in _get_roles_of_host(hostString):
+    if isinstance(rolesConfig.get(roleName), dict):
+      resolved = _deep_merge(resolved, rolesConfig[roleName])
+  hostsConfig = config.get(HOSTS_CONFIG_KEY_NAME) or {}
+  hostName = hostString.split("@")[-1].split(":")[0]
+  # the host string is more specific than the host name
+  for hostKey in (hostName, hostString):
+    if isinstance(hostsConfig.get(hostKey), dict):
+      resolved = _deep_merge(resolved, hostsConfig[hostKey])
+  return resolved
+
+def _flatten_into(index, keyPath, value):
+  """Adds `value` and every value nested under it to a config index."""
+  index[keyPath] = value
+  if isinstance(value, dict):
+    for (k, v) in value.items():
+      _flatten_into(index, keyPath + (k,), v)
+
+def get_config_index(hostString=None):
+  """Returns the flattened config index for a host, resolving it (using
+  `resolve_config`) on first use.
+
+  The index maps every key path in the resolved config, as a tuple, to the
+  value under that key path, so lookups are a single dict access. Tuples are
+  used instead of dotted strings because keys such as `viki.fabric.git`
+  contain dots.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    dict: the config index; this is empty if there is no
+      `viki_fabric_config.yml` file
+
+  >>> get_config_index()[("viki.fabric.git", "ssh_keys_dir")]
+  '.ssh'
+  """
+  global _CONFIG_INDEXES_SOURCE
+  if hostString is None:
+    hostString = env.host_string
+  config = env.get(VIKI_FABRIC_CONFIG_KEY_NAME)
+  if config is not _CONFIG_INDEXES_SOURCE:
+    # `env[VIKI_FABRIC_CONFIG_KEY_NAME]` was replaced
+    clear_config_indexes()
+    _CONFIG_INDEXES_SOURCE = config
+  if hostString not in _CONFIG_INDEXES:
+    index = {}
+    if isinstance(config, dict):
+      _flatten_into(index, (), resolve_config(config, hostString))
+    _CONFIG_INDEXES[hostString] = index
+  return _CONFIG_INDEXES[hostString]
+
+def clear_config_indexes():
+  """Discards all resolved config indexes. Call this after modifying
+  `env.viki_fabric_config` in place.
+  """
+  _CONFIG_INDEXES.clear()
+
+def get_module_config(section, key, default=None):
+  """Returns the value of a key under a dict of `viki_fabric_config.yml`, such
+  as `viki.fabric.docker`, resolved for the current host (see
+  `get_config_index`).
+
+  Args:
+    section(str): The key of the dict, such as `viki.fabric.docker`
+
+    key(str): The key of interest in that dict
+
+    default(obj, optional): The value returned if the key is absent
+
+  Returns:
+    obj: the value of the key, or `default`
+
+  >>> get_module_config("viki.fabric.deadlines", "command_timeout", 600)
+  900
+  """
+  return get_config_index().get((section, key), default)
+
+def validate_config(config, schema, configName):
+  """Validates a config dict against a schema.
+
+  Args:
+    config(dict): The config to validate
+
+    schema(dict): A dict mapping each required key of `config` to the type (or
+      tuple of types) its value should have
+
+    configName(str): Name of the config, used in the error message
+
+  Raises:
+    RuntimeError: if `config` is not a dict, lacks a key in `schema`, or has a
+      value of the wrong type
+
+  >>> validate_config({"ssh_keys_dir": ".ssh"}, {"ssh_keys_dir": basestring},
+        "viki.fabric.git")
+  """
+  if not isinstance(config, dict):
+    raise RuntimeError("`{}` config should be a dict, not `{!r}`".format(
+      configName, config
+    ))
+  errors = []
+  for (k, expectedType) in sorted(schema.items()):
+    if k not in config:
+      errors.append("missing key `{}`".format(k))
+    elif not isinstance(config[k], expectedType):
+      errors.append("`{}` has the wrong type: `{!r}`".format(k, config[k]))
+  if errors:
+    raise RuntimeError("Invalid `{}` config: {}".format(configName,
+      "; ".join(errors)
+    ))
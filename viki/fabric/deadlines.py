@@ -0,0 +1,320 @@
+import atexit
+import fcntl
+import functools
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+from fabric.api import env
+from fabric.colors import red, yellow
+from fabric.context_managers import settings
+from fabric.exceptions import CommandTimeout, NetworkError
+
+from viki.fabric.config import get_module_config
+
+# Environment variable holding the id of the current Fabric run. Processes
+# started by a parallel Fabric run inherit it, so that they share quarantined
+# hosts through the quarantine file.
+RUN_ID_ENV_VAR = "VIKI_FABRIC_RUN_ID"
+
+# Default path of the local file holding the quarantined hosts of the current
+# run. Relative paths are relative to the directory where the main Python
+# script is run
+_DEFAULT_QUARANTINE_PATH = ".viki_fabric_quarantine.json"
+
+# Default number of failed connections to a host after which it is quarantined
+_DEFAULT_MAX_CONNECTION_FAILURES = 3
+
+# Quarantined hosts known to this process, keyed by host string, with the
+# reasons they were quarantined
+_QUARANTINED_HOSTS = {}
+
+# Number of failed connections to each host, keyed by host string
+_CONNECTION_FAILURES = {}
+
+# Per-thread stack of the deadlines (in seconds since the epoch) of the tasks
+# currently running
+_LOCAL = threading.local()
+
+class DeadlineExceeded(RuntimeError):
+  """Raised when an operation is issued after the deadline of the task it
+  belongs to.
+  """
+  pass
+
+class HostQuarantined(RuntimeError):
+  """Raised when an operation is issued on a host which has been quarantined
+  for the rest of the run.
+  """
+  pass
+
+def get_run_id():
+  """Returns the id of the current Fabric run, which is the value of the
+  `VIKI_FABRIC_RUN_ID` environment variable. If it is not set, it is set to a
+  new id, which the processes started by this process inherit, and this
+  process reports the quarantined hosts when it exits.
+
+  Returns:
+    str: the run id
+  """
+  runId = os.environ.get(RUN_ID_ENV_VAR)
+  if not runId:
+    runId = os.environ[RUN_ID_ENV_VAR] = "{}-{}".format(os.getpid(),
+      int(time.time() * 1000)
+    )
+    atexit.register(_report_at_exit, os.getpid())
+  return runId
+
+def _get_deadlines():
+  """Returns the stack of deadlines of the tasks running in this thread."""
+  deadlines = getattr(_LOCAL, "deadlines", None)
+  if deadlines is None:
+    deadlines = _LOCAL.deadlines = []
+  return deadlines
+
+def get_command_timeout():
+  """Returns the timeout for the next command: the smaller of the
+  `command_timeout` key of the `viki.fabric.deadlines` dict in
+  `viki_fabric_config.yml`, and the time left before the deadline of the
+  running task (see `with_deadline`).
+
+  Returns:
+    float: the timeout in seconds, or `None` if there is no timeout
+
+  Raises:
+    DeadlineExceeded: if the deadline of the running task has passed
+  """
+  timeout = get_module_config("viki.fabric.deadlines", "command_timeout", None)
+  deadlines = _get_deadlines()
+  if deadlines:
+    remaining = min(deadlines) - time.time()
+    if remaining <= 0:
+      raise DeadlineExceeded(
+        "The deadline of the task running on `{}` has passed".format(
+          env.host_string
+        )
+      )
+    timeout = remaining if timeout is None else min(timeout, remaining)
+  return timeout
+
+def get_quarantine_path():
+  """Returns the path of the local file holding the quarantined hosts.
+
+  This is the value of the `quarantine_path` key of the
+  `viki.fabric.deadlines` dict in `viki_fabric_config.yml`, or
+  `.viki_fabric_quarantine.json` if that key is absent.
+
+  Returns:
+    str: path of the quarantine file
+  """
+  return get_module_config("viki.fabric.deadlines", "quarantine_path",
+    _DEFAULT_QUARANTINE_PATH
+  )
+
+def _read_quarantine_file():
+  """Returns the contents of the quarantine file: a dict whose keys are run
+  ids and whose values are dicts mapping the quarantined hosts of the run to
+  the reasons they were quarantined.
+  """
+  quarantinePath = get_quarantine_path()
+  if not os.path.exists(quarantinePath):
+    return {}
+  with open(quarantinePath, "r") as f:
+    try:
+      return json.load(f)
+    except ValueError:
+      return {}
+
+def get_quarantined_hosts():
+  """Returns the hosts quarantined during the current run, by this process or
+  any other process of the run.
+
+  Returns:
+    dict: A dict whose keys are host strings and whose values are the reasons
+      the hosts were quarantined
+
+  >>> get_quarantined_hosts()
+  {"ubuntu@hostThree": "`docker pull busybox` timed out after 600 seconds"}
+  """
+  quarantinedHosts = dict(_read_quarantine_file().get(get_run_id(), {}))
+  quarantinedHosts.update(_QUARANTINED_HOSTS)
+  return quarantinedHosts
+
+def is_quarantined(hostString=None, checkOtherProcesses=False):
+  """Determines if a host has been quarantined during the current run.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+    checkOtherProcesses(bool, optional): If `True`, hosts quarantined by the
+      other processes of a parallel run are taken into account, which involves
+      reading the quarantine file
+
+  Returns:
+    bool: True if the host has been quarantined, False otherwise
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if hostString in _QUARANTINED_HOSTS:
+    return True
+  if checkOtherProcesses:
+    otherQuarantinedHosts = _read_quarantine_file().get(get_run_id(), {})
+    if hostString in otherQuarantinedHosts:
+      _QUARANTINED_HOSTS[hostString] = otherQuarantinedHosts[hostString]
+      return True
+  return False
+
+def check_not_quarantined(hostString=None):
+  """Raises `HostQuarantined` if a host has been quarantined during the
+  current run.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if hostString in _QUARANTINED_HOSTS:
+    raise HostQuarantined("`{}` has been quarantined: {}".format(hostString,
+      _QUARANTINED_HOSTS[hostString]
+    ))
+
+def quarantine_host(reason, hostString=None):
+  """Quarantines a host for the rest of the current run: operations on it
+  raise `HostQuarantined`, and tasks decorated with `with_deadline` skip it.
+
+  Args:
+    reason(str): Why the host is quarantined
+
+    hostString(str, optional): The host to quarantine. Defaults to
+      `env.host_string`
+
+  >>> quarantine_host("disk full")
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if hostString in _QUARANTINED_HOSTS:
+    return
+  _QUARANTINED_HOSTS[hostString] = reason
+  print(red("Quarantining `{}` for the rest of the run: {}".format(hostString,
+    reason
+  )))
+  # Hosts in a parallel run write to the same file, so the file is locked.
+  # Entries of earlier runs are dropped.
+  runId = get_run_id()
+  quarantinePath = get_quarantine_path()
+  quarantineDir = os.path.dirname(os.path.abspath(quarantinePath))
+  with open("{}.lock".format(quarantinePath), "w") as lockFile:
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    quarantinedHosts = _read_quarantine_file().get(runId, {})
+    quarantinedHosts[hostString] = reason
+    fd, tmpPath = tempfile.mkstemp(dir=quarantineDir, prefix=".quarantine-")
+    with os.fdopen(fd, "w") as f:
+      json.dump({ runId: quarantinedHosts }, f, indent=2, sort_keys=True)
+    os.rename(tmpPath, quarantinePath)
+
+def record_connection_failure(hostString=None):
+  """Records a failed connection to a host, and quarantines the host once the
+  `max_connection_failures` key of the `viki.fabric.deadlines` dict in
+  `viki_fabric_config.yml` (3 if absent) is reached.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+  """
+  if hostString is None:
+    hostString = env.host_string
+  failures = _CONNECTION_FAILURES.get(hostString, 0) + 1
+  _CONNECTION_FAILURES[hostString] = failures
+  maxFailures = get_module_config("viki.fabric.deadlines",
+    "max_connection_failures", _DEFAULT_MAX_CONNECTION_FAILURES
+  )
+  if failures >= maxFailures:
+    quarantine_host(
+      "{} failed connections".format(failures), hostString=hostString
+    )
+
+def with_deadline(seconds=None):
+  """A decorator for Fabric tasks which gives each call of the task a
+  deadline, and quarantines hosts which blow it or keep failing connections,
+  so that a run over many hosts is not held up by a few unhealthy ones.
+
+  Commands issued by the task are given a timeout no longer than the time left
+  before the deadline. If the deadline passes, a command times out, or the
+  connection to the host fails, the host is quarantined (after
+  `max_connection_failures` failed connections, for the latter), a warning is
+  printed and the task returns `None` instead of failing the run. The task is
+  skipped on hosts which are already quarantined.
+
+  Args:
+    seconds(float, optional): The deadline, in seconds after the task starts.
+      Defaults to the `task_timeout` key of the `viki.fabric.deadlines` dict in
+      `viki_fabric_config.yml`; if that key is absent too, there is no
+      deadline, but hosts are still quarantined as described above
+
+  The fan-out helpers of this library (such as `gather_facts` and
+  `setup_registry_mirrors`) apply this decorator to the task they run on each
+  host, with the configured `task_timeout` as the deadline.
+
+  >>> @task
+      @parallel
+      @with_deadline(900)
+      def deploy():
+        pull_docker_image_from_registry("viki/api", "v1.2.3")
+  """
+  # the processes forked by a parallel run of the task share the run id, so it
+  # is set before they are
+  get_run_id()
+  def decorator(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      hostString = env.host_string
+      if is_quarantined(hostString, checkOtherProcesses=True):
+        print(yellow("Skipping `{}` on quarantined host `{}`".format(
+          f.__name__, hostString
+        )))
+        return None
+      timeout = seconds
+      if timeout is None:
+        timeout = get_module_config("viki.fabric.deadlines", "task_timeout",
+          None
+        )
+      deadlines = _get_deadlines()
+      if timeout is not None:
+        deadlines.append(time.time() + timeout)
+      # network errors raise exceptions rather than aborting the whole run
+      useExceptionsFor = dict(env.use_exceptions_for, network=True)
+      try:
+        with settings(use_exceptions_for=useExceptionsFor):
+          return f(*args, **kwargs)
+      except (CommandTimeout, DeadlineExceeded, HostQuarantined,
+          NetworkError) as e:
+        print(red("`{}` failed on `{}`, moving on: {}".format(f.__name__,
+          hostString, e
+        )))
+        return None
+      finally:
+        if timeout is not None:
+          deadlines.pop()
+    return wrapper
+  return decorator
+
+def report_quarantined_hosts():
+  """Prints the hosts quarantined during the current run, if any."""
+  quarantinedHosts = get_quarantined_hosts()
+  if not quarantinedHosts:
+    return
+  print(red("{} host(s) were quarantined during this run:".format(
+    len(quarantinedHosts)
+  )))
+  for hostString in sorted(quarantinedHosts):
+    print(red("  {}: {}".format(hostString, quarantinedHosts[hostString])))
+
+def _report_at_exit(runOwnerPid):
+  # only the process which started the run reports
+  if os.getpid() == runOwnerPid:
+    report_quarantined_hosts()
@@ -1,18 +1,28 @@
+import json
+import multiprocessing
 import os
+import pipes
+import Queue
+import re
 import shutil
 import sys
 import tempfile
-
-import viki.fabric.git as viki_git
-import viki.fabric.helpers as viki_fab_helpers
+import time
+import uuid
 
 from fabric.api import env
 from fabric.colors import blue, red, yellow
-from fabric.context_managers import lcd, settings
+from fabric.context_managers import cd, hide, lcd, settings
 from fabric.decorators import runs_once, task
-from fabric.operations import local, run
 from fabric.tasks import execute
 
+from viki.fabric.config import get_module_config
+from viki.fabric.deadlines import with_deadline
+from viki.fabric.operations import local, run, sudo
+from viki.fabric.script import RemoteScript
+from viki.fabric.tracing import traced
+from viki.fabric.transfer import put_file
+
 def construct_tagged_docker_image_name(dockerImageName, dockerImageTag=None):
   """Constructs a tagged docker image name from a Docker image name and an
   optional tag.
@@ -27,7 +37,83 @@ def construct_tagged_docker_image_name(dockerImageName, dockerImageTag=None):
   else:
     return "{}:{}".format(dockerImageName, dockerImageTag)
 
-def _add_remotes_for_local_git_repository(gitRemotes):
+# Lines of the output of `docker build` starting a step, and reporting that a
+# step was served from the layer cache; the classic builder prints
+# "Step 2/5 : RUN make" and " ---> Using cache", BuildKit prints
+# "#6 [2/5] RUN make" and "#6 CACHED"
+_CLASSIC_BUILD_STEP_RE = re.compile(r"^Step \d+/\d+ : (\S+)")
+_CLASSIC_BUILD_CACHE_HIT_RE = re.compile(r"^ ---> Using cache")
+_BUILDKIT_BUILD_STEP_RE = re.compile(r"^#(\d+) \[[^\]]*\d+/\d+\] (\S+)")
+_BUILDKIT_BUILD_CACHE_HIT_RE = re.compile(r"^#(\d+) CACHED")
+
+# Layer cache statistics of the Docker images built by this process; see
+# `get_build_cache_stats`
+_BUILD_CACHE_STATS = []
+
+# Builder hosts the Docker images built by this process on builder hosts were
+# built on, keyed by tagged image name; they are pushed from there
+_IMAGE_BUILDER_HOSTS = {}
+
+# Default maximum load (see `_get_builder_host_load`) above that of the least
+# loaded builder host at which a builder host with a warmer layer cache is
+# still preferred
+_DEFAULT_BUILDER_AFFINITY_SLACK = 1.0
+
+def count_cached_build_steps(buildOutputLines):
+  """Counts the steps of a `docker build` (other than `FROM` steps) and how
+  many of them were served from the layer cache, from its output. Both the
+  classic builder and BuildKit (with plain progress output) are supported.
+
+  Args:
+    buildOutputLines(iterable of str): Lines of output of `docker build`
+
+  Returns:
+    tuple: the number of steps served from the cache (int), and the number of
+      steps (int)
+
+  >>> count_cached_build_steps(open("build.log"))
+  (7, 9)
+  """
+  classicSteps = classicHits = 0
+  buildkitSteps = set()
+  buildkitHits = set()
+  for line in buildOutputLines:
+    line = line.rstrip("\r\n")
+    m = _CLASSIC_BUILD_STEP_RE.match(line)
+    if m:
+      if m.group(1).upper() != "FROM":
+        classicSteps += 1
+      continue
+    if _CLASSIC_BUILD_CACHE_HIT_RE.match(line):
+      classicHits += 1
+      continue
+    m = _BUILDKIT_BUILD_STEP_RE.match(line)
+    if m:
+      if m.group(2).upper() != "FROM":
+        buildkitSteps.add(m.group(1))
+      continue
+    m = _BUILDKIT_BUILD_CACHE_HIT_RE.match(line)
+    if m:
+      buildkitHits.add(m.group(1))
+  if buildkitSteps:
+    return (len(buildkitHits & buildkitSteps), len(buildkitSteps))
+  return (classicHits, classicSteps)
+
+def get_build_cache_stats():
+  """Returns the layer cache statistics of the Docker images built by
+  `build_docker_image_from_git_repo` in this process.
+
+  Returns:
+    list of dict: one dict per build, with the keys `image` (the tagged image
+      name), `builder_host` (the builder host the image was built on, or
+      `None` if it was built locally), `cache_image` (the image used as a
+      cache source, or `None`),
+      `cached_steps`, `steps` and `hit_rate` (`cached_steps / steps`, or
+      `None` if there were no steps)
+  """
+  return list(_BUILD_CACHE_STATS)
+
+def _add_remotes_for_local_git_repository(gitRemotes, refIndex):
   """Adds git remotes supplied to the `build_docker_image_from_git_repo` Fabric
   task to the local git repository.
 
@@ -37,15 +123,14 @@ def _add_remotes_for_local_git_repository(gitRemotes):
     gitRemotes(dict): A dict where keys are git remote names and values are git
       remote urls. Refer to the docstring for the parameter of the same name in
       the `build_docker_image_from_git_repo` function for more information
+
+    refIndex(viki.fabric.git.LocalGitRefIndex): index of the local git
+      repository; it is kept up to date with the remotes added
   """
-  with settings(warn_only=True):
-    for (gitRemoteName, gitRemoteUrl) in gitRemotes.items():
-      # we remove any existing git remote of the same name before adding the
-      # remote
-      local("git remote rm {}".format(gitRemoteName))
-      local("git remote add {} {}".format(gitRemoteName, gitRemoteUrl))
+  # any existing git remote of the same name is overridden
+  refIndex.set_remotes(gitRemotes)
 
-def _set_upstream_branches_for_local_git_repository(gitSetUpstream):
+def _set_upstream_branches_for_local_git_repository(gitSetUpstream, refIndex):
   """Sets the upstream branch (remote tracking branch) for the given branches
   in the local git repository. This function should only be called by the
   `build_docker_image_from_git_repo` Fabric task.
@@ -58,28 +143,23 @@ def _set_upstream_branches_for_local_git_repository(gitSetUpstream):
       are git remote branch names in `remote/branch` format.
       Refer to docstring for the parameter of the same name in the
       `build_docker_image_from_git_repo` Fabric task for more information.
+
+    refIndex(viki.fabric.git.LocalGitRefIndex): index of the local git
+      repository, loaded after the remotes were fetched
   """
-  with settings(warn_only=True):
-    for (localBranchName, upstreamBranchName) in gitSetUpstream.items():
-      if viki_git.local_git_branch_exists(localBranchName):
-        # Local branch exists. Set its upstream branch to the remote tracking
-        # branch
-        local("git branch --set-upstream-to={} {}".format(
-          upstreamBranchName, localBranchName
-        ))
-      else:
-        # Local branch does not exist. Checkout from the remote branch.
-        # We assume the remote has been fetched.
-        local("git checkout -b {} {}".format(localBranchName,
-          upstreamBranchName
-        ))
+  # Local branches which exist get their upstream branch set to the remote
+  # tracking branch; those which do not exist are created from the remote
+  # branch.
+  refIndex.set_upstream_branches(gitSetUpstream)
 
 @runs_once
 @task
+@traced
 def build_docker_image_from_git_repo(gitRepository, dockerImageName,
     branch="master", gitRemotes=None, gitSetUpstream=None,
     runGitCryptInit=False, gitCryptKeyPath=None,
-    relativeDockerfileDirInGitRepo=".", dockerImageTag=None):
+    relativeDockerfileDirInGitRepo=".", dockerImageTag=None,
+    useRegistryCache=False, cacheTag=None, builderHosts=None):
   """A Fabric task which **runs locally**; it does the following:
 
   1. clones a given git repository to a local temporary directory and checks out
@@ -93,6 +173,21 @@ def build_docker_image_from_git_repo(gitRepository, dockerImageName,
   The Docker image is tagged (details are in the docstring for the
   `dockerImageTag` parameter).
 
+  If `useRegistryCache` is `True`, the cache image of the branch is pulled
+  from the Docker registry first and used as a layer cache source
+  (`docker build --cache-from`), so that layers built on other machines are
+  reused; after a successful build, the built image is pushed as the new cache
+  image. The number of build steps served from the layer cache is reported in
+  either case (see `get_build_cache_stats`).
+
+  If builder hosts are given (using the `builderHosts` parameter or the
+  `builder_hosts` key of the `viki.fabric.docker` dict in
+  `viki_fabric_config.yml`), the checked out repository is sent to one of them
+  over SSH and the image is built there instead of locally. The builder host
+  is the one holding the most images of the repository of `dockerImageName`
+  (hence the warmest layer cache) among the least loaded ones. The image stays
+  on the builder host; `push_docker_image_to_registry` pushes it from there.
+
   **NOTE:** This Fabric task is only run once regardless of the number of
   hosts/roles you supply.
 
@@ -132,7 +227,10 @@ def build_docker_image_from_git_repo(gitRepository, dockerImageName,
       If supplied, the corresponding upstream branch will be set for the local
       branch using `git branch --set-upstream-to=upstream-branch local-branch`
       for existing local branches, or
-      `git checkout -b upstream-branch local-branch` for non-existent branches.
+      `git branch --track local-branch upstream-branch` for non-existent
+      branches (which creates the branch without checking it out). A local
+      branch whose upstream branch does not exist is left as it is, with a
+      warning.
 
       Remote tracking branches must be specified in `remote/branch` format.
       You should supply this parameter if the following hold:
@@ -173,6 +271,18 @@ def build_docker_image_from_git_repo(gitRepository, dockerImageName,
       is 18f450dc8c4be916fdf7f47cf79aae9af1a67cd7, then the tag will be
       `master-18f450dc8c4b`.
 
+    useRegistryCache(bool, optional): If `True`, the cache image is pulled
+      and used as a layer cache source, and updated after a successful build.
+      Defaults to `False`
+
+    cacheTag(str, optional): Tag of the cache image of `dockerImageName`.
+      Defaults to `branch-cache`, such as `master-cache`
+
+    builderHosts(list of str, optional): Host strings of the builder hosts,
+      which need Docker. Defaults to the `builder_hosts` key of the
+      `viki.fabric.docker` dict in `viki_fabric_config.yml`; the image is
+      built locally if neither is given
+
   Returns:
     str: The tag of the Docker image
 
@@ -181,6 +291,26 @@ def build_docker_image_from_git_repo(gitRepository, dockerImageName,
       - the `gitCryptKeyPath` parameter is not given, or `None` is supplied
       - the `gitCryptKeyPath` parameter is a non-existent path
   """
+  return _build_docker_image_from_git_repo(gitRepository, dockerImageName,
+    branch, gitRemotes, gitSetUpstream, runGitCryptInit, gitCryptKeyPath,
+    relativeDockerfileDirInGitRepo, dockerImageTag, useRegistryCache, cacheTag,
+    builderHosts
+  )
+
+def _build_docker_image_from_git_repo(gitRepository, dockerImageName,
+    branch="master", gitRemotes=None, gitSetUpstream=None,
+    runGitCryptInit=False, gitCryptKeyPath=None,
+    relativeDockerfileDirInGitRepo=".", dockerImageTag=None,
+    useRegistryCache=False, cacheTag=None, builderHosts=None):
+  """Does the work of the `build_docker_image_from_git_repo` Fabric task; it
+  is not decorated with `runs_once`, so that it can build several images.
+  """
+  if builderHosts is None:
+    builderHosts = get_module_config("viki.fabric.docker", "builder_hosts",
+      None
+    )
+  if isinstance(builderHosts, basestring):
+    builderHosts = [h.strip() for h in builderHosts.split(",") if h.strip()]
   if runGitCryptInit:
     # Check validity of `gitCryptKeyPath` because `runGitCryptInit` is True
     if gitCryptKeyPath is None:
@@ -194,6 +324,8 @@ def build_docker_image_from_git_repo(gitRepository, dockerImageName,
         "  supply a path to an existing git-crypt key.").format(gitCryptKeyPath)
       )
 
+  import viki.fabric.git as viki_git
+
   # Clone this git repository into a temporary directory so we can check out
   # the branch from which we want to build the Docker image
   tmpGitRepoPathName = tempfile.mkdtemp()
@@ -202,16 +334,21 @@ def build_docker_image_from_git_repo(gitRepository, dockerImageName,
   dockerImageTag = None
   # go into the cloned repo
   with lcd(tmpGitRepoPathName):
+    # refs and remotes of the cloned repo, so that we do not spawn git
+    # processes for every remote and branch
+    refIndex = viki_git.LocalGitRefIndex()
     if isinstance(gitRemotes, dict):
       print(blue("Adding supplied git remotes..."))
-      _add_remotes_for_local_git_repository(gitRemotes)
+      _add_remotes_for_local_git_repository(gitRemotes, refIndex)
     # pull from all remotes
     local("git fetch --all")
     # set upstream branches; refer to the docstring for the `gitSetUpstream`
     # parameter for more information
     if isinstance(gitSetUpstream, dict):
       print(blue("Setting upstream branches..."))
-      _set_upstream_branches_for_local_git_repository(gitSetUpstream)
+      # the fetch created remote tracking branches
+      refIndex.reload()
+      _set_upstream_branches_for_local_git_repository(gitSetUpstream, refIndex)
     # check out the branch, set up git-crypt to decrypt the encrypted files (if
     # instructed).
     local("git checkout {}".format(branch))
@@ -236,21 +373,215 @@ def build_docker_image_from_git_repo(gitRepository, dockerImageName,
         dockerTaggedImageName, branch, headSHA1
       )
     ))
-    # Build the tagged Docker image using the Dockerfile in the
-    # `relativeDockerfileInGitRepo` directory inside the Git repository
-    local("docker build -t {} {}".format(dockerTaggedImageName,
-      relativeDockerfileDirInGitRepo
-    ))
+    builderHost = None
+    remoteBuildDir = None
+    if builderHosts:
+      builderHost = _select_builder_host(builderHosts, dockerImageName)
+      remoteBuildDir = _send_build_context_to_builder_host(
+        tmpGitRepoPathName, builderHost
+      )
+    try:
+      # `cd` only affects the commands run on the builder host
+      with cd(remoteBuildDir or "."):
+        _run_docker_build(dockerImageName, dockerTaggedImageName, branch,
+          relativeDockerfileDirInGitRepo, useRegistryCache, cacheTag,
+          builderHost
+        )
+    finally:
+      if remoteBuildDir is not None:
+        _run_on_builder_host("rm -rf {}".format(pipes.quote(remoteBuildDir)),
+          builderHost, warnOnly=True
+        )
 
   # delete temporary git repo directory
   shutil.rmtree(tmpGitRepoPathName)
   return dockerImageTag
 
+def _run_on_builder_host(command, builderHost, warnOnly=False):
+  """Runs a command of a build on a builder host (see `_select_builder_host`),
+  or locally if `builderHost` is `None`.
+  """
+  with settings(warn_only=warnOnly):
+    if builderHost is None:
+      return local(command, shell="/bin/bash")
+    with settings(host_string=builderHost):
+      return run(command)
+
+def _run_docker_build(dockerImageName, dockerTaggedImageName, branch,
+    relativeDockerfileDirInGitRepo, useRegistryCache, cacheTag, builderHost):
+  """Builds a Docker image from the build context in the current directory
+  (on the builder host if `builderHost` is not `None`), using the registry
+  cache if instructed, and records its layer cache statistics.
+  """
+  buildOptions = ""
+  cacheImageName = None
+  if useRegistryCache:
+    cacheImageName = construct_tagged_docker_image_name(dockerImageName,
+      cacheTag or "{}-cache".format(branch)
+    )
+    print(blue("Pulling cache image `{}`...".format(cacheImageName)))
+    cachePulled = _run_on_builder_host(
+      "docker pull {}".format(cacheImageName), builderHost, warnOnly=True
+    ).succeeded
+    if cachePulled:
+      buildOptions += "--cache-from {} ".format(cacheImageName)
+    else:
+      print(yellow(
+        "Cache image `{}` could not be pulled; building without it".format(
+          cacheImageName
+        )
+      ))
+    # embeds the cache metadata in the image, so that BuildKit can use the
+    # image as a cache source on other machines
+    buildOptions += "--build-arg BUILDKIT_INLINE_CACHE=1 "
+  # Build the tagged Docker image using the Dockerfile in the
+  # `relativeDockerfileInGitRepo` directory inside the Git repository. The
+  # output of local builds is also written to a file to count the cache hits;
+  # remote builds return it. The file is kept out of the build context, where
+  # it would invalidate the layer cache of `COPY .` steps.
+  buildCommand = "docker build {}-t {} {} 2>&1".format(buildOptions,
+    dockerTaggedImageName, relativeDockerfileDirInGitRepo
+  )
+  if builderHost is None:
+    (fd, buildLogPath) = tempfile.mkstemp(prefix="viki-docker-build-",
+      suffix=".log"
+    )
+    os.close(fd)
+    try:
+      local("set -o pipefail; {} | tee {}".format(buildCommand, buildLogPath),
+        shell="/bin/bash"
+      )
+      with open(buildLogPath, "r") as f:
+        (cachedSteps, steps) = count_cached_build_steps(f)
+    finally:
+      os.unlink(buildLogPath)
+  else:
+    buildOutput = _run_on_builder_host(buildCommand, builderHost)
+    (cachedSteps, steps) = count_cached_build_steps(buildOutput.splitlines())
+    _IMAGE_BUILDER_HOSTS[dockerTaggedImageName] = builderHost
+  _BUILD_CACHE_STATS.append({
+    "image": dockerTaggedImageName,
+    "builder_host": builderHost,
+    "cache_image": cacheImageName,
+    "cached_steps": cachedSteps,
+    "steps": steps,
+    "hit_rate": float(cachedSteps) / steps if steps else None,
+  })
+  print(blue("Layer cache: {} of {} build steps reused{}".format(
+    cachedSteps, steps,
+    " ({:.0%})".format(float(cachedSteps) / steps) if steps else ""
+  )))
+  if cacheImageName is not None:
+    print(blue("Pushing cache image `{}`...".format(cacheImageName)))
+    _run_on_builder_host("docker tag {} {}".format(dockerTaggedImageName,
+      cacheImageName), builderHost
+    )
+    if _run_on_builder_host("docker push {}".format(cacheImageName),
+        builderHost, warnOnly=True).failed:
+      print(yellow(
+        "Could not push cache image `{}`; the next build will not reuse"
+        " the layers of this build".format(cacheImageName)
+      ))
+
+def _get_builder_host_load(builderHost, dockerImageName):
+  """Returns the load of a builder host (its 1-minute load average per CPU,
+  plus the number of `docker build` commands running on it) and the number of
+  local images of the repository of `dockerImageName` on it, which tells how
+  warm its layer cache is for that repository; returns `None` if the host
+  cannot be reached.
+  """
+  repository = dockerImageName.split(":")[0]
+  script = RemoteScript()
+  script.add_step("loadavg", "cut -d ' ' -f 1 /proc/loadavg")
+  script.add_step("cpus", "nproc")
+  script.add_step("builds", "pgrep -fc '^docker build' || true")
+  script.add_step("images",
+    "docker images -q {} | wc -l".format(pipes.quote(repository))
+  )
+  try:
+    with settings(host_string=builderHost):
+      result = script.run()
+  # Fabric aborts with `SystemExit` when it cannot connect
+  except (Exception, SystemExit) as e:
+    print(yellow("Could not reach builder host `{}`: {}".format(builderHost,
+      e
+    )))
+    return None
+  if not result["succeeded"]:
+    print(yellow("Could not get the load of builder host `{}`".format(
+      builderHost
+    )))
+    return None
+  values = dict((name, stepResult["output"][-1].strip())
+    for (name, stepResult) in result["steps"].items()
+  )
+  return {
+    "host": builderHost,
+    "load": float(values["loadavg"]) / max(int(values["cpus"]), 1) +
+      int(values["builds"]),
+    "cached_images": int(values["images"]),
+  }
+
+def _select_builder_host(builderHosts, dockerImageName):
+  """Picks the builder host to build a Docker image on: the host holding the
+  most images of its repository (hence the warmest layer cache) among the
+  hosts whose load is within the `builder_affinity_slack` key of the
+  `viki.fabric.docker` dict in `viki_fabric_config.yml` of the least loaded
+  host.
+
+  Raises:
+    RuntimeError: if no builder host can be reached
+  """
+  loads = [load for load in (_get_builder_host_load(h, dockerImageName)
+    for h in builderHosts) if load is not None]
+  if not loads:
+    raise RuntimeError("None of the builder hosts {} can be reached".format(
+      ", ".join(builderHosts)
+    ))
+  slack = float(get_module_config("viki.fabric.docker",
+    "builder_affinity_slack", _DEFAULT_BUILDER_AFFINITY_SLACK
+  ))
+  minLoad = min(load["load"] for load in loads)
+  candidates = [load for load in loads if load["load"] <= minLoad + slack]
+  selected = max(candidates,
+    key=lambda load: (load["cached_images"], -load["load"])
+  )
+  print(blue(
+    "Building `{}` on `{}` (load {:.2f}, {} cached images)...".format(
+      dockerImageName, selected["host"], selected["load"],
+      selected["cached_images"]
+    )
+  ))
+  return selected["host"]
+
+def _send_build_context_to_builder_host(localBuildDir, builderHost):
+  """Sends the checked out git repository (with its `.git` directory and any
+  files decrypted by git-crypt) to a new directory on a builder host, and
+  returns the path of that directory.
+  """
+  remoteBuildDir = "/tmp/viki-docker-build-{}".format(uuid.uuid4().hex[:12])
+  (fd, contextTarPath) = tempfile.mkstemp(suffix=".tar")
+  os.close(fd)
+  try:
+    local("tar -cf {} -C {} .".format(contextTarPath, localBuildDir))
+    with settings(host_string=builderHost):
+      run("mkdir -p {}".format(remoteBuildDir))
+      # compressed for the transfer if it is worth it
+      put_file(contextTarPath, remoteBuildDir + "/context.tar")
+      with cd(remoteBuildDir):
+        run("tar -xf context.tar && rm context.tar")
+  finally:
+    os.unlink(contextTarPath)
+  return remoteBuildDir
+
 @runs_once
 @task
+@traced
 def push_docker_image_to_registry(dockerImageName, dockerImageTag="latest"):
   """A Fabric task which **runs locally**; it pushes a local Docker image with
-  a given tag to the Docker registry (http://index.docker.io).
+  a given tag to the Docker registry (http://index.docker.io). Images built
+  on a builder host by `build_docker_image_from_git_repo` in this process are
+  pushed from that builder host.
 
   **NOTE:** This Fabric task is only run once regardless of the number of
   hosts/roles you supply.
@@ -261,8 +592,18 @@ def push_docker_image_to_registry(dockerImageName, dockerImageTag="latest"):
     dockerImageTag(str, optional): Tag of the Docker image, defaults to the
       string "latest"
   """
-  dockerTaggedImageName = construct_tagged_docker_image_name(dockerImageName,
-    dockerImageTag)
+  _push_docker_image_to_registry(
+    construct_tagged_docker_image_name(dockerImageName, dockerImageTag)
+  )
+
+def _push_docker_image_to_registry(dockerTaggedImageName, builderHost=None):
+  """Does the work of the `push_docker_image_to_registry` Fabric task; it is
+  not decorated with `runs_once`, so that it can push several images. The
+  image is pushed from `builderHost`, which defaults to the builder host it
+  was built on in this process, if any.
+  """
+  if builderHost is None:
+    builderHost = _IMAGE_BUILDER_HOSTS.get(dockerTaggedImageName)
   # try running `docker push` without logging in and see if it succeeds so we
   # can avoid running a `docker login`, because at minimum, `docker login`
   # requires the user to press the Enter key if he/she is already logged to the
@@ -273,8 +614,9 @@ def push_docker_image_to_registry(dockerImageName, dockerImageTag="latest"):
     ("Pushing image `{}` to the Docker registry"
      " (http://index.docker.io)...").format(dockerTaggedImageName)
   ))
-  with settings(warn_only=True):
-    dockerPushSucceeded = local(dockerPushCmd).succeeded
+  dockerPushSucceeded = _run_on_builder_host(dockerPushCmd, builderHost,
+    warnOnly=True
+  ).succeeded
   # `docker push` failed most probably due to login issues.
   # Do a `docker login` followed by the `docker push`.
   if not dockerPushSucceeded:
@@ -282,11 +624,12 @@ def push_docker_image_to_registry(dockerImageName, dockerImageTag="latest"):
       "The previous `docker push` failed most probably due to a lack of"
       " credentials. Running `docker login` followed by `docker push`..."
     ))
-    local("docker login")
-    local(dockerPushCmd)
+    _run_on_builder_host("docker login", builderHost)
+    _run_on_builder_host(dockerPushCmd, builderHost)
 
 @runs_once
 @task
+@traced
 def build_docker_image_from_git_repo_and_push_to_registry(gitRepository,
     dockerImageName, **kwargs):
   """A Fabric task which **runs locally**; it builds a Docker image from a git
@@ -310,6 +653,8 @@ def build_docker_image_from_git_repo_and_push_to_registry(gitRepository,
   Returns:
     str: The tag of the built Docker image
   """
+  import viki.fabric.helpers as viki_fab_helpers
+
   retVal = execute(build_docker_image_from_git_repo, gitRepository,
     dockerImageName, roles=env.roles, hosts=env.hosts, **kwargs
   )
@@ -320,9 +665,242 @@ def build_docker_image_from_git_repo_and_push_to_registry(gitRepository,
   )
   return dockerImageTag
 
+# Default number of images built at the same time, and pushed at the same
+# time, by `release_docker_images`
+_DEFAULT_BUILD_CONCURRENCY = 1
+_DEFAULT_PUSH_CONCURRENCY = 2
+
+# Default number of built images which may wait to be pushed in
+# `release_docker_images`; builds wait while that many images are waiting, so
+# that built images do not pile up on the local disk
+_DEFAULT_PUSH_QUEUE_SIZE = 2
+
+def _release_build_worker(buildQueue, pushQueue, resultQueue):
+  """Builds the images taken from `buildQueue` and hands them over to the push
+  workers through `pushQueue`; runs in a process of `release_docker_images`.
+  """
+  while True:
+    job = buildQueue.get()
+    if job is None:
+      return
+    (idx, image) = job
+    buildKwargs = dict(image)
+    gitRepository = buildKwargs.pop("gitRepository")
+    dockerImageName = buildKwargs.pop("dockerImageName")
+    buildStart = time.time()
+    try:
+      dockerImageTag = _build_docker_image_from_git_repo(gitRepository,
+        dockerImageName, **buildKwargs
+      )
+    # Fabric aborts with `SystemExit` when a command fails
+    except (Exception, SystemExit) as e:
+      resultQueue.put((idx, {
+        "docker_image_name": dockerImageName,
+        "docker_image_tag": None,
+        "build_seconds": time.time() - buildStart,
+        "queued_seconds": None,
+        "push_seconds": None,
+        "cache_hit_rate": None,
+        "builder_host": None,
+        "error": "build failed: {}".format(e),
+      }))
+      continue
+    # blocks while the push queue is full
+    pushQueue.put((idx, dockerImageName, dockerImageTag, buildStart,
+      time.time(), _BUILD_CACHE_STATS[-1]["hit_rate"],
+      _BUILD_CACHE_STATS[-1]["builder_host"]
+    ))
+
+def _release_push_worker(pushQueue, resultQueue):
+  """Pushes the images taken from `pushQueue`; runs in a process of
+  `release_docker_images`.
+  """
+  while True:
+    job = pushQueue.get()
+    if job is None:
+      return
+    (idx, dockerImageName, dockerImageTag, buildStart, buildEnd,
+      cacheHitRate, builderHost) = job
+    pushStart = time.time()
+    error = None
+    try:
+      # the image is only on the builder host it was built on, which this
+      # process does not know about
+      _push_docker_image_to_registry(
+        construct_tagged_docker_image_name(dockerImageName, dockerImageTag),
+        builderHost
+      )
+    except (Exception, SystemExit) as e:
+      error = "push failed: {}".format(e)
+    resultQueue.put((idx, {
+      "docker_image_name": dockerImageName,
+      "docker_image_tag": dockerImageTag,
+      "build_seconds": buildEnd - buildStart,
+      "queued_seconds": pushStart - buildEnd,
+      "push_seconds": time.time() - pushStart,
+      "cache_hit_rate": cacheHitRate,
+      "builder_host": builderHost,
+      "error": error,
+    }))
+
+@runs_once
+@task
+@traced
+def release_docker_images(images, buildConcurrency=None,
+    pushConcurrency=None, pushQueueSize=None):
+  """A Fabric task which **runs locally**; it builds several Docker images
+  from git repositories and pushes them to the Docker registry, as a pipeline:
+  images are pushed while the next images are built, instead of leaving the
+  network idle during builds and the CPU idle during pushes.
+
+  Builds and pushes run in separate processes, connected by a bounded queue
+  of built images waiting to be pushed. Since the pushes cannot prompt for
+  credentials, log in to the Docker registry (`docker login`) beforehand.
+
+  If builder hosts are given (see `build_docker_image_from_git_repo`), each
+  image is built and pushed on the builder host picked for it, so raising
+  `buildConcurrency` builds several images in parallel on the builder hosts
+  rather than on this machine.
+
+  **NOTE:** This Fabric task is only run once regardless of the number of
+  hosts/roles you supply.
+
+  Args:
+    images(list of dict): The images to release. Each dict holds the
+      `gitRepository` and `dockerImageName` keys, and optionally other keyword
+      arguments of the `build_docker_image_from_git_repo` Fabric task (such as
+      `branch` or `builderHosts`)
+
+    buildConcurrency(int, optional): Number of images built at the same time.
+      Defaults to the `build_concurrency` key of the `viki.fabric.docker` dict
+      in `viki_fabric_config.yml`, or 1 if that key is absent
+
+    pushConcurrency(int, optional): Number of images pushed at the same time.
+      Defaults to the `push_concurrency` key of the `viki.fabric.docker` dict
+      in `viki_fabric_config.yml`, or 2 if that key is absent
+
+    pushQueueSize(int, optional): Number of built images which may wait to be
+      pushed; builds wait while the queue is full. Defaults to the
+      `push_queue_size` key of the `viki.fabric.docker` dict in
+      `viki_fabric_config.yml`, or 2 if that key is absent
+
+  Returns:
+    list of dict: One dict per image, in the order of `images`, with the keys
+      `docker_image_name`, `docker_image_tag` (`None` if the build failed),
+      `build_seconds`, `queued_seconds` (time spent waiting to be pushed),
+      `push_seconds`, `cache_hit_rate` (see `get_build_cache_stats`),
+      `builder_host` (`None` if the image was built locally) and `error`
+      (`None` if the image was released)
+
+  >>> release_docker_images([
+        {"gitRepository": "git@github.com:viki-org/api.git",
+         "dockerImageName": "viki/api"},
+        {"gitRepository": "git@github.com:viki-org/web.git",
+         "dockerImageName": "viki/web", "branch": "release"},
+      ])
+  [{"docker_image_name": "viki/api", "docker_image_tag": "master-18f450dc8c4b",
+    "build_seconds": 95.2, "queued_seconds": 0.0, "push_seconds": 41.7,
+    "cache_hit_rate": 0.8, "builder_host": None, "error": None}, ...]
+  """
+  if buildConcurrency is None:
+    buildConcurrency = get_module_config("viki.fabric.docker",
+      "build_concurrency", _DEFAULT_BUILD_CONCURRENCY
+    )
+  if pushConcurrency is None:
+    pushConcurrency = get_module_config("viki.fabric.docker",
+      "push_concurrency", _DEFAULT_PUSH_CONCURRENCY
+    )
+  if pushQueueSize is None:
+    pushQueueSize = get_module_config("viki.fabric.docker", "push_queue_size",
+      _DEFAULT_PUSH_QUEUE_SIZE
+    )
+  # arguments given on the command line are strings
+  buildConcurrency = int(buildConcurrency)
+  pushConcurrency = int(pushConcurrency)
+  pushQueueSize = int(pushQueueSize)
+  if buildConcurrency < 1 or pushConcurrency < 1 or pushQueueSize < 1:
+    raise ValueError(
+      "`buildConcurrency`, `pushConcurrency` and `pushQueueSize` must be"
+      " positive"
+    )
+  for image in images:
+    if "gitRepository" not in image or "dockerImageName" not in image:
+      raise ValueError(
+        "Every image must have the `gitRepository` and `dockerImageName`"
+        " keys; got {}".format(image)
+      )
+
+  startTime = time.time()
+  # Fabric's `env` (and hence `lcd` and `settings`) is shared by the threads
+  # of a process, so the stages run in separate processes
+  buildQueue = multiprocessing.Queue()
+  pushQueue = multiprocessing.Queue(pushQueueSize)
+  resultQueue = multiprocessing.Queue()
+  for (idx, image) in enumerate(images):
+    buildQueue.put((idx, image))
+  for _ in range(buildConcurrency):
+    buildQueue.put(None)
+  pushWorkers = [
+    multiprocessing.Process(target=_release_push_worker,
+      args=(pushQueue, resultQueue)
+    ) for _ in range(pushConcurrency)
+  ]
+  buildWorkers = [
+    multiprocessing.Process(target=_release_build_worker,
+      args=(buildQueue, pushQueue, resultQueue)
+    ) for _ in range(min(buildConcurrency, len(images)))
+  ]
+  for worker in pushWorkers + buildWorkers:
+    worker.daemon = True
+    worker.start()
+  # every image yields exactly one result, from a build worker if the build
+  # failed and from a push worker otherwise
+  results = [None] * len(images)
+  for _ in images:
+    while True:
+      try:
+        (idx, result) = resultQueue.get(timeout=5)
+        break
+      except Queue.Empty:
+        if not any(w.is_alive() for w in pushWorkers + buildWorkers):
+          raise RuntimeError("The release workers exited unexpectedly")
+    results[idx] = result
+  for _ in pushWorkers:
+    pushQueue.put(None)
+  for worker in pushWorkers + buildWorkers:
+    worker.join()
+
+  elapsed = time.time() - startTime
+  stageSeconds = sum((r["build_seconds"] or 0) + (r["push_seconds"] or 0)
+    for r in results
+  )
+  for result in results:
+    if result["error"] is not None:
+      print(red("`{}`: {}".format(result["docker_image_name"],
+        result["error"]
+      )))
+    else:
+      print(blue(
+        "`{}`: built in {:.1f}s, waited {:.1f}s, pushed in {:.1f}s".format(
+          construct_tagged_docker_image_name(result["docker_image_name"],
+            result["docker_image_tag"]
+          ),
+          result["build_seconds"], result["queued_seconds"],
+          result["push_seconds"]
+        )
+      ))
+  print(blue(
+    "Released {} of {} images in {:.1f}s ({:.1f}s of builds and pushes)".format(
+      sum(1 for r in results if r["error"] is None), len(results), elapsed,
+      stageSeconds
+    )
+  ))
+  return results
+
 @task
+@traced
 def pull_docker_image_from_registry(dockerImageName,
-    dockerImageTag="latest"):
+    dockerImageTag="latest", timeout=None):
   """Pulls a tagged Docker image from the Docker registry.
 
   Rationale: While a `docker run` command for a missing image will pull the
@@ -338,6 +916,11 @@ def pull_docker_image_from_registry(dockerImageName,
 
     dockerImageTag(str, optional): Tag of the Docker image to pull, defaults to
       the string `latest`
+
+    timeout(float, optional): Number of seconds after which each `docker pull`
+      times out, quarantining the host (see `viki.fabric.deadlines`). Defaults
+      to the configured command timeout and the deadline of the running task,
+      if any
   """
   dockerTaggedImageName = construct_tagged_docker_image_name(dockerImageName,
     dockerImageTag
@@ -353,11 +936,342 @@ def pull_docker_image_from_registry(dockerImageName,
      " (http://index.docker.io) ...").format(dockerTaggedImageName)
   ))
   with settings(warn_only=True):
-    dockerPullSucceeded = run(dockerPullCmd).succeeded
+    dockerPullSucceeded = run(dockerPullCmd, timeout=timeout).succeeded
   if not dockerPullSucceeded:
     print(yellow(
       "The previous `docker pull` failed most probably due to a lack of"
       " credentials. Running `docker login` followed by `docker pull`..."
     ))
     run("docker login")
-    run(dockerPullCmd)
+    run(dockerPullCmd, timeout=timeout)
+
+# Name of the pull-through cache registry container started by
+# `start_registry_mirror`
+_REGISTRY_MIRROR_CONTAINER_NAME = "viki-registry-mirror"
+
+# Defaults for the pull-through cache registry: the port it is published on,
+# the registry it caches, and the directory of the host holding the cache
+_DEFAULT_REGISTRY_MIRROR_PORT = 5000
+_DEFAULT_REGISTRY_MIRROR_REMOTE_URL = "https://registry-1.docker.io"
+_DEFAULT_REGISTRY_MIRROR_DATA_DIR = "/var/lib/viki-registry-mirror"
+
+# Address of the debug server of the registry inside its container; it serves
+# the proxy hit and miss counters under `/debug/vars`
+_REGISTRY_MIRROR_DEBUG_ADDR = "localhost:5001"
+
+# Path of the configuration file of the Docker daemon
+_DOCKER_DAEMON_CONFIG_PATH = "/etc/docker/daemon.json"
+
+@task
+@traced
+def start_registry_mirror(port=_DEFAULT_REGISTRY_MIRROR_PORT,
+    remoteUrl=_DEFAULT_REGISTRY_MIRROR_REMOTE_URL,
+    dataDir=_DEFAULT_REGISTRY_MIRROR_DATA_DIR):
+  """Starts a pull-through cache registry (a `registry:2` container) on the
+  server, unless it is already running. Point the Docker daemons of the other
+  hosts at it using the `use_registry_mirror` Fabric task, so that they pull
+  images over the LAN, from the registry which only pulls each image once from
+  `remoteUrl`.
+
+  Args:
+    port(int, optional): Port of the server the registry is published on.
+      Defaults to 5000
+
+    remoteUrl(str, optional): URL of the registry to cache. Defaults to the
+      Docker Hub registry (https://registry-1.docker.io)
+
+    dataDir(str, optional): Directory of the server holding the cached images.
+      Defaults to `/var/lib/viki-registry-mirror`
+
+  Returns:
+    str: URL of the registry mirror, such as `http://hostOne:5000`
+  """
+  with settings(hide("everything"), warn_only=True):
+    state = run(
+      "docker inspect -f '{{{{.State.Running}}}}' {} 2>/dev/null".format(
+        _REGISTRY_MIRROR_CONTAINER_NAME
+      )
+    ).strip()
+  if state == "true":
+    print(blue("The registry mirror is already running on `{}`".format(
+      env.host
+    )))
+  elif state == "false":
+    print(blue("Restarting the registry mirror on `{}`...".format(env.host)))
+    run("docker start {}".format(_REGISTRY_MIRROR_CONTAINER_NAME))
+  else:
+    print(blue("Starting the registry mirror of `{}` on `{}`...".format(
+      remoteUrl, env.host
+    )))
+    run(
+      ("docker run -d --restart=always --name {} -p {}:5000"
+       " -v {}:/var/lib/registry -e REGISTRY_PROXY_REMOTEURL={}"
+       " -e REGISTRY_HTTP_DEBUG_ADDR={} registry:2").format(
+        _REGISTRY_MIRROR_CONTAINER_NAME, port, pipes.quote(dataDir),
+        pipes.quote(remoteUrl), _REGISTRY_MIRROR_DEBUG_ADDR
+      )
+    )
+  return "http://{}:{}".format(env.host, port)
+
+@task
+@traced
+def use_registry_mirror(mirrorUrls=None):
+  """Points the Docker daemon of the server at registry mirrors, by setting the
+  `registry-mirrors` key of `/etc/docker/daemon.json` (other keys are kept).
+  The Docker daemon is only restarted if the file changed.
+
+  Args:
+    mirrorUrls(list of str, optional): URLs of the registry mirrors, or a
+      comma separated string of them (as given on the command line). Defaults
+      to the `registry_mirrors` key of the `viki.fabric.docker` dict in
+      `viki_fabric_config.yml`
+
+  Returns:
+    bool: `True` if the Docker daemon was reconfigured, `False` if it already
+      used the registry mirrors
+
+  >>> use_registry_mirror(["http://hostOne:5000"])
+  True
+  """
+  if mirrorUrls is None:
+    mirrorUrls = get_module_config("viki.fabric.docker", "registry_mirrors",
+      None
+    )
+  if not mirrorUrls:
+    raise ValueError(
+      "No registry mirrors given; supply the `mirrorUrls` parameter or the"
+      " `registry_mirrors` key of the `viki.fabric.docker` dict in"
+      " `viki_fabric_config.yml`"
+    )
+  if isinstance(mirrorUrls, basestring):
+    mirrorUrls = [url.strip() for url in mirrorUrls.split(",") if url.strip()]
+  # the script delimits the contents of the file from any other output
+  script = RemoteScript()
+  script.add_step("read", "cat {}".format(_DOCKER_DAEMON_CONFIG_PATH),
+    condition="[ -f {} ]".format(_DOCKER_DAEMON_CONFIG_PATH)
+  )
+  readResult = script.run(useSudo=True)["steps"]["read"]
+  currentConfig = "\n".join(readResult["output"])
+  daemonConfig = {}
+  if readResult["return_code"] == 0 and currentConfig.strip():
+    try:
+      daemonConfig = json.loads(currentConfig)
+    except ValueError:
+      raise RuntimeError("`{}` on `{}` is not valid JSON".format(
+        _DOCKER_DAEMON_CONFIG_PATH, env.host
+      ))
+  if daemonConfig.get("registry-mirrors") == list(mirrorUrls):
+    print(blue("The Docker daemon on `{}` already uses {}".format(env.host,
+      ", ".join(mirrorUrls)
+    )))
+    return False
+  daemonConfig["registry-mirrors"] = list(mirrorUrls)
+  print(blue("Pointing the Docker daemon on `{}` at {}...".format(env.host,
+    ", ".join(mirrorUrls)
+  )))
+  with settings(hide("running")):
+    sudo("mkdir -p {} && printf '%s\\n' {} > {}".format(
+      os.path.dirname(_DOCKER_DAEMON_CONFIG_PATH),
+      pipes.quote(json.dumps(daemonConfig, indent=2, sort_keys=True,
+        separators=(",", ": ")
+      )),
+      _DOCKER_DAEMON_CONFIG_PATH
+    ))
+  sudo("systemctl restart docker || service docker restart")
+  return True
+
+def _get_registry_mirror_repository(dockerImageName):
+  """Returns the repository and tag of a Docker Hub image in the registry
+  mirror (`ubuntu` is `library/ubuntu:latest`), or `None` for images of other
+  registries.
+  """
+  (repository, _, tag) = dockerImageName.partition(":")
+  if "/" in tag:
+    # the colon separated the port of a registry host
+    return None
+  firstComponent = repository.split("/")[0]
+  if "/" in repository and ("." in firstComponent or firstComponent ==
+      "localhost"):
+    return None
+  if "/" not in repository:
+    repository = "library/{}".format(repository)
+  return "{}:{}".format(repository, tag or "latest")
+
+@task
+@traced
+def warm_registry_mirror(dockerImageNames,
+    port=_DEFAULT_REGISTRY_MIRROR_PORT):
+  """Pulls Docker images through the registry mirror running on the server
+  (see `start_registry_mirror`), so that it caches them before the hosts using
+  it pull them, such as before a deploy. The images are pulled in a single
+  remote command, and removed from the Docker daemon of the server afterwards.
+
+  Args:
+    dockerImageNames(list of str): Docker Hub images in `namespace/image:tag`
+      format, or a comma separated string of them (as given on the command
+      line). Images of other registries are skipped
+
+    port(int, optional): Port of the server the registry mirror is published
+      on. Defaults to 5000
+
+  Returns:
+    dict: A dict whose keys are the image names and whose values are `True` if
+      the image is cached by the registry mirror, `False` otherwise
+
+  >>> warm_registry_mirror(["viki/api:master-18f450dc8c4b", "redis:3.0"])
+  {"viki/api:master-18f450dc8c4b": True, "redis:3.0": True}
+  """
+  if isinstance(dockerImageNames, basestring):
+    dockerImageNames = [name.strip() for name in dockerImageNames.split(",")
+      if name.strip()]
+  warmed = {}
+  script = RemoteScript()
+  for dockerImageName in dockerImageNames:
+    repository = _get_registry_mirror_repository(dockerImageName)
+    if repository is None:
+      print(yellow(
+        "Skipping `{}`, which is not an image of the mirrored registry".format(
+          dockerImageName
+        )
+      ))
+      warmed[dockerImageName] = False
+      continue
+    mirrorImageName = pipes.quote("localhost:{}/{}".format(port, repository))
+    script.add_step(dockerImageName,
+      "docker pull {0} && docker rmi {0}".format(mirrorImageName),
+      stopOnFailure=False
+    )
+  print(blue("Warming the registry mirror on `{}`...".format(env.host)))
+  for (dockerImageName, stepResult) in script.run()["steps"].items():
+    warmed[dockerImageName] = stepResult["return_code"] == 0
+    if not warmed[dockerImageName]:
+      print(yellow(
+        "Could not pull `{}` through the registry mirror:\n{}".format(
+          dockerImageName, "\n".join(stepResult["output"][-5:])
+        )
+      ))
+  return warmed
+
+@task
+@traced
+def get_registry_mirror_stats():
+  """Obtains the number of requests, hits and misses of the registry mirror
+  running on the server (see `start_registry_mirror`), for image layers
+  (blobs) and manifests, since the registry container started.
+
+  Returns:
+    dict: with the keys `blobs` and `manifests`, each a dict with the keys
+      `requests`, `hits`, `misses`, `bytes_pulled` (from the mirrored
+      registry) and `bytes_pushed` (to the Docker daemons), and `hit_ratio`,
+      the ratio of blob requests which were hits (`None` if there were none)
+
+  >>> get_registry_mirror_stats()
+  {"blobs": {"requests": 120, "hits": 108, "misses": 12, ...},
+   "manifests": {...}, "hit_ratio": 0.9}
+  """
+  script = RemoteScript()
+  script.add_step("vars",
+    "docker exec {} wget -qO- http://{}/debug/vars".format(
+      _REGISTRY_MIRROR_CONTAINER_NAME, _REGISTRY_MIRROR_DEBUG_ADDR
+    )
+  )
+  result = script.run()
+  if not result["succeeded"]:
+    raise RuntimeError(
+      "Could not obtain the statistics of the registry mirror on `{}`".format(
+        env.host
+      )
+    )
+  debugVars = json.loads("\n".join(result["steps"]["vars"]["output"]))
+  proxyVars = debugVars.get("registry", {}).get("proxy", {})
+  stats = {}
+  for kind in ("blobs", "manifests"):
+    kindVars = proxyVars.get(kind, {})
+    stats[kind] = dict(
+      (key, kindVars.get(varName, 0)) for (key, varName) in (
+        ("requests", "Requests"), ("hits", "Hits"), ("misses", "Misses"),
+        ("bytes_pulled", "BytesPulled"), ("bytes_pushed", "BytesPushed")
+      )
+    )
+  blobRequests = stats["blobs"]["requests"]
+  stats["hit_ratio"] = float(stats["blobs"]["hits"]) / blobRequests \
+    if blobRequests else None
+  print(blue(
+    "Registry mirror on `{}`: {} of {} layer requests were hits{}".format(
+      env.host, stats["blobs"]["hits"], blobRequests,
+      " ({:.0%})".format(stats["hit_ratio"]) if blobRequests else ""
+    )
+  ))
+  return stats
+
+@runs_once
+@task
+@traced
+def setup_registry_mirrors(mirrorHosts, clientHosts=None,
+    dockerImageNames=None, port=_DEFAULT_REGISTRY_MIRROR_PORT):
+  """A Fabric task which starts registry mirrors on designated hosts, warms
+  them with the Docker images needed for a deploy, and points the Docker
+  daemons of the other hosts at them; it runs the `start_registry_mirror`,
+  `warm_registry_mirror` and `use_registry_mirror` Fabric tasks.
+
+  **NOTE:** This Fabric task is only run once regardless of the number of
+  hosts/roles you supply.
+
+  Each host is given the `task_timeout` deadline of the
+  `viki.fabric.deadlines` config, if any; mirror hosts which time out are left
+  out of the returned URLs.
+
+  Args:
+    mirrorHosts(list of str): Hosts running the registry mirrors, or a comma
+      separated string of them (as given on the command line)
+
+    clientHosts(list of str, optional): Hosts to point at the registry
+      mirrors, or a comma separated string of them. Defaults to the hosts of
+      the current run, other than `mirrorHosts`
+
+    dockerImageNames(list of str, optional): Docker images to warm the
+      registry mirrors with, or a comma separated string of them
+
+    port(int, optional): Port the registry mirrors are published on. Defaults
+      to 5000
+
+  Returns:
+    list of str: URLs of the registry mirrors
+
+  >>> setup_registry_mirrors(["hostOne"], ["hostTwo", "hostThree"],
+        ["viki/api:master-18f450dc8c4b"]
+      )
+  ["http://hostOne:5000"]
+  """
+  # arguments given on the command line are strings
+  if isinstance(mirrorHosts, basestring):
+    mirrorHosts = [h.strip() for h in mirrorHosts.split(",") if h.strip()]
+  if isinstance(clientHosts, basestring):
+    clientHosts = [h.strip() for h in clientHosts.split(",") if h.strip()]
+  if isinstance(dockerImageNames, basestring):
+    dockerImageNames = [name.strip() for name in dockerImageNames.split(",")
+      if name.strip()]
+  if clientHosts is None:
+    clientHosts = [h for h in env.hosts if h not in mirrorHosts]
+  # hosts which time out are quarantined and left out (see
+  # `viki.fabric.deadlines`)
+  mirrorResults = execute(with_deadline()(start_registry_mirror.wrapped),
+    port=port, hosts=mirrorHosts
+  )
+  startedMirrorHosts = sorted(h for (h, url) in mirrorResults.items()
+    if url is not None
+  )
+  if not startedMirrorHosts:
+    raise RuntimeError("None of the registry mirrors could be started on {}"
+      .format(mirrorHosts)
+    )
+  mirrorUrls = sorted(mirrorResults[h] for h in startedMirrorHosts)
+  if dockerImageNames:
+    execute(with_deadline()(warm_registry_mirror.wrapped), dockerImageNames,
+      port=port, hosts=startedMirrorHosts
+    )
+  if clientHosts:
+    execute(with_deadline()(use_registry_mirror.wrapped), mirrorUrls,
+      hosts=clientHosts
+    )
+  return mirrorUrls
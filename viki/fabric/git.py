@@ -1,19 +1,42 @@
 import functools
 import os.path
-import yaml
+import pipes
 
 import viki.fabric.helpers as fabric_helpers
 
-from fabric.api import env, run, task
-from fabric.colors import red
+from fabric.api import env, task
+from fabric.colors import blue, red, yellow
 from fabric.context_managers import hide, settings
-from fabric.contrib.files import exists, upload_template
-from fabric.operations import local
-from viki.fabric import VIKI_FABRIC_CONFIG_KEY_NAME
-from viki.fabric.helpers import env_has_nested_keys, get_in_viki_fabric_config
-
-# Whether the `_initialize` function has been called
-_INITIALIZED = False
+from viki.fabric.config import validate_config
+from viki.fabric.helpers import get_in_viki_fabric_config
+from viki.fabric.memo import converged
+from viki.fabric.operations import local, read_only, run
+from viki.fabric.script import RemoteScript, quote_path
+from viki.fabric.statcache import remote_path_exists
+from viki.fabric.tracing import traced
+from viki.fabric.transfer import put_file, upload_template_file
+
+# Sentinel for `_INITIALIZED_HOST_STRING` before `_initialize` is first called
+_NOT_INITIALIZED = object()
+
+# Host string for which the `_initialize` function last assigned the global
+# variables below
+_INITIALIZED_HOST_STRING = _NOT_INITIALIZED
+
+# Validated `viki.fabric.git` configs, keyed by host string; the config of a
+# host is only validated once
+_VALIDATED_CONFIGS = {}
+
+# Schema of the `viki.fabric.git` config; refer to the `validate_config`
+# function in `viki.fabric.config`
+_CONFIG_SCHEMA = {
+  "ssh_private_key": basestring,
+  "ssh_public_key": basestring,
+  "ssh_keys_local_copy_dir": basestring,
+  "ssh_keys_dir": basestring,
+  "git_ssh_script_name": basestring,
+  "git_ssh_script_local_folder": basestring,
+}
 
 # Name of the ssh private key that allows us to clone private analytics Github
 # repositories
@@ -47,33 +70,31 @@ _GIT_SSH_SCRIPT_NAME = None
 def _initialize():
   """Initializes some global variables in this module with those read from the
   `viki_fabric_config.yml` file (and subsequently stored into
-  `env.viki_fabric_config["viki.fabric.git"]`).
+  `env.viki_fabric_config["viki.fabric.git"]`), resolved for the current host
+  (`env.host_string`) since the config can be overridden per role and host.
   """
-  global _INITIALIZED
-  if _INITIALIZED:
+  global _INITIALIZED_HOST_STRING
+  hostString = env.host_string
+  if _INITIALIZED_HOST_STRING is not _NOT_INITIALIZED and \
+      _INITIALIZED_HOST_STRING == hostString:
     return
 
-  if not env_has_nested_keys([VIKI_FABRIC_CONFIG_KEY_NAME, "viki.fabric.git"]):
-    raise RuntimeError(
-      "For modules importing the `viki.fabric.git` module (directly or"
-      " indirectly), a `viki_fabric_config.yml` containing a `viki.fabric.git`"
-      " key (whose value is a dict) is required at the directory where the main"
-      " Python script is run.\n"
-      "For more information, consult the documentation at"
-      " http://viki-fabric-helpers.readthedocs.org/en/latest/viki-fabric-git.html"
-    )
-
-  # Keys we expect to be in env[VIKI_FABRIC_CONFIG_KEY_NAME]["viki.fabric.git"]
-  expectedKeys = ["ssh_private_key", "ssh_public_key",
-    "ssh_keys_local_copy_dir", "ssh_keys_dir", "git_ssh_script_name",
-    "git_ssh_script_local_folder"
-  ]
-  # obtain env[VIKI_FABRIC_CONFIG_KEY_NAME]["viki.fabric.git"]
-  vikiFabricGitConfig = get_in_viki_fabric_config(["viki.fabric.git"])
-  assert(isinstance(vikiFabricGitConfig, dict))
-  # check that the `expectedKeys` exist
-  for k in expectedKeys:
-    assert(k in vikiFabricGitConfig)
+  if hostString not in _VALIDATED_CONFIGS:
+    # obtain env[VIKI_FABRIC_CONFIG_KEY_NAME]["viki.fabric.git"], resolved for
+    # the current host
+    vikiFabricGitConfig = get_in_viki_fabric_config(["viki.fabric.git"])
+    if vikiFabricGitConfig is None:
+      raise RuntimeError(
+        "For modules importing the `viki.fabric.git` module (directly or"
+        " indirectly), a `viki_fabric_config.yml` containing a"
+        " `viki.fabric.git` key (whose value is a dict) is required at the"
+        " directory where the main Python script is run.\n"
+        "For more information, consult the documentation at"
+        " http://viki-fabric-helpers.readthedocs.org/en/latest/viki-fabric-git.html"
+      )
+    validate_config(vikiFabricGitConfig, _CONFIG_SCHEMA, "viki.fabric.git")
+    _VALIDATED_CONFIGS[hostString] = vikiFabricGitConfig
+  vikiFabricGitConfig = _VALIDATED_CONFIGS[hostString]
 
   # assign them to global variables for convenience
   global _SSH_PRIVATE_KEY, _SSH_PUBLIC_KEY, _SSH_KEYS_LOCAL_COPY_DIR, \
@@ -86,7 +107,7 @@ def _initialize():
   _GIT_SSH_SCRIPT_LOCAL_FOLDER = \
     vikiFabricGitConfig["git_ssh_script_local_folder"]
 
-  _INITIALIZED = True
+  _INITIALIZED_HOST_STRING = hostString
 
 def _check_initialized(f):
   """A decorator which checks that the `_initialize` function has been called;
@@ -99,6 +120,7 @@ def _check_initialized(f):
   return wrapper
 
 # Determines if a directory is under git control
+@traced
 def is_dir_under_git_control(dirName):
   """Determines if a directory on a server is under Git control.
 
@@ -114,14 +136,35 @@ def is_dir_under_git_control(dirName):
   True
   """
   gitRevParseCmd = "cd {} && git rev-parse --git-dir".format(dirName)
-  with settings(hide("warnings", "stdout", "stderr"), warn_only=True):
+  with settings(hide("warnings", "stdout", "stderr"), read_only(),
+      warn_only=True):
     return run(gitRevParseCmd).succeeded
 
+def _get_memo_state_command():
+  """Returns the state command of the `setup_server_for_git_clone` task for
+  the current host (see `viki.fabric.memo.converged`), or `None` if the
+  `viki.fabric.git` module is not configured for it.
+  """
+  try:
+    _initialize()
+  except RuntimeError:
+    return None
+  return "cd && cksum {} {} {}".format(
+    pipes.quote(os.path.join(_SSH_KEYS_DIR, _SSH_PUBLIC_KEY)),
+    pipes.quote(os.path.join(_SSH_KEYS_DIR, _SSH_PRIVATE_KEY)),
+    pipes.quote(_GIT_SSH_SCRIPT_NAME)
+  )
+
 @task
 @_check_initialized
+@traced
+@converged(_get_memo_state_command)
 def setup_server_for_git_clone(homeDir=None):
   """Fabric task that sets up the ssh keys and a wrapper script for GIT_SSH
-  to allow cloning of private Github repositories.
+  to allow cloning of private Github repositories. The server is checked for
+  the files in a single remote command, and only the missing files are copied.
+  The task is skipped on hosts where it has already converged (see
+  `viki.fabric.memo`).
 
   Args:
     homeDir(str, optional): home directory for the server. If not supplied or if
@@ -155,26 +198,46 @@ def setup_server_for_git_clone(homeDir=None):
   serverPrivateKeyPath = os.path.join(homeDir, _SSH_KEYS_DIR, _SSH_PRIVATE_KEY)
   localPublicKey = os.path.join(_SSH_KEYS_LOCAL_COPY_DIR, _SSH_PUBLIC_KEY)
   localPrivateKey = os.path.join(_SSH_KEYS_LOCAL_COPY_DIR, _SSH_PRIVATE_KEY)
-  fabric_helpers.copy_file_to_server_if_not_exists(localPublicKey,
-    serverPublicKeyPath
-  )
-  fabric_helpers.copy_file_to_server_if_not_exists(localPrivateKey,
-    serverPrivateKeyPath
-  )
+  gitSSHWrapperPath = get_git_ssh_script_path(homeDir)
+  # check for all the files in a single remote command, then only transfer
+  # those which are missing
+  script = RemoteScript()
+  for serverPath in (serverPublicKeyPath, serverPrivateKeyPath,
+      gitSSHWrapperPath):
+    script.add_step(serverPath, "[ -e {} ]".format(quote_path(serverPath)),
+      stopOnFailure=False
+    )
+  with read_only():
+    checks = script.run()["steps"]
+  for (localPath, serverPath) in ((localPublicKey, serverPublicKeyPath),
+      (localPrivateKey, serverPrivateKeyPath)):
+    if checks[serverPath]["return_code"] == 0:
+      print(blue("`{}` exists on `{}`".format(serverPath, serverName)))
+      continue
+    print(yellow("`{}` does not exist on `{}`.".format(serverPath, serverName)))
+    print(yellow("Copying local `{}` to `{}` on `{}`...".format(
+      localPath, serverPath, serverName
+    )))
+    put_file(localPath, serverPath, mirrorLocalMode=True)
   # Copy gitwrap.sh, which is a wrapper that forces `git clone` to make use of
   # the ssh private key we just copied
-  gitSSHWrapperPath = get_git_ssh_script_path(homeDir)
-  if not exists(gitSSHWrapperPath):
-    upload_template(_GIT_SSH_SCRIPT_NAME, gitSSHWrapperPath, use_jinja=True,
-      template_dir=_GIT_SSH_SCRIPT_LOCAL_FOLDER, mode=0755,
+  if checks[gitSSHWrapperPath]["return_code"] != 0:
+    upload_template_file(_GIT_SSH_SCRIPT_NAME, gitSSHWrapperPath,
+      useJinja=True, templateDir=_GIT_SSH_SCRIPT_LOCAL_FOLDER, mode=0755,
       context={ 'ssh_private_key_path': serverPrivateKeyPath }
     )
+  import viki.fabric.inventory as viki_inventory
+  viki_inventory.set_facts({ "setup_server_for_git_clone_run": True })
 
+@traced
 def is_fabtask_setup_server_for_git_clone_run(homeDir=None, printWarnings=True):
   """Determines if the `setup_server_for_git_clone` Fabric task has been run.
 
   This task checks for the existence of some files on the server to determine
-  whether the `setup_server_for_git_clone` task has been run.
+  whether the `setup_server_for_git_clone` task has been run, using the stat
+  cache of the server (see `viki.fabric.statcache`). If `homeDir` is
+  not supplied and the `setup_server_for_git_clone_run` fact in the inventory
+  (see `viki.fabric.inventory`) is fresh enough, the fact is used instead.
 
   Args:
     homeDir(str, optional): home directory for the server. If not supplied or if
@@ -192,24 +255,33 @@ def is_fabtask_setup_server_for_git_clone_run(homeDir=None, printWarnings=True):
   """
   serverName = env.host
   if homeDir is None:
+    import viki.fabric.inventory as viki_inventory
+    taskHasRun = viki_inventory.get_fact("setup_server_for_git_clone_run")
+    if taskHasRun is not None:
+      if (not taskHasRun) and printWarnings:
+        print(red((
+          'Please run the `setup_server_for_git_clone` fabric task for `{}` '
+          'and try again.'
+        ).format(serverName)))
+      return taskHasRun
     homeDir = fabric_helpers.get_home_dir()
   gitsshWrapper = get_git_ssh_script_path(homeDir)
   taskHasRun = True
-  if not exists(gitsshWrapper):
+  if not remote_path_exists(gitsshWrapper):
     taskHasRun = False
     if printWarnings:
       print(red('`{}` does not exist on `{}`'.format(
         gitsshWrapper, serverName
       )))
   sshPublicKeyPath = _get_ssh_public_key_path(homeDir)
-  if not exists(sshPublicKeyPath):
+  if not remote_path_exists(sshPublicKeyPath):
     taskHasRun = False
     if printWarnings:
       print(red('`{}` does not exist on `{}`'.format(sshPublicKeyPath,
         serverName
       )))
   sshPrivateKeyPath = _get_ssh_private_key_path(homeDir)
-  if not exists(sshPrivateKeyPath):
+  if not remote_path_exists(sshPrivateKeyPath):
     taskhasRun = False
     if printWarnings:
       print(red('`{}` does not exist on `{}`'.format(sshPrivateKeyPath,
@@ -223,6 +295,7 @@ def is_fabtask_setup_server_for_git_clone_run(homeDir=None, printWarnings=True):
   return taskHasRun
 
 @_check_initialized
+@traced
 def get_git_ssh_script_path(homeDir=None):
   """Returns the path to the git ssh script
 
@@ -273,6 +346,7 @@ def _get_ssh_private_key_path(homeDir=None):
     homeDir = fabric_helpers.get_home_dir()
   return os.path.join(homeDir, _SSH_KEYS_DIR, _SSH_PRIVATE_KEY)
 
+@traced
 def local_git_branch_exists(branch):
   """Determines if a branch exists in the current git repository on your local
   machine.
@@ -295,3 +369,168 @@ def local_git_branch_exists(branch):
     return local("git show-ref --verify --quiet refs/heads/{}".format(
       branch
     )).succeeded
+
+class LocalGitRefIndex(object):
+  """An in-memory index of the refs, remotes and upstream branches of the git
+  repository on your local machine.
+
+  The index is loaded using one `git for-each-ref` and one
+  `git config --get-regexp` command, after which lookups do not spawn any
+  process. Changes to remotes and upstream branches are applied in batches (one
+  shell command per batch) and are reflected in the index.
+
+  **NOTE:** The current working directory (or the `fabric.context_managers.lcd`
+  directory) is assumed to be inside the git repository of interest.
+
+  >>> refIndex = LocalGitRefIndex()
+  >>> refIndex.branch_exists("master")
+  True
+  >>> refIndex.set_remotes({"origin": "git@github.com:viki-org/repo.git"})
+  >>> refIndex.set_upstream_branches({"master": "origin/master"})
+  """
+
+  def __init__(self):
+    self.reload()
+
+  def reload(self):
+    """(Re)loads the index from the git repository. This should be called
+    after running git commands which create refs outside of this class, such
+    as `git fetch`.
+    """
+    refs = local("git for-each-ref --format='%(refname)'", capture=True)
+    self._refs = set(line.strip() for line in refs.splitlines() if line.strip())
+    # `git config --get-regexp` exits with 1 when nothing matches
+    with settings(warn_only=True):
+      configLines = local("git config --get-regexp '^(remote|branch)\\.'",
+        capture=True
+      )
+    # {remote name: {variable: value}}
+    self._remotes = {}
+    # {branch name: {variable: value}}
+    self._branches = {}
+    for line in configLines.splitlines():
+      (key, _, value) = line.strip().partition(" ")
+      (section, _, rest) = key.partition(".")
+      # remote and branch names may contain dots, variable names do not
+      (name, _, variable) = rest.rpartition(".")
+      if not name:
+        continue
+      if section == "remote":
+        self._remotes.setdefault(name, {})[variable] = value
+      else:
+        self._branches.setdefault(name, {})[variable] = value
+
+  def has_ref(self, ref):
+    """Determines if a fully qualified ref (such as `refs/heads/master`)
+    exists.
+    """
+    return ref in self._refs
+
+  def branch_exists(self, branch):
+    """Determines if a local branch exists. This is the equivalent of the
+    `local_git_branch_exists` function.
+    """
+    return self.has_ref("refs/heads/{}".format(branch))
+
+  def get_remote_url(self, remote):
+    """Returns the url of a git remote, or `None` if the remote does not exist.
+    """
+    return self._remotes.get(remote, {}).get("url")
+
+  def get_upstream_branch(self, branch):
+    """Returns the upstream branch of a local branch in `remote/branch` format,
+    or `None` if it has no upstream branch.
+    """
+    branchConfig = self._branches.get(branch, {})
+    if "remote" not in branchConfig or "merge" not in branchConfig:
+      return None
+    return "{}/{}".format(branchConfig["remote"],
+      branchConfig["merge"][len("refs/heads/"):]
+    )
+
+  def _run_batch(self, cmds, warnOnly=False):
+    """Runs a list of git commands as a single shell command. If `warnOnly` is
+    `True`, every command is run even if an earlier one fails, and failures
+    only print a warning; the index is then reloaded, as the changes it
+    recorded for the failed commands did not happen.
+    """
+    if not cmds:
+      return
+    if warnOnly:
+      # the shell command fails if any of the git commands failed
+      shellCommand = "rc=0; {}; exit $rc".format(
+        "; ".join("{} || rc=1".format(cmd) for cmd in cmds)
+      )
+    else:
+      shellCommand = " && ".join(cmds)
+    with settings(warn_only=warnOnly):
+      result = local(shellCommand)
+    if result.failed:
+      self.reload()
+
+  def set_remotes(self, gitRemotes):
+    """Adds git remotes to the repository, replacing any existing remote of the
+    same name like `git remote rm` followed by `git remote add` would: its
+    fetch refspec is reset and its remote tracking branches are deleted.
+    Remotes which already have the given url are left untouched. All changes
+    are made using a single shell command.
+
+    Args:
+      gitRemotes(dict): A dict where keys are git remote names and values are
+        git remote urls
+    """
+    cmds = []
+    staleRefs = []
+    for (remoteName, remoteUrl) in gitRemotes.items():
+      if self.get_remote_url(remoteName) == remoteUrl:
+        continue
+      remoteFetch = "+refs/heads/*:refs/remotes/{}/*".format(remoteName)
+      cmds.append("git config remote.{}.url {}".format(pipes.quote(remoteName),
+        pipes.quote(remoteUrl)
+      ))
+      cmds.append("git config --replace-all remote.{}.fetch {}".format(
+        pipes.quote(remoteName), pipes.quote(remoteFetch)
+      ))
+      refPrefix = "refs/remotes/{}/".format(remoteName)
+      staleRefs.extend(ref for ref in self._refs if ref.startswith(refPrefix))
+      self._remotes[remoteName] = { "fetch": remoteFetch, "url": remoteUrl }
+    if staleRefs:
+      cmds.append("printf 'delete %s\\n' {} |"
+        " git update-ref --no-deref --stdin".format(
+        " ".join(pipes.quote(ref) for ref in sorted(staleRefs))
+      ))
+      self._refs.difference_update(staleRefs)
+    self._run_batch(cmds, warnOnly=True)
+
+  def set_upstream_branches(self, gitSetUpstream):
+    """Sets the upstream branch (remote tracking branch) for the given local
+    branches, creating local branches which do not exist from their upstream
+    branch. All changes are made using a single shell command. A branch whose
+    upstream branch does not exist is left as it is, with a warning.
+
+    **NOTE:** Any remotes involved are assumed to have been fetched, and the
+    index reloaded after the fetch.
+
+    Args:
+      gitSetUpstream(dict): A dict where keys are local branch names and values
+        are git remote branch names in `remote/branch` format
+    """
+    cmds = []
+    for (localBranchName, upstreamBranchName) in gitSetUpstream.items():
+      if self.get_upstream_branch(localBranchName) == upstreamBranchName:
+        continue
+      if self.branch_exists(localBranchName):
+        cmds.append("git branch --set-upstream-to={} {}".format(
+          upstreamBranchName, localBranchName
+        ))
+      else:
+        cmds.append("git branch --track {} {}".format(localBranchName,
+          upstreamBranchName
+        ))
+        self._refs.add("refs/heads/{}".format(localBranchName))
+      (remoteName, _, remoteBranchName) = upstreamBranchName.partition("/")
+      self._branches[localBranchName] = {
+        "remote": remoteName,
+        "merge": "refs/heads/{}".format(remoteBranchName),
+      }
+    self._run_batch(cmds, warnOnly=True)
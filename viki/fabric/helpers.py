@@ -1,17 +1,35 @@
-from fabric.api import env, run
+from fabric.api import env
 from fabric.colors import blue, red, yellow
-from fabric.context_managers import cd, hide, settings
-from fabric.contrib.files import exists
-from fabric.operations import get, put, sudo
+from fabric.context_managers import hide, settings
+from fabric.decorators import parallel, task
+from fabric.tasks import execute
 from fabric.utils import abort
 
 from viki.fabric import VIKI_FABRIC_CONFIG_KEY_NAME
-
+from viki.fabric.agent import get_agent
+from viki.fabric.backends import get_backend, is_local_target
+from viki.fabric.config import get_config_index
+from viki.fabric.deadlines import with_deadline
+from viki.fabric.memo import converged
+from viki.fabric.operations import read_only, run, sudo
+from viki.fabric.output import capture_output
+from viki.fabric.script import RemoteScript, quote_path
+from viki.fabric.statcache import remote_path_exists, remote_path_is_dir
+from viki.fabric.tracing import traced
+from viki.fabric.transfer import get_file, put_file
+
+import base64
+import collections
+import hashlib
+import json
 import os
 import os.path
-import StringIO
+import pipes
+import re
+import shutil
 import tempfile
 
+@traced
 def run_and_get_stdout(cmdString, hostString=None, useSudo=False):
   """Runs a command and grabs its output from standard output, without all the
   Fabric associated stuff and other crap (hopefully).
@@ -34,11 +52,17 @@ def run_and_get_stdout(cmdString, hostString=None, useSudo=False):
   return run_and_get_output(cmdString, hostString=hostString, useSudo=useSudo,
     captureStdout=True, captureStderr=False)["stdout"]
 
+@traced
 def run_and_get_output(cmdString, hostString=None, useSudo=False,
-      captureStdout=True, captureStderr=True):
+      captureStdout=True, captureStderr=True, timeout=None):
   """Runs a command and grabs its stdout and stderr, without all the Fabric
     associated stuff and other crap (hopefully).
 
+  The output is written to the log files of the host (see
+  `viki.fabric.output`) as it arrives, and read back from them. Commands run
+  without `sudo` go through the agent of the host if it has one (see
+  `viki.fabric.agent`).
+
   Args:
     cmdString(str): Command to run
 
@@ -48,6 +72,11 @@ def run_and_get_output(cmdString, hostString=None, useSudo=False,
     useSudo(bool, optional): If `True`, `sudo` will be used instead of `run`
       to execute the command
 
+    timeout(float, optional): Number of seconds after which the command times
+      out, raising `fabric.exceptions.CommandTimeout` and quarantining the host
+      (see `viki.fabric.deadlines`). Defaults to the configured command timeout
+      and the deadline of the running task, if any
+
   Returns:
     dict: A Dict with 2 keys:
       "stdout": list(str) if captureStdout==True, `None` otherwise
@@ -58,50 +87,159 @@ def run_and_get_output(cmdString, hostString=None, useSudo=False,
   { "stdout": ["LICENSE", "README.md", "setup.py"], "stderr": [] }
   """
 
-  # takes a StringIO object
-  def _remove_fabric_prefix(sio, prefix):
+  # takes an iterable of lines
+  def _remove_fabric_prefix(lines, prefix):
     prefixLen = len(prefix)
-    linesList = sio.getvalue().split("\n")
     retList = []
-    for (idx, line) in enumerate(linesList):
-      if line == delimiterLine:
-        retList = linesList[idx+1:]
-        break
-    for (idx, line) in enumerate(retList):
-      if line.startswith(prefix):
-        retList[idx] = line[prefixLen:]
+    delimiterSeen = False
+    for line in lines:
+      if not delimiterSeen:
+        delimiterSeen = line in (delimiter, delimiterLine)
+      elif prefixLen and line.startswith(prefix):
+        retList.append(line[prefixLen:])
+      else:
+        retList.append(line)
     return retList
 
   if hostString is None:
     hostString = env.host_string
   devNull = open(os.devnull, "w")
   prefix = "[{}] out: ".format(hostString)
+  # The local execution backend writes output without Fabric's prefix
+  if not get_backend(hostString).prefixesOutput:
+    prefix = ""
   delimiter = "START OF run_and_get_stdout delimiter"
   delimiterLine = "{}{}".format(prefix, delimiter)
-  stdoutSIO = devNull
-  stderrSIO = devNull
-  if captureStdout:
-    stdoutSIO = StringIO.StringIO()
-  if captureStderr:
-    stderrSIO = StringIO.StringIO()
-  fabricRunOp = run
-  if useSudo:
-    fabricRunOp = sudo
-  with settings(hide("running", "status"), warn_only=True):
-    fabricRunOp("echo '{}' && {}".format(delimiter, cmdString),
-      stdout=stdoutSIO, stderr=stderrSIO
-    )
+  agent = None if useSudo else get_agent(hostString)
+  # the output goes to the log files of the host rather than being held in
+  # memory, and is streamed back from them
+  with capture_output(hostString) as (stdoutSink, stderrSink):
+    if agent is not None:
+      prefix = ""
+      with settings(host_string=hostString):
+        result = agent.run_command("echo '{}' && {}".format(delimiter,
+          cmdString), timeout=timeout
+        )
+      if captureStdout:
+        stdoutSink.write(result["stdout"])
+      if captureStderr:
+        stderrSink.write(result["stderr"])
+    else:
+      fabricRunOp = run
+      if useSudo:
+        fabricRunOp = sudo
+      with settings(hide("running", "status"), warn_only=True,
+          output_prefix=False):
+        fabricRunOp("echo '{}' && {}".format(delimiter, cmdString),
+          stdout=stdoutSink if captureStdout else devNull,
+          stderr=stderrSink if captureStderr else devNull, timeout=timeout
+        )
   devNull.close()
   retVal = { "stdout": None, "stderr": None }
   if captureStdout:
-    retVal["stdout"] = _remove_fabric_prefix(stdoutSIO, prefix)
+    retVal["stdout"] = _remove_fabric_prefix(stdoutSink.iter_lines(), prefix)
   if captureStderr:
-    retVal["stderr"] = _remove_fabric_prefix(stderrSIO, prefix)
+    retVal["stderr"] = _remove_fabric_prefix(stderrSink.iter_lines(), prefix)
   return retVal
 
+def _build_query_pipeline(cmdString, match, exclude, ignoreCase, head, tail,
+    fields, separator, count):
+  """Compiles the clauses of `query_remote_output` into a shell pipeline."""
+  grepFlags = "-Ei" if ignoreCase else "-E"
+  pipeline = ["{{ {}\n}}".format(cmdString)]
+  if match is not None:
+    pipeline.append("grep {} -e {}".format(grepFlags, pipes.quote(match)))
+  if exclude is not None:
+    pipeline.append("grep -v {} -e {}".format(grepFlags, pipes.quote(exclude)))
+  if head is not None:
+    pipeline.append("head -n {:d}".format(head))
+  if tail is not None:
+    pipeline.append("tail -n {:d}".format(tail))
+  if fields is not None:
+    awkFlags = "" if separator is None \
+      else "-F {} ".format(pipes.quote(separator))
+    pipeline.append("awk {}{}".format(awkFlags, pipes.quote(
+      "{{ print {} }}".format(' "\\t" '.join(
+        "${:d}".format(field) for field in fields
+      ))
+    )))
+  if count:
+    pipeline.append("wc -l")
+  return " | ".join(pipeline)
+
+@traced
+def query_remote_output(cmdString, match=None, exclude=None, ignoreCase=False,
+    head=None, tail=None, fields=None, separator=None, count=False,
+    hostString=None, useSudo=False):
+  """Runs a command and filters its output on the server, so that only the
+  reduced result is sent back. The clauses are compiled into a shell pipeline
+  (`grep`, `head`, `tail`, `awk` and `wc`) applied in this order: `match`,
+  `exclude`, `head`, `tail`, `fields`, `count`.
+
+  Args:
+    cmdString(str): Command to run
+
+    match(str, optional): Extended regular expression; only the lines matching
+      it are kept
+
+    exclude(str, optional): Extended regular expression; the lines matching it
+      are dropped
+
+    ignoreCase(bool, optional): If `True`, `match` and `exclude` ignore case
+
+    head(int, optional): Only the first `head` remaining lines are kept
+
+    tail(int, optional): Only the last `tail` remaining lines are kept
+
+    fields(list of int, optional): Numbers of the fields (starting at 1, as
+      in `awk` and `cut`) to keep from each line
+
+    separator(str, optional): Field separator for `fields` (an `awk` field
+      separator). Defaults to runs of whitespace
+
+    count(bool, optional): If `True`, only the number of remaining lines is
+      returned
+
+    hostString(str, optional): This should be passed the value of
+      `env.host_string`
+
+    useSudo(bool, optional): If `True`, `sudo` will be used instead of `run`
+      to execute the command
+
+  Returns:
+    int if `count` is `True`, otherwise list of list of str if `fields` is
+      given (one list of field values per line), otherwise list of str (the
+      remaining lines)
+
+  >>> query_remote_output("ps -eo pid,user,comm", match="nginx",
+        fields=[1, 2]
+      )
+  [["1234", "root"], ["1235", "www-data"]]
+  >>> query_remote_output("cat /var/log/nginx/error.log", match="upstream",
+        count=True
+      )
+  42
+  """
+  lines = run_and_get_stdout(
+    _build_query_pipeline(cmdString, match, exclude, ignoreCase, head, tail,
+      fields, separator, count
+    ),
+    hostString=hostString, useSudo=useSudo
+  )
+  lines = [line.rstrip("\r") for line in lines]
+  if count:
+    return int(lines[-1].strip()) if lines else 0
+  if fields is not None:
+    return [line.split("\t") for line in lines]
+  return lines
+
+@traced
 def get_home_dir():
   """Returns the home directory for the current user of a given server.
 
+  The `home_dir` fact in the inventory (see `viki.fabric.inventory`) is used
+  if it is fresh enough; the server is not contacted in that case.
+
   Returns:
     str: the path to the home directory of the current host, or the string
       "$HOME"
@@ -109,15 +247,23 @@ def get_home_dir():
   >>> get_home_dir()
   "/home/ubuntu"
   """
-  outputList = run_and_get_stdout("echo $HOME")
+  import viki.fabric.inventory as viki_inventory
+  homeDir = viki_inventory.get_fact("home_dir")
+  if homeDir is not None:
+    return homeDir
+  with read_only():
+    outputList = run_and_get_stdout("echo $HOME")
   if outputList:
-    return outputList[0].strip()
+    homeDir = outputList[0].strip()
+    viki_inventory.set_facts({ "home_dir": homeDir }, persist=False)
+    return homeDir
   else:
     return "$HOME"
 
 # Downloads a remote file to a NamedTemporaryFile and invokes its .close()
 # method.
 # returns the name of the NamedTemporaryFile
+@traced
 def download_remote_file_to_tempfile(remoteFileName):
   """Downloads a file from a server to a \
   `tempfile.NamedTemporaryFile \
@@ -127,6 +273,10 @@ def download_remote_file_to_tempfile(remoteFileName):
 
   **NOTE:** The caller is reponsible for deleting the NamedTemporaryFile.
 
+  Large files are compressed for the transfer (see
+  `viki.fabric.transfer.get_file`); if the server has an agent (see
+  `viki.fabric.agent`), the file is read through it instead.
+
   Args:
     remoteFileName(str): name of the file on the server
 
@@ -144,13 +294,297 @@ def download_remote_file_to_tempfile(remoteFileName):
   downloadedDotfile = tempfile.NamedTemporaryFile(delete=False)
   downloadedDotfileName = downloadedDotfile.name
   downloadedDotfile.close()
+  agent = get_agent()
+  if agent is not None:
+    with open(downloadedDotfileName, "wb") as f:
+      agent.read_file(remoteFileName, f)
+    return downloadedDotfileName
   # hide warning of an existing file getting overwritten
   with settings(hide("warnings")):
-    get(remoteFileName, downloadedDotfileName)
+    get_file(remoteFileName, downloadedDotfileName)
   return downloadedDotfileName
 
+# Default size of the blocks `RemoteFile` fetches, and default number of
+# blocks it caches
+_REMOTE_FILE_BLOCK_SIZE = 1 << 20
+_REMOTE_FILE_CACHE_BLOCKS = 64
+
+# Maximum number of blocks `RemoteFile` fetches in a single request
+_REMOTE_FILE_MAX_FETCH_BLOCKS = 16
+
+class RemoteFile(object):
+  """A read-only file object for a file on a server, which fetches only the
+  parts of the file that are read, so that reading the end of a huge log or
+  sampling a few offsets of it does not download the whole file (unlike
+  `download_remote_file_to_tempfile`).
+
+  The file is fetched in fixed-size blocks, on demand; contiguous missing
+  blocks are fetched in a single request (a single remote command, or a
+  single request to the agent of the server if it has one; see
+  `viki.fabric.agent`). The most recently used blocks are kept in an LRU
+  cache. Besides `seek`, `tell` and `read`, the file supports reverse line
+  iteration (`iter_lines_reversed` and `tail`) and `mmap`-like indexing and
+  slicing.
+
+  The size of the file is taken when it is opened; bytes appended after that
+  are not read.
+
+  Args:
+    path(str): Path of the file on the server
+
+    hostString(str, optional): The server of interest. Defaults to
+      `env.host_string`
+
+    useSudo(bool, optional): If `True`, the file is read using `sudo`
+
+    blockSize(int, optional): Size of the blocks fetched, in bytes. Defaults
+      to 1 MB
+
+    cacheBlocks(int, optional): Number of blocks cached. Defaults to 64
+
+  Raises:
+    RuntimeError: if the file does not exist
+
+  >>> with RemoteFile("/var/log/syslog") as f:
+        lastLines = f.tail(100)
+        f.seek(-1024, os.SEEK_END)
+        lastKilobyte = f.read(1024)
+        firstBytes = f[:16]
+  """
+
+  def __init__(self, path, hostString=None, useSudo=False,
+      blockSize=_REMOTE_FILE_BLOCK_SIZE, cacheBlocks=_REMOTE_FILE_CACHE_BLOCKS):
+    if hostString is None:
+      hostString = env.host_string
+    self.path = path
+    self.hostString = hostString
+    self.useSudo = useSudo
+    self.blockSize = blockSize
+    self.cacheBlocks = cacheBlocks
+    self.closed = False
+    # number of fetch requests and bytes fetched, and number of blocks read
+    # from the cache
+    self.fetches = 0
+    self.bytesFetched = 0
+    self.cacheHits = 0
+    self._cache = collections.OrderedDict()
+    self._position = 0
+    self.size = self._get_size()
+
+  def _get_agent(self):
+    return None if self.useSudo else get_agent(self.hostString)
+
+  def _get_size(self):
+    agent = self._get_agent()
+    with settings(host_string=self.hostString):
+      if agent is not None:
+        fileStat = agent.call("stat", paths=[self.path])[0]
+        size = None if fileStat is None else fileStat["size"]
+      else:
+        # the script delimits the size from any other output
+        script = RemoteScript()
+        script.add_step("size", "stat -L -c %s {}".format(
+          quote_path(self.path)
+        ))
+        with read_only():
+          stepResult = script.run(useSudo=self.useSudo)["steps"]["size"]
+        size = int(stepResult["output"][-1]) \
+          if stepResult["return_code"] == 0 else None
+    if size is None:
+      raise RuntimeError("`{}` does not exist on `{}`".format(self.path,
+        self.hostString
+      ))
+    return size
+
+  def _fetch_blocks(self, firstBlock, blockCount):
+    """Fetches consecutive blocks of the file in a single request, and returns
+    their contents.
+
+    Raises:
+      RuntimeError: if the blocks could not be read, or fewer bytes than the
+        file holds up to its size at opening were read
+    """
+    # blocks past the size of the file at opening are never read
+    expectedSize = max(0,
+      min(blockCount * self.blockSize, self.size - firstBlock * self.blockSize)
+    )
+    agent = self._get_agent()
+    with settings(host_string=self.hostString):
+      if agent is not None:
+        data = base64.b64decode(agent.call("read", path=self.path,
+          offset=firstBlock * self.blockSize,
+          length=blockCount * self.blockSize
+        )["data"])
+      else:
+        # without `pipefail`, a failing `dd` would go unnoticed
+        script = RemoteScript()
+        script.add_step("read",
+          ("set -o pipefail; dd if={} bs={:d} skip={:d} count={:d} 2>/dev/null"
+           " | base64").format(
+            quote_path(self.path), self.blockSize, firstBlock, blockCount
+          )
+        )
+        with read_only():
+          stepResult = script.run(useSudo=self.useSudo)["steps"]["read"]
+        if stepResult["return_code"] != 0:
+          raise RuntimeError("Could not read `{}` on `{}`".format(self.path,
+            self.hostString
+          ))
+        data = base64.b64decode("".join(stepResult["output"]))
+    # bytes appended after opening are dropped; fewer bytes mean the file was
+    # truncated or replaced
+    data = data[:expectedSize]
+    if len(data) != expectedSize:
+      raise RuntimeError(
+        "Read {:d} bytes of `{}` on `{}` at offset {:d}, expected {:d}".format(
+          len(data), self.path, self.hostString, firstBlock * self.blockSize,
+          expectedSize
+        )
+      )
+    self.fetches += 1
+    self.bytesFetched += len(data)
+    return data
+
+  def _cache_block(self, blockIdx, block):
+    self._cache[blockIdx] = block
+    while len(self._cache) > self.cacheBlocks:
+      self._cache.popitem(last=False)
+
+  def _read_range(self, start, stop):
+    """Returns the bytes of the file from offset `start` up to offset `stop`
+    (exclusive), fetching the blocks which are not cached.
+    """
+    stop = min(stop, self.size)
+    if self.closed:
+      raise ValueError("I/O operation on closed file")
+    if start >= stop:
+      return ""
+    firstBlock = start // self.blockSize
+    lastBlock = (stop - 1) // self.blockSize
+    blocks = []
+    blockIdx = firstBlock
+    while blockIdx <= lastBlock:
+      if blockIdx in self._cache:
+        # most recently used blocks are at the end
+        block = self._cache.pop(blockIdx)
+        self._cache[blockIdx] = block
+        self.cacheHits += 1
+        blocks.append(block)
+        blockIdx += 1
+        continue
+      runEnd = blockIdx + 1
+      while runEnd <= lastBlock and runEnd not in self._cache and \
+          runEnd - blockIdx < _REMOTE_FILE_MAX_FETCH_BLOCKS:
+        runEnd += 1
+      data = self._fetch_blocks(blockIdx, runEnd - blockIdx)
+      for idx in range(blockIdx, runEnd):
+        offset = (idx - blockIdx) * self.blockSize
+        block = data[offset:offset + self.blockSize]
+        self._cache_block(idx, block)
+        blocks.append(block)
+      blockIdx = runEnd
+    startOffset = start - firstBlock * self.blockSize
+    return "".join(blocks)[startOffset:startOffset + stop - start]
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    """Sets the position in the file, like `file.seek`."""
+    if whence == os.SEEK_CUR:
+      offset += self._position
+    elif whence == os.SEEK_END:
+      offset += self.size
+    if offset < 0:
+      raise ValueError("Negative position {}".format(offset))
+    self._position = offset
+
+  def tell(self):
+    """Returns the position in the file."""
+    return self._position
+
+  def read(self, size=-1):
+    """Reads up to `size` bytes from the position in the file (until the end
+    of the file if `size` is negative), like `file.read`.
+    """
+    stop = self.size if size < 0 else self._position + size
+    data = self._read_range(self._position, stop)
+    self._position += len(data)
+    return data
+
+  def iter_lines_reversed(self):
+    """Yields the lines of the file (without line terminators) from the last
+    one to the first one, fetching the blocks of the file from its end.
+    """
+    stop = self.size
+    partialLine = None
+    while stop > 0:
+      start = ((stop - 1) // self.blockSize) * self.blockSize
+      lines = self._read_range(start, stop).split("\n")
+      if partialLine is None:
+        # a line terminator at the end of the file does not start a line
+        if lines[-1] == "":
+          lines.pop()
+      else:
+        lines[-1] += partialLine
+      partialLine = lines.pop(0) if lines else ""
+      for line in reversed(lines):
+        yield line.rstrip("\r")
+      stop = start
+    # the first line of the file
+    if partialLine is not None:
+      yield partialLine.rstrip("\r")
+
+  def tail(self, lineCount=10):
+    """Returns the last `lineCount` lines of the file (without line
+    terminators), like `tail -n`.
+    """
+    lines = []
+    for line in self.iter_lines_reversed():
+      if len(lines) >= lineCount:
+        break
+      lines.append(line)
+    return lines[::-1]
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, key):
+    """Returns a byte (for an index) or a range of bytes (for a slice) of the
+    file, like `mmap`.
+    """
+    if isinstance(key, slice):
+      (start, stop, step) = key.indices(self.size)
+      if step == 1:
+        return self._read_range(start, stop)
+      offsets = range(start, stop, step)
+      if not offsets:
+        return ""
+      firstOffset = min(offsets)
+      data = self._read_range(firstOffset, max(offsets) + 1)
+      return "".join(data[offset - firstOffset] for offset in offsets)
+    if key < 0:
+      key += self.size
+    if not 0 <= key < self.size:
+      raise IndexError("RemoteFile index out of range")
+    return self._read_range(key, key + 1)
+
+  def close(self):
+    """Drops the cached blocks."""
+    self._cache.clear()
+    self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+@traced
 def copy_file_to_server_if_not_exists(localFileName, serverFileName):
-  """Copies a file to the server if it does not exist there.
+  """Copies a file to the server if it does not exist there. Large files are
+  compressed for the transfer (see `viki.fabric.transfer.put_file`).
+
+  The existence check uses the stat cache of the server (see
+  `viki.fabric.statcache`), so copying several files to the same directory
+  checks them all with a single remote command.
 
   Args:
     localFileName(str): local path of the file to copy to the server
@@ -162,19 +596,21 @@ def copy_file_to_server_if_not_exists(localFileName, serverFileName):
       )
   """
   serverName = env.host
-  if not exists(serverFileName):
+  if not remote_path_exists(serverFileName):
     print(yellow("`{}` does not exist on `{}`.".format(serverFileName,
       serverName
     )))
     print(yellow("Copying local `{}` to `{}` on `{}`...".format(
       localFileName, serverFileName, serverName
     )))
-    put(localFileName, serverFileName, mirror_local_mode=True)
+    put_file(localFileName, serverFileName, mirrorLocalMode=True)
   else:
     print(blue("`{}` exists on `{}`".format(serverFileName, serverName)))
 
+@traced
 def is_dir(path):
-  """Checks if a given path on the server is a directory.
+  """Checks if a given path on the server is a directory, using the stat cache
+  of the server (see `viki.fabric.statcache`).
 
   Args:
     path(str): path we wish to check
@@ -185,9 +621,9 @@ def is_dir(path):
   >>> is_dir("/home/ubuntu")
   True
   """
-  with(settings(hide("everything"), warn_only=True)):
-    return run("[ -d '{}' ]".format(path)).succeeded
+  return remote_path_is_dir(path)
 
+@traced
 def update_package_manager_package_lists():
   """Updates the package list of the package manager (currently assumed to be
   apt-get)
@@ -196,11 +632,33 @@ def update_package_manager_package_lists():
   """
   sudo("apt-get update")
 
+# State of the packages installed using the package manager, for memoizing
+# helpers (see `viki.fabric.memo.converged`)
+_PACKAGES_STATE_COMMAND = \
+  "dpkg-query -W -f '${Package} ${Version} ${Status}\\n'"
+
+# State of Vundle and the vim plugins it manages in the home directory of the
+# user, for memoizing `setup_vundle`
+_VUNDLE_STATE_COMMAND = \
+  'cat ~/.vimrc; cd ~/.vim/bundle && for d in */; do' \
+  ' echo "$d $(cd "$d" && git rev-parse HEAD)"; done'
+
+def _get_docker_state_command():
+  """Returns the state command of `install_docker_most_recent` for the current
+  host (see `viki.fabric.memo.converged`).
+  """
+  return "docker --version; id -nG {}".format(pipes.quote(env.user))
+
+@traced
+@converged(_PACKAGES_STATE_COMMAND)
 def install_software_using_package_manager(softwareList):
   """Installs a list of software using the system's package manager if they
   have not been installed. Currently this assumes `apt-get` to be the package
   manager.
 
+  The call is skipped on hosts where it has already converged (see
+  `viki.fabric.memo`).
+
   Args:
     softwareList(list of str): list of software to install
 
@@ -208,16 +666,30 @@ def install_software_using_package_manager(softwareList):
         ["vim", "openjdk-6-jdk", "unzip"]
       )
   """
+  import viki.fabric.inventory as viki_inventory
   softwareToInstall = [software for software in softwareList if
     not is_installed_using_package_manager(software)]
   if softwareToInstall:
     print(yellow("Installing {} ...".format(",".join(softwareToInstall))))
     sudo("apt-get install -y {}".format(" ".join(softwareToInstall)))
-
+    # keep the inventory in step with what we just installed
+    installedPackages = viki_inventory.get_fact("installed_packages")
+    if installedPackages is not None:
+      viki_inventory.set_facts({
+        "installed_packages": sorted(set(installedPackages) |
+          set(softwareToInstall))
+      })
+
+@traced
 def is_installed_using_package_manager(software):
   """Determines if a given software is installed on the system by its package
   manager (currently assumed to be apt-get).
 
+  The `installed_packages` fact in the inventory (see `viki.fabric.inventory`)
+  is used if it is fresh enough; the server is not contacted in that case.
+  Otherwise, the agent of the server is asked if it has one (see
+  `viki.fabric.agent`).
+
   Args:
     software(str): The name of the software
 
@@ -228,7 +700,19 @@ def is_installed_using_package_manager(software):
   >>> is_installed_using_package_manager("python")
   True
   """
-  outputList = run_and_get_stdout("dpkg -s {}".format(software))
+  import viki.fabric.inventory as viki_inventory
+  installedPackages = viki_inventory.get_fact("installed_packages")
+  if installedPackages is not None:
+    return software in installedPackages
+  agent = get_agent()
+  if agent is not None:
+    for package in agent.call("dpkg_query", packages=[software]):
+      if package["package"] == software:
+        return package["status"] == "install ok installed"
+    return False
+  outputList = query_remote_output("dpkg -s {}".format(software),
+    match="^Status: ", head=1
+  )
   statusPrefix = "Status: "
   statusPrefixLen = len(statusPrefix)
   for line in outputList:
@@ -236,51 +720,350 @@ def is_installed_using_package_manager(software):
       return line[statusPrefixLen:].strip() == "install ok installed"
   return False
 
-def setup_vundle(homeDir=None):
+# Git repository and version of Vundle
+_VUNDLE_GIT_REPO = "https://github.com/gmarik/Vundle.vim.git"
+_VUNDLE_VERSION = "v0.10.2"
+
+# Lines of a vimrc declaring a plugin managed by Vundle, such as
+# `Plugin 'tpope/vim-fugitive'`
+_VUNDLE_PLUGIN_RE = re.compile(r"""^\s*(?:Plugin|Bundle)\s+['"]([^'"]+)['"]""")
+
+# File in `~/.vim/bundle` holding the version of the bundle snapshot it was
+# extracted from (see `build_vundle_bundle_snapshot`)
+_VUNDLE_BUNDLE_VERSION_FILE = ".viki_bundle_version"
+
+# File names of bundle snapshots, which hold their version
+_VUNDLE_BUNDLE_SNAPSHOT_NAME_FORMAT = "vundle-bundle-{}.tar.gz"
+_VUNDLE_BUNDLE_SNAPSHOT_NAME_RE = re.compile(r"^vundle-bundle-(\w+)\.tar\.gz$")
+
+@converged(_VUNDLE_STATE_COMMAND, name="viki.fabric.helpers.setup_vundle")
+def _setup_vundle_in_user_home_dir(bundleSnapshotPath=None):
+  """Sets up Vundle in the home directory of the user, unless it has already
+  converged there.
+  """
+  _setup_vundle(get_home_dir(), bundleSnapshotPath)
+
+@traced
+def setup_vundle(homeDir=None, bundleSnapshotPath=None):
   """Clones the Vundle vim plugin (https://github.com/gmarik/Vundle.vim) to the
   server (if it hasn't been cloned), pulls updates, checkout v0.10.2, and
   installs vim plugins managed by Vundle.
 
+  The checks and commands are sent to the server as a single script (see
+  `viki.fabric.script.RemoteScript`). Unless `homeDir` is given, the call is
+  skipped on hosts where it has already converged (see `viki.fabric.memo`);
+  the state checked is that of the home directory of the user.
+
+  If `bundleSnapshotPath` is given, the `~/.vim/bundle` directory is instead
+  replaced by the contents of a bundle snapshot built by
+  `build_vundle_bundle_snapshot`, unless the server already has the same
+  version of it; this does not contact GitHub. To set up many servers, use
+  `distribute_vundle_bundle_snapshot`.
+
   Args:
     homeDir(str, optional): home directory for the server. If not supplied or if
       `None` is supplied, the return value of the `get_home_dir` function is
       used
 
+    bundleSnapshotPath(str, optional): Path of a local bundle snapshot
+
   >>> setup-vundle()
   """
   if homeDir is None:
-    homeDir = get_home_dir()
-  vundleGitRepoPath = os.path.join(homeDir, ".vim", "bundle", "Vundle.vim")
-  if exists(vundleGitRepoPath):
-    if not is_dir(vundleGitRepoPath):
-      abort(red(
-        ("Error: `{}` is not a directory. Please remove it manually (it is used"
-         " for storing Vundle)."
-        ).format(vundleGitRepoPath)
-      ))
-    # updates the repository
-    with cd(vundleGitRepoPath):
-      print(blue('Vundle git repo exists. Updating it...'))
-      run('git remote update')
+    _setup_vundle_in_user_home_dir(bundleSnapshotPath=bundleSnapshotPath)
   else:
+    _setup_vundle(homeDir, bundleSnapshotPath)
+
+def _setup_vundle(homeDir, bundleSnapshotPath):
+  """Sets up Vundle in a home directory; see `setup_vundle`."""
+  if bundleSnapshotPath is not None:
+    _deploy_vundle_bundle_snapshot(bundleSnapshotPath, homeDir)
+    return
+  vundleGitRepoPath = os.path.join(homeDir, ".vim", "bundle", "Vundle.vim")
+  quotedVundleGitRepoPath = quote_path(vundleGitRepoPath)
+  # all the steps are run as a single remote command
+  script = RemoteScript()
+  script.add_step("check_dir", "[ ! -e {0} ] || [ -d {0} ]".format(
+    quotedVundleGitRepoPath
+  ))
+  with script.cd(vundleGitRepoPath):
+    script.add_step("update", "git remote update",
+      condition="[ -d {} ]".format(quotedVundleGitRepoPath)
+    )
+  script.add_step("clone",
+    "git clone {} {}".format(_VUNDLE_GIT_REPO, quotedVundleGitRepoPath),
+    condition="[ ! -e {} ]".format(quotedVundleGitRepoPath)
+  )
+  with script.cd(vundleGitRepoPath):
+    script.add_step("checkout", "git checkout {}".format(_VUNDLE_VERSION))
+  script.add_step("plugin_install", "vim +PluginInstall +qall")
+  print(blue("Setting up Vundle in `{}`...".format(vundleGitRepoPath)))
+  result = script.run()
+  failedStep = result["failed_step"]
+  if failedStep == "check_dir":
+    abort(red(
+      ("Error: `{}` is not a directory. Please remove it manually (it is used"
+       " for storing Vundle)."
+      ).format(vundleGitRepoPath)
+    ))
+  elif failedStep is not None:
+    abort(red("Error: the `{}` step of setting up Vundle failed:\n{}".format(
+      failedStep, "\n".join(result["steps"][failedStep]["output"])
+    )))
+  if result["steps"]["clone"]["ran"]:
     print(yellow(
-      'Vundle.vim not found. Cloning it to `{}`'.format(vundleGitRepoPath)
+      "Vundle.vim was not found. Cloned it to `{}`.".format(vundleGitRepoPath)
     ))
-    gitCloneCmd = \
-      'git clone https://github.com/gmarik/Vundle.vim.git {}'.format(
-        vundleGitRepoPath
+  else:
+    print(blue("Vundle git repo exists. Updated it."))
+  print(yellow("Installed vim plugins managed by Vundle."))
+
+def get_vundle_bundle_version(vimrcPath):
+  """Returns the version of the bundle snapshot for a vimrc: a hash of the
+  plugins it declares (in `Plugin` or `Bundle` lines) and of the version of
+  Vundle.
+
+  Args:
+    vimrcPath(str): Path of the local vimrc
+
+  Returns:
+    str: the version
+
+  >>> get_vundle_bundle_version("dotfiles/vimrc")
+  "5d41402abc4b2a76"
+  """
+  with open(vimrcPath, "r") as f:
+    plugins = sorted(set(
+      m.group(1) for m in (_VUNDLE_PLUGIN_RE.match(line) for line in f) if m
+    ))
+  return hashlib.sha1(json.dumps([_VUNDLE_VERSION, plugins])).hexdigest()[:16]
+
+def _get_vundle_bundle_snapshot_version(bundleSnapshotPath):
+  """Returns the version of a bundle snapshot, from its file name."""
+  m = _VUNDLE_BUNDLE_SNAPSHOT_NAME_RE.match(
+    os.path.basename(bundleSnapshotPath)
+  )
+  if m is None:
+    raise ValueError(
+      "`{}` is not a bundle snapshot built by `build_vundle_bundle_snapshot`"
+      .format(bundleSnapshotPath)
+    )
+  return m.group(1)
+
+@traced
+def build_vundle_bundle_snapshot(vimrcPath, outputDir=".", seedHost=None):
+  """Builds a snapshot of the `~/.vim/bundle` directory for a vimrc: Vundle and
+  the vim plugins it installs, packed in a tarball whose name holds its version
+  (see `get_vundle_bundle_version`). Deploy the snapshot with
+  `distribute_vundle_bundle_snapshot`, or with the `bundleSnapshotPath`
+  parameter of `setup_vundle`.
+
+  The plugins are installed in a temporary home directory, on this machine or
+  on a seed host, in a single script (see `viki.fabric.script.RemoteScript`).
+  An existing snapshot of the same version in `outputDir` is reused.
+
+  Args:
+    vimrcPath(str): Path of the local vimrc declaring the plugins
+
+    outputDir(str, optional): Local directory to write the snapshot to.
+      Defaults to the current directory
+
+    seedHost(str, optional): Host string of the host to install the plugins
+      on. Defaults to this machine (`localhost`)
+
+  Returns:
+    str: path of the snapshot
+
+  >>> build_vundle_bundle_snapshot("dotfiles/vimrc", outputDir="build")
+  "build/vundle-bundle-5d41402abc4b2a76.tar.gz"
+  """
+  version = get_vundle_bundle_version(vimrcPath)
+  snapshotName = _VUNDLE_BUNDLE_SNAPSHOT_NAME_FORMAT.format(version)
+  snapshotPath = os.path.join(outputDir, snapshotName)
+  if os.path.exists(snapshotPath):
+    print(blue("Reusing the Vundle bundle snapshot `{}`".format(snapshotPath)))
+    return snapshotPath
+  if not os.path.isdir(outputDir):
+    os.makedirs(outputDir)
+  with open(vimrcPath, "r") as f:
+    vimrc = f.read()
+  buildDir = "/tmp/viki-vundle-build-{}".format(version)
+  remoteSnapshotPath = "/tmp/{}".format(snapshotName)
+  bundleDir = "{}/.vim/bundle".format(buildDir)
+  script = RemoteScript()
+  script.add_step("prepare",
+    "rm -rf {0} && mkdir -p {1} && printf '%s' {2} > {0}/.vimrc".format(
+      buildDir, bundleDir, pipes.quote(vimrc)
+    )
+  )
+  script.add_step("clone", "git clone {} {}/Vundle.vim".format(
+    _VUNDLE_GIT_REPO, bundleDir
+  ))
+  with script.cd("{}/Vundle.vim".format(bundleDir)):
+    script.add_step("checkout", "git checkout {}".format(_VUNDLE_VERSION))
+  script.add_step("plugin_install",
+    "HOME={} vim +PluginInstall +qall </dev/null".format(buildDir)
+  )
+  script.add_step("pack",
+    "echo {} > {}/{} && tar -czf {} -C {}/.vim bundle".format(version,
+      bundleDir, _VUNDLE_BUNDLE_VERSION_FILE, remoteSnapshotPath, buildDir
+    )
+  )
+  script.add_step("clean", "rm -rf {}".format(buildDir), stopOnFailure=False)
+  buildHost = seedHost or "localhost"
+  print(blue("Building the Vundle bundle snapshot `{}` on `{}`...".format(
+    snapshotName, buildHost
+  )))
+  with settings(host_string=buildHost):
+    result = script.run()
+    failedStep = result["failed_step"]
+    if failedStep is not None:
+      abort(red(
+        "Error: the `{}` step of building the Vundle bundle failed:\n{}".format(
+          failedStep, "\n".join(result["steps"][failedStep]["output"])
+        )
+      ))
+    if is_local_target():
+      shutil.move(remoteSnapshotPath, snapshotPath)
+    else:
+      get_file(remoteSnapshotPath, snapshotPath)
+      with settings(hide("everything"), warn_only=True):
+        run("rm -f {}".format(remoteSnapshotPath))
+  return snapshotPath
+
+def _deploy_vundle_bundle_snapshot(bundleSnapshotPath, homeDir):
+  """Replaces the `~/.vim/bundle` directory of the server by the contents of a
+  bundle snapshot, unless it already holds the same version.
+
+  Returns:
+    bool: `True` if the snapshot was deployed, `False` if it was skipped
+  """
+  version = _get_vundle_bundle_snapshot_version(bundleSnapshotPath)
+  vimDir = os.path.join(homeDir, ".vim")
+  quotedVimDir = quote_path(vimDir)
+  check = RemoteScript()
+  check.add_step("version", "cat {}/bundle/{}".format(quotedVimDir,
+    _VUNDLE_BUNDLE_VERSION_FILE
+  ))
+  with read_only():
+    checkResult = check.run()["steps"]["version"]
+  if checkResult["return_code"] == 0 and \
+      [line.strip() for line in checkResult["output"]] == [version]:
+    print(blue("`{}` already has version `{}` of the Vundle bundle".format(
+      env.host, version
+    )))
+    return False
+  remoteSnapshotPath = "/tmp/{}".format(os.path.basename(bundleSnapshotPath))
+  put_file(bundleSnapshotPath, remoteSnapshotPath)
+  # the snapshot is extracted next to `~/.vim/bundle` first, so that a failed
+  # extraction leaves the current bundle in place
+  newBundleParentDir = "{}/.viki-bundle-{}".format(quotedVimDir, version)
+  script = RemoteScript()
+  script.add_step("extract",
+    "rm -rf {0} && mkdir -p {0} && tar -xzf {1} -C {0}".format(
+      newBundleParentDir, remoteSnapshotPath
+    )
+  )
+  script.add_step("swap",
+    "rm -rf {0}/bundle && mv {1}/bundle {0}/bundle && rmdir {1}".format(
+      quotedVimDir, newBundleParentDir
+    )
+  )
+  script.add_step("clean", "rm -f {}".format(remoteSnapshotPath),
+    stopOnFailure=False
+  )
+  print(blue("Deploying version `{}` of the Vundle bundle to `{}`...".format(
+    version, vimDir
+  )))
+  result = script.run()
+  failedStep = result["failed_step"]
+  if failedStep is not None:
+    abort(red(
+      "Error: the `{}` step of deploying the Vundle bundle failed:\n{}".format(
+        failedStep, "\n".join(result["steps"][failedStep]["output"])
       )
-    run(gitCloneCmd)
+    ))
+  return True
+
+@task
+@parallel
+def deploy_vundle_bundle_snapshot(bundleSnapshotPath, homeDir=None):
+  """Fabric task which deploys a Vundle bundle snapshot to the current host,
+  unless it already has the same version.
+
+  This task is used by `distribute_vundle_bundle_snapshot`; call that instead.
+
+  Returns:
+    bool: `True` if the snapshot was deployed, `False` if it was skipped
+  """
+  if homeDir is None:
+    homeDir = get_home_dir()
+  return _deploy_vundle_bundle_snapshot(bundleSnapshotPath, homeDir)
+
+def distribute_vundle_bundle_snapshot(vimrcPath, hosts=None, roles=None,
+    seedHost=None, poolSize=None, outputDir="."):
+  """Sets up Vundle and the vim plugins of a vimrc on many hosts in parallel:
+  builds a bundle snapshot once (see `build_vundle_bundle_snapshot`), and
+  deploys it to the hosts which do not have the same version yet, instead of
+  having every host clone every plugin from GitHub.
 
-  with cd(vundleGitRepoPath):
-    run('git checkout v0.10.2')
-  print(yellow('Installing vim plugins managed by Vundle...'))
-  with settings(hide('stdout')):
-    run('vim +PluginInstall +qall')
+  The vimrc itself is not copied to the hosts.
 
+  Args:
+    vimrcPath(str): Path of the local vimrc declaring the plugins
+
+    hosts(list of str, optional): Hosts to deploy to. Defaults to `env.hosts`
+
+    roles(list of str, optional): Roles to deploy to. Defaults to `env.roles`
+
+    seedHost(str, optional): Host to build the snapshot on. Defaults to this
+      machine
+
+    poolSize(int, optional): Maximum number of hosts to deploy to
+      concurrently. Defaults to `env.pool_size`
+
+    outputDir(str, optional): Local directory holding the snapshots. Defaults
+      to the current directory
+
+  Returns:
+    dict: A dict whose keys are host strings and whose values are `True` if
+      the snapshot was deployed to the host, `False` if the host already had
+      it. Hosts which failed map to the exception raised for them, and hosts
+      which timed out or were quarantined (see `viki.fabric.deadlines`) map to
+      `None`
+
+  >>> distribute_vundle_bundle_snapshot("dotfiles/vimrc",
+        hosts=["hostOne", "hostTwo"], poolSize=20
+      )
+  {"hostOne": True, "hostTwo": False}
+  """
+  if hosts is None:
+    hosts = env.hosts
+  if roles is None:
+    roles = env.roles
+  bundleSnapshotPath = build_vundle_bundle_snapshot(vimrcPath,
+    outputDir=outputDir, seedHost=seedHost
+  )
+  taskToExecute = with_deadline()(deploy_vundle_bundle_snapshot.wrapped)
+  if poolSize is not None:
+    taskToExecute = parallel(pool_size=poolSize)(taskToExecute)
+  retVal = execute(taskToExecute, bundleSnapshotPath, hosts=hosts,
+    roles=roles
+  )
+  print(blue("Deployed the Vundle bundle to {} hosts, {} already had it".format(
+    sum(1 for v in retVal.values() if v is True),
+    sum(1 for v in retVal.values() if v is False)
+  )))
+  return retVal
+
+@traced
 def is_program_on_path(program):
   """Determines if a program is in any folder in the PATH environment variable.
 
+  The `programs_on_path` fact in the inventory (see `viki.fabric.inventory`) is
+  used if it is fresh enough and covers `program`; the server is not contacted
+  in that case.
+
   Args:
     program(str): Name of the program
 
@@ -291,9 +1074,15 @@ def is_program_on_path(program):
   >>> is_program_on_path("python")
   True
   """
-  with settings(hide("everything"), warn_only=True):
+  import viki.fabric.inventory as viki_inventory
+  programsOnPath = viki_inventory.get_fact("programs_on_path")
+  if programsOnPath is not None and program in programsOnPath:
+    return programsOnPath[program]
+  with settings(hide("everything"), read_only(), warn_only=True):
     return run("command -v {} >/dev/null 2>&1".format(program)).succeeded
 
+@traced
+@converged(_get_docker_state_command)
 def install_docker_most_recent():
   """Installs the most recent version of  docker (https://www.docker.io) using
   the http://get.docker.io shell script, and adds the current user to the
@@ -301,6 +1090,9 @@ def install_docker_most_recent():
 
   **NOTE:** This function assumes that the bash shell exists, and that the
     user has sudo privileges.
+
+  The call is skipped on hosts where it has already converged (see
+  `viki.fabric.memo`).
   """
   run("wget -qO- https://get.docker.io/ | bash")
   sudo("usermod -aG docker {}".format(env.user))
@@ -358,8 +1150,13 @@ def get_in_env(keyList, default=None):
   return currentVal
 
 def get_in_viki_fabric_config(keyList, default=None):
-  """Calls `get_in_env`, but with the 0th element of the `keyList` set to
-  `VIKI_FABRIC_CONFIG_KEY_NAME`.
+  """Obtains the value under a series of nested keys in the
+  `VIKI_FABRIC_CONFIG_KEY_NAME` key of `fabric.api.env`, like `get_in_env`.
+
+  The config is resolved for the current host (`env.host_string`), so
+  per-role and per-host overrides apply (see :doc:`configuration`). This is a
+  single lookup in an index built once per host by
+  `viki.fabric.config.get_config_index`.
 
   Args:
     keyList(list of str): list of keys under the `VIKI_FABRIC_CONFIG_KEY_NAME`
@@ -384,9 +1181,7 @@ def get_in_viki_fabric_config(keyList, default=None):
   >>> get_in_viki_fabric_config(["hierarchy", "pin"], "useThis")
   'useThis'
   """
-  return get_in_env([VIKI_FABRIC_CONFIG_KEY_NAME] + keyList,
-    default=default
-  )
+  return get_config_index().get(tuple(keyList), default)
 
 def env_has_nested_keys(keyList):
   """Determines if `fabric.api.env` has a set of nested keys; the value of each
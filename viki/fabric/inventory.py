@@ -0,0 +1,358 @@
+import fcntl
+import json
+import os
+import os.path
+import tempfile
+import time
+
+from fabric.api import env
+from fabric.colors import blue
+from fabric.context_managers import hide, settings
+from fabric.decorators import parallel, task
+from fabric.tasks import execute
+
+from viki.fabric.config import get_config_index, get_module_config
+from viki.fabric.deadlines import with_deadline
+from viki.fabric.operations import read_only
+
+# Default path of the local file holding the fact inventory. Relative paths are
+# relative to the directory where the main Python script is run
+_DEFAULT_INVENTORY_PATH = ".viki_fabric_inventory.json"
+
+# Default maximum age (in seconds) of a fact before it is considered stale
+_DEFAULT_MAX_AGE = 3600
+
+# Default programs whose presence on the PATH is recorded as a fact
+_DEFAULT_PROGRAMS = ["git", "vim", "docker", "wget", "curl", "python"]
+
+# Line printed before each section of the output of the fact gathering script
+_SECTION_MARKER = "VIKI_FABRIC_INVENTORY_SECTION "
+
+# In-memory copy of the inventory file; a dict whose keys are host strings and
+# whose values are dicts mapping fact names to
+# `{"value": fact value, "timestamp": seconds since the epoch}` dicts.
+# `None` if the inventory file has not been read.
+_INVENTORY = None
+
+def get_inventory_path():
+  """Returns the path of the local file holding the fact inventory.
+
+  This is the value of the `path` key of the `viki.fabric.inventory` dict in
+  `viki_fabric_config.yml`, or `.viki_fabric_inventory.json` if that key is
+  absent.
+
+  Returns:
+    str: path of the inventory file
+
+  >>> get_inventory_path()
+  ".viki_fabric_inventory.json"
+  """
+  return get_module_config("viki.fabric.inventory", "path",
+    _DEFAULT_INVENTORY_PATH
+  )
+
+def _load_inventory():
+  """Reads the inventory file into `_INVENTORY` (only once per process) and
+  returns it.
+  """
+  global _INVENTORY
+  if _INVENTORY is None:
+    inventoryPath = get_inventory_path()
+    _INVENTORY = {}
+    if os.path.exists(inventoryPath):
+      with open(inventoryPath, "r") as f:
+        try:
+          _INVENTORY = json.load(f)
+        except ValueError:
+          # a corrupt inventory is as good as no inventory
+          _INVENTORY = {}
+  return _INVENTORY
+
+def _merge_inventories(target, source):
+  """Merges the `source` inventory into the `target` inventory, keeping the
+  most recent value of every fact.
+  """
+  for (hostString, sourceFacts) in source.items():
+    targetFacts = target.setdefault(hostString, {})
+    for (factName, fact) in sourceFacts.items():
+      if factName not in targetFacts or \
+          targetFacts[factName]["timestamp"] < fact["timestamp"]:
+        targetFacts[factName] = fact
+
+def _save_inventory():
+  """Atomically writes `_INVENTORY` to the inventory file.
+
+  Hosts in a parallel run write to the same file, so the file is locked, and
+  facts already in it that are more recent than ours are kept.
+  """
+  inventory = _load_inventory()
+  inventoryPath = get_inventory_path()
+  inventoryDir = os.path.dirname(os.path.abspath(inventoryPath))
+  with open("{}.lock".format(inventoryPath), "w") as lockFile:
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    if os.path.exists(inventoryPath):
+      with open(inventoryPath, "r") as f:
+        try:
+          _merge_inventories(inventory, json.load(f))
+        except ValueError:
+          pass
+    fd, tmpPath = tempfile.mkstemp(dir=inventoryDir, prefix=".inventory-")
+    with os.fdopen(fd, "w") as f:
+      json.dump(inventory, f, indent=2, sort_keys=True)
+    os.rename(tmpPath, inventoryPath)
+
+def get_fact(factName, hostString=None, maxAge=None):
+  """Obtains a fact about a host from the inventory, if it is fresh enough.
+
+  This does not contact the host.
+
+  Args:
+    factName(str): Name of the fact, such as "home_dir"
+
+    hostString(str, optional): The host to obtain the fact for. Defaults to
+      `env.host_string`
+
+    maxAge(int, optional): Maximum age of the fact in seconds. Defaults to the
+      value of the `max_age` key of the `viki.fabric.inventory` dict in
+      `viki_fabric_config.yml`, or 3600 if that key is absent
+
+  Returns:
+    obj: The value of the fact, or `None` if the fact is absent from the
+      inventory or is older than `maxAge`
+
+  >>> get_fact("home_dir")
+  "/home/ubuntu"
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if maxAge is None:
+    maxAge = get_module_config("viki.fabric.inventory", "max_age",
+      _DEFAULT_MAX_AGE
+    )
+  fact = _load_inventory().get(hostString, {}).get(factName)
+  if fact is None or time.time() - fact["timestamp"] > maxAge:
+    return None
+  return fact["value"]
+
+def set_facts(facts, hostString=None, persist=True):
+  """Records facts about a host in the inventory, timestamping each of them
+  with the current time.
+
+  Args:
+    facts(dict): A dict whose keys are fact names and whose values are the
+      values of the facts
+
+    hostString(str, optional): The host the facts are about. Defaults to
+      `env.host_string`
+
+    persist(bool, optional): If `True`, the inventory file is rewritten
+
+  >>> set_facts({"home_dir": "/home/ubuntu"})
+  """
+  if hostString is None:
+    hostString = env.host_string
+  now = time.time()
+  hostFacts = _load_inventory().setdefault(hostString, {})
+  for (factName, value) in facts.items():
+    hostFacts[factName] = { "value": value, "timestamp": now }
+  if persist:
+    _save_inventory()
+
+def get_fact_ages(hostString=None):
+  """Returns the age of every fact recorded in the inventory for a host.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    dict: A dict whose keys are fact names and whose values are the ages of
+      the facts in seconds
+
+  >>> get_fact_ages()
+  {"home_dir": 12.5, "installed_packages": 12.5}
+  """
+  if hostString is None:
+    hostString = env.host_string
+  now = time.time()
+  return dict(
+    (factName, now - fact["timestamp"])
+    for (factName, fact) in _load_inventory().get(hostString, {}).items()
+    if fact["value"] is not None
+  )
+
+def _build_fact_gathering_script(programs, gitPaths):
+  """Builds a shell script which prints every fact in the standard fact set,
+  each section preceded by a line starting with `_SECTION_MARKER`.
+  """
+  lines = [
+    "echo '{}home_dir'".format(_SECTION_MARKER),
+    "echo $HOME",
+    "echo '{}programs_on_path'".format(_SECTION_MARKER),
+  ]
+  for program in programs:
+    lines.append(
+      "command -v {0} >/dev/null 2>&1 && echo '{0} 1' || echo '{0} 0'".format(
+        program
+      )
+    )
+  lines.extend([
+    "echo '{}installed_packages'".format(_SECTION_MARKER),
+    "dpkg-query -W -f='${Package} ${Status}\\n' 2>/dev/null"
+      " | awk '$NF == \"installed\" && $(NF-1) == \"ok\" { print $1 }'",
+  ])
+  if gitPaths is not None:
+    lines.append(
+      "echo '{}setup_server_for_git_clone_run'".format(_SECTION_MARKER)
+    )
+    lines.append("{} && echo 1 || echo 0".format(" && ".join(
+      "[ -e \"$HOME/{}\" ]".format(p) for p in gitPaths
+    )))
+  return "\n".join(lines)
+
+def _parse_fact_gathering_output(outputLines):
+  """Parses the output of the script built by `_build_fact_gathering_script`
+  into a dict of facts.
+  """
+  sections = {}
+  currentSection = None
+  for line in outputLines:
+    line = line.rstrip("\r")
+    if line.startswith(_SECTION_MARKER):
+      currentSection = line[len(_SECTION_MARKER):]
+      sections[currentSection] = []
+    elif currentSection is not None and line:
+      sections[currentSection].append(line)
+
+  facts = {}
+  if sections.get("home_dir"):
+    facts["home_dir"] = sections["home_dir"][0].strip()
+  if "programs_on_path" in sections:
+    facts["programs_on_path"] = dict(
+      (line.split()[0], line.split()[1] == "1")
+      for line in sections["programs_on_path"]
+    )
+  if "installed_packages" in sections:
+    facts["installed_packages"] = sorted(
+      line.strip() for line in sections["installed_packages"]
+    )
+  if sections.get("setup_server_for_git_clone_run"):
+    facts["setup_server_for_git_clone_run"] = \
+      sections["setup_server_for_git_clone_run"][0].strip() == "1"
+  return facts
+
+def _get_git_setup_paths():
+  """Returns the paths (relative to $HOME) checked by
+  `viki.fabric.git.is_fabtask_setup_server_for_git_clone_run`, or `None` if
+  the `viki.fabric.git` module is not configured.
+  """
+  gitConfig = get_config_index().get(("viki.fabric.git",))
+  if not isinstance(gitConfig, dict):
+    return None
+  try:
+    return [
+      gitConfig["git_ssh_script_name"],
+      os.path.join(gitConfig["ssh_keys_dir"], gitConfig["ssh_public_key"]),
+      os.path.join(gitConfig["ssh_keys_dir"], gitConfig["ssh_private_key"]),
+    ]
+  except KeyError:
+    return None
+
+@task
+@parallel
+def gather_host_facts():
+  """Fabric task which gathers the standard fact set of the current host using
+  a single remote command, and returns it.
+
+  This task is used by `gather_facts`; call that instead.
+
+  Returns:
+    dict: A dict whose keys are fact names and whose values are the values of
+      the facts
+  """
+  # imported here because `viki.fabric.helpers` imports this module
+  from viki.fabric.helpers import run_and_get_stdout
+  programs = get_module_config("viki.fabric.inventory", "programs",
+    _DEFAULT_PROGRAMS
+  )
+  script = _build_fact_gathering_script(programs, _get_git_setup_paths())
+  with read_only():
+    return _parse_fact_gathering_output(run_and_get_stdout(script))
+
+def gather_facts(hosts=None, roles=None, poolSize=None):
+  """Gathers the standard fact set from many hosts in parallel and persists it
+  in the inventory file.
+
+  The standard fact set consists of:
+
+  - `home_dir`: the home directory of the user (see
+    `viki.fabric.helpers.get_home_dir`)
+  - `programs_on_path`: a dict mapping each program in the `programs` key of
+    the `viki.fabric.inventory` dict in `viki_fabric_config.yml` to whether it
+    is on the PATH (see `viki.fabric.helpers.is_program_on_path`)
+  - `installed_packages`: the list of packages installed using the package
+    manager (see `viki.fabric.helpers.is_installed_using_package_manager`)
+  - `setup_server_for_git_clone_run`: whether the
+    `viki.fabric.git.setup_server_for_git_clone` Fabric task has been run;
+    only gathered if the `viki.fabric.git` module is configured
+
+  **NOTE:** This function should not be called from within a Fabric task that
+  is itself being executed for many hosts.
+
+  Args:
+    hosts(list of str, optional): Hosts to gather facts from. Defaults to
+      `env.hosts`
+
+    roles(list of str, optional): Roles whose hosts facts are gathered from.
+      Defaults to `env.roles`
+
+    poolSize(int, optional): Maximum number of hosts to gather facts from
+      concurrently. Defaults to `env.pool_size`
+
+  Returns:
+    dict: A dict whose keys are host strings and whose values are dicts of
+      the facts gathered, or `None` for hosts which timed out or were
+      quarantined (see `viki.fabric.deadlines`)
+
+  >>> gather_facts(hosts=["hostOne", "hostTwo"])
+  {"hostOne": {"home_dir": "/home/ubuntu", ...}, "hostTwo": {...}}
+  """
+  if hosts is None:
+    hosts = env.hosts
+  if roles is None:
+    roles = env.roles
+  taskToExecute = with_deadline()(gather_host_facts.wrapped)
+  if poolSize is not None:
+    taskToExecute = parallel(pool_size=poolSize)(taskToExecute)
+  print(blue("Gathering facts..."))
+  with settings(hide("running", "stdout")):
+    retVal = execute(taskToExecute, hosts=hosts, roles=roles)
+  # results from the parallel subprocesses are written in this process only
+  for (hostString, facts) in retVal.items():
+    if isinstance(facts, dict):
+      set_facts(facts, hostString=hostString, persist=False)
+  _save_inventory()
+  return retVal
+
+def invalidate_facts(factNames=None, hostString=None):
+  """Invalidates facts about a host in the inventory, so that helpers will
+  contact the host to answer questions about them.
+
+  Args:
+    factNames(list of str, optional): Names of the facts to invalidate. If
+      `None`, all facts about the host are invalidated
+
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  >>> invalidate_facts(["installed_packages"])
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if factNames is None:
+    factNames = _load_inventory().get(hostString, {}).keys()
+  # invalidated facts are overwritten with `None` rather than removed, so that
+  # `_save_inventory` does not bring them back from the inventory file
+  set_facts(dict((factName, None) for factName in factNames),
+    hostString=hostString
+  )
@@ -0,0 +1,236 @@
+import collections
+import functools
+import hashlib
+import json
+import pipes
+
+from fabric.api import env
+from fabric.colors import blue
+from fabric.context_managers import hide, settings
+
+from viki.fabric.config import get_module_config
+from viki.fabric.operations import get_state_changing_operation_count, \
+  read_only, run
+from viki.fabric.script import RemoteScript
+
+# Default directory on the server (relative to $HOME) holding the marker files
+# of converged steps; each marker file is named after the step and the hash of
+# its arguments, and holds the hash of the state of the server after the step
+_DEFAULT_REMOTE_DIR = ".viki_fabric_memo"
+
+# Prefix of the names of the facts in the inventory (see
+# `viki.fabric.inventory`) which hold the local copy of the marker files
+_FACT_PREFIX = "memo:"
+
+# Memoized steps, in the order they were registered; the keys are step names
+# and the values are their state commands (strings, or functions returning
+# strings)
+_STEPS = collections.OrderedDict()
+
+# Results of the batched check of each host, keyed by host string; each value
+# is a `(operationCount, stateHashes, markers)` tuple, where `stateHashes` maps
+# step names to the hashes of their current state, and `markers` maps marker
+# names to the state hashes recorded in the marker files. A result is stale
+# once any operation which may change the state of the host has been issued
+# after the check (`operationCount` is the count of such operations just after
+# the check).
+_HOST_CHECKS = {}
+
+def _get_remote_dir():
+  """Returns the shell expression for the directory holding the marker
+  files.
+  """
+  remoteDir = get_module_config("viki.fabric.memo", "remote_dir",
+    _DEFAULT_REMOTE_DIR
+  )
+  return '"$HOME"/{}'.format(pipes.quote(remoteDir))
+
+def _get_state_command(stepName):
+  """Returns the state command of a step for the current host, or `None` if
+  the step has no state command for it.
+  """
+  stateCommand = _STEPS[stepName]
+  if callable(stateCommand):
+    stateCommand = stateCommand()
+  return stateCommand
+
+def _get_state_hash_command(stateCommand):
+  """Returns a shell command which prints the SHA-1 of the output of a state
+  command.
+  """
+  return "{{ {}\n}} 2>/dev/null | sha1sum | cut -c1-40".format(stateCommand)
+
+def _get_marker_name(stepName, args, kwargs):
+  """Returns the name of the marker file of a call of a step."""
+  argsHash = hashlib.sha1(
+    json.dumps([args, kwargs], sort_keys=True, default=repr)
+  ).hexdigest()[:16]
+  return "{}.{}".format(stepName, argsHash)
+
+def _check_host():
+  """Obtains the hashes of the current state of every memoized step and the
+  contents of the marker files of the current host, using a single remote
+  command; the result is reused until an operation which may change the state
+  of the host is issued.
+  """
+  hostString = env.host_string
+  if hostString in _HOST_CHECKS and _HOST_CHECKS[hostString][0] == \
+      get_state_changing_operation_count(hostString):
+    return _HOST_CHECKS[hostString][1:]
+  script = RemoteScript()
+  script.add_step("markers",
+    ("cd {} 2>/dev/null && for f in *; do [ -f \"$f\" ] &&"
+     " echo \"$f $(cat \"$f\")\"; done"
+    ).format(_get_remote_dir()),
+    stopOnFailure=False
+  )
+  for stepName in _STEPS:
+    stateCommand = _get_state_command(stepName)
+    if stateCommand is not None:
+      script.add_step(stepName, _get_state_hash_command(stateCommand),
+        stopOnFailure=False
+      )
+  with read_only():
+    steps = script.run()["steps"]
+  stateHashes = {}
+  for (stepName, stepResult) in steps.items():
+    if stepName != "markers" and stepResult["return_code"] == 0 and \
+        stepResult["output"]:
+      stateHashes[stepName] = stepResult["output"][0].strip()
+  markers = {}
+  for line in steps["markers"]["output"]:
+    fields = line.split()
+    if len(fields) == 2:
+      markers[fields[0]] = fields[1]
+  _HOST_CHECKS[hostString] = (
+    get_state_changing_operation_count(hostString), stateHashes, markers
+  )
+  return (stateHashes, markers)
+
+def _record_step(stepName, markerName):
+  """Writes the marker file of a step which has just run on the current host,
+  holding the hash of the state of the host, and keeps a local copy of it in
+  the inventory.
+  """
+  import viki.fabric.inventory as viki_inventory
+  stateCommand = _get_state_command(stepName)
+  if stateCommand is None:
+    return
+  remoteDir = _get_remote_dir()
+  with settings(hide("everything"), warn_only=True):
+    result = run(
+      ("mkdir -p {0} && h=$({1}) && echo \"$h\" > {0}/{2} && echo \"$h\""
+      ).format(remoteDir, _get_state_hash_command(stateCommand),
+        pipes.quote(markerName)
+      )
+    )
+  if result.succeeded and result.strip():
+    viki_inventory.set_facts({
+      _FACT_PREFIX + markerName: result.strip().splitlines()[-1]
+    })
+
+def _is_memo_enabled():
+  """Returns `False` if memoization is turned off using the `enabled` key of
+  the `viki.fabric.memo` dict in `viki_fabric_config.yml`.
+  """
+  return get_module_config("viki.fabric.memo", "enabled", True)
+
+def converged(stateCommand, name=None):
+  """A decorator which skips calls of a function on hosts where it has already
+  converged: the same function was called with the same arguments, and the
+  state of the host that the function depends on has not changed since.
+
+  The state of a host is the output of `stateCommand`, a cheap shell command
+  (such as listing the installed packages). After the function runs, the hash
+  of the state is recorded in a marker file on the host, and in the inventory
+  (see `viki.fabric.inventory`). Before the first memoized call on a host, the
+  state commands of all memoized functions are run and the marker files are
+  read in a single remote command; the result is reused until an operation
+  which may change the state of the host (see
+  `viki.fabric.operations.get_state_changing_operation_count`) is issued.
+
+  Skipped calls return `None`, so only functions called for their effects
+  should be memoized.
+
+  Args:
+    stateCommand(str or function): The state command, or a function taking no
+      arguments which returns the state command for the current host (or
+      `None` if the function should not be memoized on the host)
+
+    name(str, optional): Name of the memoized step. Defaults to the name of
+      the function in `module.function` format
+
+  >>> @converged("dpkg-query -W -f '${Package} ${Version}\\n' nginx")
+      def setup_nginx():
+        ...
+  """
+  def decorator(f):
+    stepName = name or "{}.{}".format(f.__module__, f.__name__)
+    _STEPS[stepName] = stateCommand
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      if not _is_memo_enabled():
+        return f(*args, **kwargs)
+      import viki.fabric.inventory as viki_inventory
+      markerName = _get_marker_name(stepName, args, kwargs)
+      (stateHashes, markers) = _check_host()
+      stateHash = stateHashes.get(stepName)
+      if stateHash is not None and markers.get(markerName) == stateHash:
+        print(blue("`{}` has converged on `{}`; skipping it".format(stepName,
+          env.host
+        )))
+        factName = _FACT_PREFIX + markerName
+        if viki_inventory.get_fact(factName, maxAge=float("inf")) != stateHash:
+          viki_inventory.set_facts({ factName: stateHash })
+        return None
+      retVal = f(*args, **kwargs)
+      _record_step(stepName, markerName)
+      return retVal
+    return wrapper
+  return decorator
+
+def get_converged_steps(hostString=None):
+  """Returns the steps recorded as converged on a host in the inventory,
+  without contacting the host.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    dict: A dict whose keys are the names of the marker files of the
+      converged steps (`step name.hash of the arguments`) and whose values are
+      the hashes of the state of the host after the steps
+
+  >>> get_converged_steps()
+  {"viki.fabric.helpers.setup_vundle.99914b932bd37a50": "3f2a..."}
+  """
+  import viki.fabric.inventory as viki_inventory
+  ages = viki_inventory.get_fact_ages(hostString)
+  return dict(
+    (factName[len(_FACT_PREFIX):],
+      viki_inventory.get_fact(factName, hostString, maxAge=float("inf")))
+    for factName in ages if factName.startswith(_FACT_PREFIX)
+  )
+
+def forget_converged_steps(hostString=None):
+  """Forgets every step which has converged on a host, both on the host and
+  in the inventory, so that the memoized functions run again there.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  >>> forget_converged_steps()
+  """
+  import viki.fabric.inventory as viki_inventory
+  if hostString is None:
+    hostString = env.host_string
+  with settings(hide("everything"), host_string=hostString, warn_only=True):
+    run("rm -rf {}".format(_get_remote_dir()))
+  _HOST_CHECKS.pop(hostString, None)
+  viki_inventory.invalidate_facts(
+    [_FACT_PREFIX + markerName
+      for markerName in get_converged_steps(hostString)],
+    hostString=hostString
+  )
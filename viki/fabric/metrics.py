@@ -0,0 +1,205 @@
+import json
+import os
+import tempfile
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+  60, 300
+]
+
+# Recorded metrics; a dict whose keys are `(host, helper, operation)` tuples and
+# whose values are dicts as returned by `_new_entry`
+_METRICS = {}
+
+def _new_entry():
+  """Returns the metrics of a `(host, helper, operation)` tuple before any
+  operation is recorded.
+  """
+  return {
+    "count": 0,
+    "failures": 0,
+    "latency_sum": 0.0,
+    # number of operations in each of the `LATENCY_BUCKETS` (not cumulative),
+    # with an extra bucket for operations slower than the last bucket
+    "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+    "bytes_in": 0,
+    "bytes_out": 0,
+  }
+
+def record_operation(host, helper, operation, latency, bytesIn=0, bytesOut=0,
+    failed=False):
+  """Records a remote (or local) operation issued by the library.
+
+  This is called by the wrappers in `viki.fabric.operations`; you should not
+  need to call it yourself.
+
+  Args:
+    host(str): The host the operation was run on
+
+    helper(str): The helper which issued the operation, in `module.function`
+      format
+
+    operation(str): Name of the operation, such as "run" or "put"
+
+    latency(float): Wall time taken by the operation, in seconds
+
+    bytesIn(int, optional): Number of bytes received from the host
+
+    bytesOut(int, optional): Number of bytes sent to the host
+
+    failed(bool, optional): Whether the operation failed
+  """
+  entry = _METRICS.get((host, helper, operation))
+  if entry is None:
+    entry = _METRICS[(host, helper, operation)] = _new_entry()
+  entry["count"] += 1
+  if failed:
+    entry["failures"] += 1
+  entry["latency_sum"] += latency
+  bucketIdx = 0
+  while bucketIdx < len(LATENCY_BUCKETS) and \
+      latency > LATENCY_BUCKETS[bucketIdx]:
+    bucketIdx += 1
+  entry["latency_buckets"][bucketIdx] += 1
+  entry["bytes_in"] += bytesIn
+  entry["bytes_out"] += bytesOut
+
+def get_metrics():
+  """Returns the recorded metrics.
+
+  Returns:
+    list of dict: One dict per `(host, helper, operation)` tuple, with the
+      keys `host`, `helper`, `operation`, `count`, `failures`, `latency_sum`,
+      `latency_buckets`, `bytes_in` and `bytes_out`
+
+  >>> get_metrics()
+  [{'host': 'hostOne', 'helper': 'viki.fabric.helpers.get_home_dir',
+    'operation': 'run', 'count': 1, 'failures': 0, 'latency_sum': 0.21,
+    'latency_buckets': [0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    'bytes_in': 13, 'bytes_out': 52}]
+  """
+  metrics = []
+  for ((host, helper, operation), entry) in sorted(_METRICS.items()):
+    metric = { "host": host, "helper": helper, "operation": operation }
+    metric.update(entry)
+    metric["latency_buckets"] = list(entry["latency_buckets"])
+    metrics.append(metric)
+  return metrics
+
+def reset_metrics():
+  """Discards all recorded metrics."""
+  _METRICS.clear()
+
+def merge_metrics(metrics):
+  """Adds metrics (in the format returned by `get_metrics`) to the recorded
+  metrics.
+
+  This is useful for combining the metrics of Fabric tasks run in parallel,
+  since each host is then handled by a separate process with its own metrics.
+
+  Args:
+    metrics(list of dict): Metrics in the format returned by `get_metrics`
+
+  >>> for path in glob.glob("metrics-*.json"):
+        with open(path, "r") as f:
+          merge_metrics(json.load(f))
+  """
+  for metric in metrics:
+    key = (metric["host"], metric["helper"], metric["operation"])
+    entry = _METRICS.get(key)
+    if entry is None:
+      entry = _METRICS[key] = _new_entry()
+    for k in ["count", "failures", "latency_sum", "bytes_in", "bytes_out"]:
+      entry[k] += metric[k]
+    entry["latency_buckets"] = [a + b for (a, b) in
+      zip(entry["latency_buckets"], metric["latency_buckets"])
+    ]
+
+def _write_atomically(path, contents):
+  """Writes a file atomically, so that readers (such as the Prometheus node
+  exporter) never see a partially written file.
+  """
+  (fd, tmpPath) = tempfile.mkstemp(
+    dir=os.path.dirname(os.path.abspath(path)), prefix=".metrics-"
+  )
+  with os.fdopen(fd, "w") as f:
+    f.write(contents)
+  os.rename(tmpPath, path)
+
+def export_metrics_json(path):
+  """Writes the recorded metrics (in the format returned by `get_metrics`) to a
+  JSON file.
+
+  Args:
+    path(str): Path of the JSON file
+
+  >>> export_metrics_json("metrics-{}.json".format(env.host))
+  """
+  _write_atomically(path, json.dumps(get_metrics(), indent=2, sort_keys=True))
+
+def _escape_label_value(value):
+  """Escapes a Prometheus label value."""
+  return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_metrics_prometheus():
+  """Formats the recorded metrics in the Prometheus text exposition format.
+
+  Returns:
+    str: the recorded metrics in the Prometheus text exposition format
+  """
+  lines = []
+  def _add_family(name, metricType, helpText):
+    lines.append("# HELP {} {}".format(name, helpText))
+    lines.append("# TYPE {} {}".format(name, metricType))
+  def _labels(metric, extra=""):
+    return "host=\"{}\",helper=\"{}\",operation=\"{}\"{}".format(
+      _escape_label_value(metric["host"]),
+      _escape_label_value(metric["helper"]),
+      _escape_label_value(metric["operation"]),
+      extra
+    )
+
+  metrics = get_metrics()
+  for (name, key, helpText) in [
+      ("viki_fabric_operations_total", "count",
+        "Number of operations issued by viki.fabric helpers"),
+      ("viki_fabric_operation_failures_total", "failures",
+        "Number of failed operations issued by viki.fabric helpers"),
+      ("viki_fabric_operation_bytes_in_total", "bytes_in",
+        "Bytes received from hosts by viki.fabric operations"),
+      ("viki_fabric_operation_bytes_out_total", "bytes_out",
+        "Bytes sent to hosts by viki.fabric operations")]:
+    _add_family(name, "counter", helpText)
+    for metric in metrics:
+      lines.append("{}{{{}}} {}".format(name, _labels(metric), metric[key]))
+
+  name = "viki_fabric_operation_duration_seconds"
+  _add_family(name, "histogram",
+    "Latency of operations issued by viki.fabric helpers"
+  )
+  for metric in metrics:
+    cumulativeCount = 0
+    for (upperBound, count) in zip(LATENCY_BUCKETS + ["+Inf"],
+        metric["latency_buckets"]):
+      cumulativeCount += count
+      lines.append("{}_bucket{{{}}} {}".format(name,
+        _labels(metric, ",le=\"{}\"".format(upperBound)), cumulativeCount
+      ))
+    lines.append("{}_sum{{{}}} {}".format(name, _labels(metric),
+      metric["latency_sum"]
+    ))
+    lines.append("{}_count{{{}}} {}".format(name, _labels(metric),
+      metric["count"]
+    ))
+  return "\n".join(lines) + "\n"
+
+def export_metrics_prometheus(path):
+  """Writes the recorded metrics to a Prometheus textfile (for the textfile
+  collector of the Prometheus node exporter).
+
+  Args:
+    path(str): Path of the textfile; this should end with `.prom`
+
+  >>> export_metrics_prometheus("/var/lib/node_exporter/viki_fabric.prom")
+  """
+  _write_atomically(path, format_metrics_prometheus())
@@ -0,0 +1,273 @@
+# Wrappers around the Fabric operations used by the `viki.fabric` modules.
+#
+# Every remote (and local) operation the library issues goes through this
+# module, so that it can be instrumented in a single place, and dispatched to
+# the execution backend of the host (see `viki.fabric.backends`). The wrappers
+# take the same arguments and return the same values as the Fabric operations
+# they wrap.
+
+import collections
+import contextlib
+import json
+import os.path
+import sys
+import time
+
+from fabric import operations as fabric_operations
+from fabric.api import env
+from fabric.context_managers import settings
+from fabric.exceptions import CommandTimeout, NetworkError
+
+from viki.fabric.backends import get_backend
+from viki.fabric.deadlines import check_not_quarantined, get_command_timeout, \
+  quarantine_host, record_connection_failure
+from viki.fabric.metrics import record_operation
+from viki.fabric.tracing import span
+
+# Modules of the `viki.fabric` package whose functions are not helpers, when
+# determining which helper issued an operation
+_NON_HELPER_MODULES = frozenset([
+  "viki.fabric.operations", "viki.fabric.metrics", "viki.fabric.tracing"
+])
+
+# Number of operations which may change the state of a host (`run`, `sudo`,
+# `put`, `upload_template` and commands run through the agent) issued on each
+# host, keyed by host string
+_STATE_CHANGING_OPERATION_COUNTS = collections.Counter()
+
+# Names of the operations counted in `_STATE_CHANGING_OPERATION_COUNTS`
+_STATE_CHANGING_OPERATIONS = frozenset([
+  "run", "sudo", "put", "upload_template", "agent_exec"
+])
+
+# Names of the operations running shell commands on a host
+_COMMAND_OPERATIONS = frozenset(["run", "sudo", "agent_exec"])
+
+# Key of `fabric.api.env` which is `True` while the commands issued are known
+# not to change the state of the host (see `read_only`)
+_READ_ONLY_ENV_KEY = "viki_fabric_read_only"
+
+@contextlib.contextmanager
+def read_only():
+  """Context manager; declares that the commands issued within it do not
+  change the state of the host, so that they are not counted by
+  `get_state_changing_operation_count` and do not drop the stat cache of the
+  host (see `viki.fabric.statcache`). Other commands may write anywhere on the
+  host, so they drop the whole stat cache.
+
+  >>> with read_only():
+        run("dpkg-query -W nginx")
+  """
+  with settings(**{_READ_ONLY_ENV_KEY: True}):
+    yield
+
+def get_state_changing_operation_count(hostString=None):
+  """Returns the number of operations which may have changed the state of a
+  host (`run`, `sudo`, `put`, `upload_template` and commands run through the
+  agent of `viki.fabric.agent`, except for commands issued within `read_only`)
+  issued on it so far; use it to find out whether anything may have changed on
+  a host since an earlier point in time.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    int: the number of operations
+  """
+  if hostString is None:
+    hostString = env.host_string
+  return _STATE_CHANGING_OPERATION_COUNTS[hostString]
+
+def _get_calling_helper():
+  """Returns the outermost public function of the `viki.fabric` package in the
+  call stack (in `module.function` format), which is the helper the caller of
+  the library invoked, or "<direct>" if there is none.
+  """
+  helper = "<direct>"
+  frame = sys._getframe(1)
+  while frame is not None:
+    moduleName = frame.f_globals.get("__name__", "")
+    functionName = frame.f_code.co_name
+    # private functions and decorator wrappers are not helpers
+    if moduleName.startswith("viki.fabric.") and \
+        moduleName not in _NON_HELPER_MODULES and \
+        not functionName.startswith("_") and functionName != "wrapper":
+      helper = "{}.{}".format(moduleName, functionName)
+    frame = frame.f_back
+  return helper
+
+def _get_file_size(fileOrPath):
+  """Returns the size of a local file given its path or a file-like object, or
+  0 if it cannot be determined.
+  """
+  try:
+    if isinstance(fileOrPath, basestring):
+      return os.path.getsize(fileOrPath)
+    elif hasattr(fileOrPath, "getvalue"):
+      return len(fileOrPath.getvalue())
+  except OSError:
+    pass
+  return 0
+
+def _get_output_size(result):
+  """Returns the number of bytes of output of a `run`, `sudo` or `local`."""
+  if result is None:
+    return 0
+  return len(result) + len(getattr(result, "stderr", None) or "")
+
+def _get_statcache():
+  """Returns the `viki.fabric.statcache` module."""
+  # imported here because `viki.fabric.statcache` imports this module
+  import viki.fabric.statcache as viki_statcache
+  return viki_statcache
+
+def _record_remote_write(result, remotePath, localName):
+  """Updates the stat cache of the current host after a `put` or
+  `upload_template` to `remotePath`.
+  """
+  viki_statcache = _get_statcache()
+  if getattr(result, "failed", None):
+    viki_statcache.invalidate_remote_paths([remotePath])
+  else:
+    viki_statcache.record_remote_write(remotePath, localName)
+
+# Maximum length of the description of an operation in the name of its span
+_MAX_SPAN_DESCRIPTION_LEN = 80
+
+def _call(operation, description, fabricFunction, host, bytesOut, getBytesIn,
+    args, kwargs):
+  """Calls a Fabric operation, records its metrics, and records a span for it
+  if tracing is enabled. Operations other than `local` fail on quarantined
+  hosts, and quarantine the host if they time out (see
+  `viki.fabric.deadlines`).
+
+  Args:
+    operation(str): Name of the operation
+
+    description(str): The command or path the operation acts on
+
+    fabricFunction(function): The Fabric operation
+
+    host(str): The host the operation runs on
+
+    bytesOut(int): Number of bytes sent to the host
+
+    getBytesIn(function): Function which takes the return value of the
+      operation and returns the number of bytes received from the host
+
+    args(tuple): Positional arguments for the Fabric operation
+
+    kwargs(dict): Keyword arguments for the Fabric operation
+  """
+  if operation != "local":
+    # fail fast on quarantined hosts, and bound commands by the configured
+    # command timeout and the deadline of the running task
+    check_not_quarantined(host)
+    if operation in _COMMAND_OPERATIONS and kwargs.get("timeout") is None:
+      timeout = get_command_timeout()
+      if timeout is not None:
+        kwargs = dict(kwargs, timeout=timeout)
+  helper = _get_calling_helper()
+  readOnly = operation in _COMMAND_OPERATIONS and env.get(_READ_ONLY_ENV_KEY)
+  if operation in _STATE_CHANGING_OPERATIONS and not readOnly:
+    _STATE_CHANGING_OPERATION_COUNTS[host] += 1
+  if operation in _COMMAND_OPERATIONS and not readOnly:
+    # commands may write anywhere on the host
+    _get_statcache().invalidate_remote_paths(hostString=host)
+  start = time.time()
+  failed = True
+  bytesIn = 0
+  spanName = "{} {}".format(operation,
+    description[:_MAX_SPAN_DESCRIPTION_LEN]
+  )
+  try:
+    with span(spanName, host=host):
+      result = fabricFunction(*args, **kwargs)
+    failed = bool(getattr(result, "failed", False))
+    bytesIn = getBytesIn(result)
+    return result
+  except CommandTimeout:
+    if operation != "local":
+      quarantine_host("`{}` timed out after {:.1f} seconds".format(
+        description[:_MAX_SPAN_DESCRIPTION_LEN], kwargs.get("timeout") or 0
+      ), hostString=host)
+    raise
+  except NetworkError:
+    record_connection_failure(host)
+    raise
+  finally:
+    record_operation(host, helper, operation, time.time() - start,
+      bytesIn=bytesIn, bytesOut=bytesOut, failed=failed
+    )
+
+# The wrappers below dispatch to the execution backend of the current host
+# (see `viki.fabric.backends.get_backend`), except for `local`
+
+def run(command, *args, **kwargs):
+  """Wrapper around `fabric.operations.run`."""
+  return _call("run", command, get_backend().run, env.host_string,
+    len(command), _get_output_size, (command,) + args, kwargs
+  )
+
+def sudo(command, *args, **kwargs):
+  """Wrapper around `fabric.operations.sudo`."""
+  return _call("sudo", command, get_backend().sudo, env.host_string,
+    len(command), _get_output_size, (command,) + args, kwargs
+  )
+
+def local(command, *args, **kwargs):
+  """Wrapper around `fabric.operations.local`."""
+  return _call("local", command, fabric_operations.local, "localhost",
+    len(command), _get_output_size, (command,) + args, kwargs
+  )
+
+def get(remote_path, *args, **kwargs):
+  """Wrapper around `fabric.operations.get`."""
+  def _get_bytes_in(result):
+    return sum(_get_file_size(p) for p in (result or []))
+  return _call("get", remote_path, get_backend().get, env.host_string,
+    len(remote_path), _get_bytes_in, (remote_path,) + args, kwargs
+  )
+
+def put(local_path=None, *args, **kwargs):
+  """Wrapper around `fabric.operations.put`."""
+  remotePath = kwargs.get("remote_path", args[0] if args else "")
+  result = _call("put", str(remotePath), get_backend().put, env.host_string,
+    _get_file_size(local_path), lambda result: 0, (local_path,) + args, kwargs
+  )
+  if isinstance(remotePath, basestring):
+    _record_remote_write(result, remotePath, local_path)
+  return result
+
+def exists(path, *args, **kwargs):
+  """Wrapper around `fabric.contrib.files.exists`."""
+  return _call("exists", path, get_backend().exists, env.host_string,
+    len(path), lambda result: 0, (path,) + args, kwargs
+  )
+
+def upload_template(filename, destination, *args, **kwargs):
+  """Wrapper around `fabric.contrib.files.upload_template`."""
+  templateDir = kwargs.get("template_dir")
+  if templateDir is None and len(args) >= 3:
+    templateDir = args[2]
+  result = _call("upload_template", destination,
+    get_backend().upload_template, env.host_string,
+    _get_file_size(os.path.join(templateDir or "", filename)),
+    lambda result: 0, (filename, destination) + args, kwargs
+  )
+  _record_remote_write(result, destination, filename)
+  return result
+
+def agent_request(agent, method, params):
+  """Sends a request to the agent of a host (see `viki.fabric.agent`); the
+  operation is named after the method, such as `agent_stat`.
+  """
+  description = params.get("command") or params.get("path") or \
+    " ".join(params.get("paths") or params.get("packages") or [method])
+  def _send(**kwargs):
+    return agent.request(method, **kwargs)
+  return _call("agent_" + method, description, _send, agent.hostString,
+    len(json.dumps(params)), lambda result: agent.lastResponseSize, (),
+    params
+  )
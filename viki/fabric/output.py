@@ -0,0 +1,298 @@
+import collections
+import contextlib
+import os
+import os.path
+import Queue
+import re
+import shutil
+import tempfile
+import threading
+
+from fabric.api import env
+
+from viki.fabric.config import get_module_config
+
+# Default directory holding the per-host log files, one subdirectory per run
+# (see `viki.fabric.deadlines.get_run_id`), in the temporary directory of the
+# user. Relative paths given in the config are relative to the directory where
+# the main Python script is run
+_DEFAULT_LOG_DIR = os.path.join(tempfile.gettempdir(),
+  "viki_fabric_logs-{}".format(os.getuid())
+)
+
+# Default number of runs whose log directories are kept; the oldest ones are
+# removed when a new run starts writing to the log directory
+_DEFAULT_MAX_RUNS = 10
+
+# Default number of lines kept in memory from the start and from the end of
+# the output of a command
+_DEFAULT_HEAD_LINES = 20
+_DEFAULT_TAIL_LINES = 50
+
+# Characters which are replaced in host strings to form log file names
+_UNSAFE_FILE_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+class _LogWriter(object):
+  """Appends the output written to `OutputSink`s to their log files in a
+  background thread, so that the threads receiving output are never held up by
+  disk writes. There is one `_LogWriter` per process.
+  """
+
+  def __init__(self):
+    self._queue = Queue.Queue()
+    self._thread = None
+    self._lock = threading.Lock()
+
+  def _ensure_started(self):
+    with self._lock:
+      # processes forked by a parallel run do not inherit the thread
+      if self._thread is None or not self._thread.is_alive():
+        self._thread = threading.Thread(target=self._loop,
+          name="viki.fabric.output"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+  def _loop(self):
+    while True:
+      (f, data, doneEvent) = self._queue.get()
+      if data:
+        f.write(data)
+      if doneEvent is not None:
+        f.flush()
+        doneEvent.set()
+
+  def write(self, f, data):
+    self._ensure_started()
+    self._queue.put((f, data, None))
+
+  def flush(self, f):
+    """Blocks until everything written to `f` so far is on disk."""
+    self._ensure_started()
+    doneEvent = threading.Event()
+    self._queue.put((f, None, doneEvent))
+    doneEvent.wait()
+
+_LOG_WRITER = _LogWriter()
+
+def get_log_path(streamName, hostString=None):
+  """Returns the path of the log file holding a stream of output of a host in
+  the current run.
+
+  Args:
+    streamName(str): "stdout" or "stderr"
+
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    str: path of the log file
+
+  >>> get_log_path("stdout")
+  "/tmp/viki_fabric_logs-1000/4242-1414141414141/ubuntu_hostOne_22.stdout.log"
+  """
+  from viki.fabric.deadlines import get_run_id
+  if hostString is None:
+    hostString = env.host_string
+  logDir = get_module_config("viki.fabric.output", "log_dir", _DEFAULT_LOG_DIR)
+  return os.path.join(logDir, get_run_id(), "{}.{}.log".format(
+    _UNSAFE_FILE_NAME_CHARS.sub("_", hostString or "local"), streamName
+  ))
+
+def _prune_run_log_dirs(runLogDir):
+  """Removes the log directories of the oldest runs, so that at most
+  `max_runs` of them (including the current one) are kept.
+  """
+  maxRuns = get_module_config("viki.fabric.output", "max_runs",
+    _DEFAULT_MAX_RUNS
+  )
+  logDir = os.path.dirname(runLogDir)
+  otherRunLogDirs = []
+  for name in os.listdir(logDir):
+    path = os.path.join(logDir, name)
+    if path == runLogDir:
+      continue
+    try:
+      if os.path.isdir(path):
+        otherRunLogDirs.append((os.path.getmtime(path), path))
+    except OSError:
+      # removed by another run in the meantime
+      pass
+  otherRunLogDirs.sort()
+  for (_, path) in otherRunLogDirs[:max(0, len(otherRunLogDirs) - maxRuns + 1)]:
+    shutil.rmtree(path, ignore_errors=True)
+
+class OutputSink(object):
+  """A file-like object which receives the output of a command on a host (pass
+  it as the `stdout` or `stderr` argument of `run` or `sudo`), appends it to
+  the log file of the host asynchronously, and only keeps the first and last
+  lines of it in memory.
+
+  The full output can be streamed back from the log file using `iter_lines`.
+
+  Args:
+    streamName(str): "stdout" or "stderr"
+
+    hostString(str, optional): The host the output comes from. Defaults to
+      `env.host_string`
+
+    headLines(int, optional): Number of lines kept from the start of the
+      output. Defaults to the `head_lines` key of the `viki.fabric.output` dict
+      in `viki_fabric_config.yml`, or 20 if that key is absent
+
+    tailLines(int, optional): Number of lines kept from the end of the output.
+      Defaults to the `tail_lines` key of the `viki.fabric.output` dict in
+      `viki_fabric_config.yml`, or 50 if that key is absent
+
+  >>> with capture_output() as (stdoutSink, stderrSink):
+        run("apt-get upgrade -y", stdout=stdoutSink, stderr=stderrSink)
+  >>> print(stdoutSink.summary())
+  """
+
+  def __init__(self, streamName, hostString=None, headLines=None,
+      tailLines=None):
+    if hostString is None:
+      hostString = env.host_string
+    if headLines is None:
+      headLines = get_module_config("viki.fabric.output", "head_lines",
+        _DEFAULT_HEAD_LINES
+      )
+    if tailLines is None:
+      tailLines = get_module_config("viki.fabric.output", "tail_lines",
+        _DEFAULT_TAIL_LINES
+      )
+    self.hostString = hostString
+    self.streamName = streamName
+    self.path = get_log_path(streamName, hostString)
+    logDir = os.path.dirname(self.path)
+    if not os.path.isdir(logDir):
+      try:
+        os.makedirs(logDir)
+      except OSError:
+        # created by another process of a parallel run in the meantime
+        if not os.path.isdir(logDir):
+          raise
+      else:
+        _prune_run_log_dirs(logDir)
+    self._file = open(self.path, "ab")
+    # the output of this sink starts at the current end of the log file, as
+    # earlier sinks of the host have been closed
+    self._file.seek(0, os.SEEK_END)
+    self._startOffset = self._file.tell()
+    self._size = 0
+    self._headLines = headLines
+    self._head = []
+    self._tail = collections.deque(maxlen=tailLines)
+    self._partialLine = ""
+    self.lineCount = 0
+    self.closed = False
+
+  def _add_line(self, line):
+    self.lineCount += 1
+    if len(self._head) < self._headLines:
+      self._head.append(line)
+    else:
+      self._tail.append(line)
+
+  def write(self, data):
+    if not data:
+      return
+    _LOG_WRITER.write(self._file, data)
+    self._size += len(data)
+    lines = (self._partialLine + data).split("\n")
+    self._partialLine = lines.pop()
+    for line in lines:
+      self._add_line(line.rstrip("\r"))
+
+  def flush(self):
+    # Fabric flushes its output streams after every chunk; waiting for the
+    # background thread each time would hold up the command, so the log file
+    # is only flushed by `close` and `iter_lines`
+    pass
+
+  def close(self):
+    """Finishes writing the output to the log file."""
+    if self.closed:
+      return
+    if self._partialLine:
+      self._add_line(self._partialLine.rstrip("\r"))
+      self._partialLine = ""
+    _LOG_WRITER.flush(self._file)
+    self._file.close()
+    self.closed = True
+
+  def head(self):
+    """Returns the first lines of the output (see `headLines`)."""
+    return list(self._head)
+
+  def tail(self):
+    """Returns the last lines of the output (see `tailLines`) which are not
+    among the first lines.
+    """
+    return list(self._tail)
+
+  def summary(self):
+    """Returns the first and last lines of the output, separated by a line
+    with the number of lines omitted, if any.
+
+    Returns:
+      str: the summary
+    """
+    lines = self.head()
+    omittedLines = self.lineCount - len(self._head) - len(self._tail)
+    if omittedLines > 0:
+      lines.append("... {} lines omitted (see {}) ...".format(omittedLines,
+        self.path
+      ))
+    lines.extend(self._tail)
+    return "\n".join(lines)
+
+  def iter_lines(self):
+    """Streams the output back from the log file, one line (without the line
+    terminator) at a time, without holding it all in memory.
+
+    Yields:
+      str: the lines of the output
+    """
+    if not self.closed:
+      _LOG_WRITER.flush(self._file)
+    with open(self.path, "rb") as f:
+      f.seek(self._startOffset)
+      remaining = self._size
+      partialLine = ""
+      while remaining > 0:
+        chunk = f.read(min(remaining, 65536))
+        if not chunk:
+          break
+        remaining -= len(chunk)
+        lines = (partialLine + chunk).split("\n")
+        partialLine = lines.pop()
+        for line in lines:
+          yield line.rstrip("\r")
+      if partialLine:
+        yield partialLine.rstrip("\r")
+
+@contextlib.contextmanager
+def capture_output(hostString=None, headLines=None, tailLines=None):
+  """Context manager which provides a pair of `OutputSink`s for the stdout
+  and stderr of commands on a host, and closes them on exit.
+
+  Args:
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+    headLines(int, optional): See `OutputSink`
+
+    tailLines(int, optional): See `OutputSink`
+
+  >>> with capture_output() as (stdoutSink, stderrSink):
+        run("make test", stdout=stdoutSink, stderr=stderrSink)
+  >>> failures = [l for l in stdoutSink.iter_lines() if "FAIL" in l]
+  """
+  stdoutSink = OutputSink("stdout", hostString, headLines, tailLines)
+  stderrSink = OutputSink("stderr", hostString, headLines, tailLines)
+  try:
+    yield (stdoutSink, stderrSink)
+  finally:
+    stdoutSink.close()
+    stderrSink.close()
@@ -0,0 +1,281 @@
+import collections
+import contextlib
+import pipes
+import re
+import uuid
+
+from fabric.context_managers import hide, settings
+
+from viki.fabric.operations import run, sudo
+from viki.fabric.tracing import traced
+
+# Shell variable which is set to 1 once a step which stops the script has
+# failed; the remaining steps are then skipped
+_FAILED_VARIABLE = "__viki_script_failed"
+
+# Matches a path starting with a `~`, `~user`, `$HOME` or `${HOME}` component,
+# and captures that component and the rest of the path
+_HOME_PREFIX_RE = re.compile(r"^(~[\w.-]*|\$HOME|\$\{HOME\})(?:/(.*))?$", re.S)
+
+def _get_return_code_variable(idx):
+  """Returns the name of the shell variable holding the exit code of a step."""
+  return "__viki_script_rc_{}".format(idx)
+
+def quote_path(path):
+  """Quotes a path for the shell like `pipes.quote`, but leaves a leading `~`
+  or `$HOME` component (which `viki.fabric.helpers.get_home_dir` may return)
+  where the shell still expands it.
+
+  Args:
+    path(str): Path on the server
+
+  Returns:
+    str: the quoted path
+
+  >>> quote_path("~/my repo")
+  "~/'my repo'"
+  >>> quote_path("$HOME/.vim")
+  '"$HOME"/.vim'
+  """
+  m = _HOME_PREFIX_RE.match(path)
+  if m is None:
+    return pipes.quote(path)
+  (homeDir, rest) = m.groups()
+  if homeDir.startswith("$"):
+    homeDir = '"{}"'.format(homeDir)
+  if rest is None:
+    return homeDir
+  # the slash must stay unquoted for the `~` to be expanded
+  return "{}/{}".format(homeDir, pipes.quote(rest) if rest else "")
+
+class RemoteScript(object):
+  """Builds a shell script out of a sequence of steps, and runs it on the
+  server in a single remote command, instead of issuing one remote command per
+  step.
+
+  Each step is a shell command, run in a subshell (so that it cannot affect
+  the steps after it) with its stderr redirected to its stdout. A step can be
+  made conditional on a shell condition, and run from a given directory. By
+  default, the steps after a failed step are skipped.
+
+  >>> script = RemoteScript()
+  >>> script.add_step("clone", "git clone {} repo".format(url),
+        condition="[ ! -d repo ]"
+      )
+  >>> with script.cd("repo"):
+        script.add_step("update", "git remote update")
+        script.add_step("checkout", "git checkout master")
+  >>> result = script.run()
+  >>> result["steps"]["clone"]["ran"]
+  False
+  """
+
+  def __init__(self):
+    # list of `(name, command, condition, cwd, stopOnFailure)` tuples
+    self._steps = []
+    # names of the steps, to their index in `self._steps`
+    self._stepIndexes = {}
+    # directories and conditions of the enclosing `cd` and `when` blocks
+    self._cwdStack = []
+    self._conditionStack = []
+
+  def add_step(self, name, command, condition=None, stopOnFailure=True):
+    """Adds a step to the script.
+
+    Args:
+      name(str): Name of the step; it must be unique within the script
+
+      command(str): Shell command of the step
+
+      condition(str, optional): Shell command which decides whether the step
+        is run; the step is only run if it exits with 0. It is combined with
+        the conditions of the enclosing `when` blocks
+
+      stopOnFailure(bool, optional): If `True` (the default), the steps after
+        this step are skipped if it fails. Use `False` for steps whose failure
+        is informative, such as checking for a file
+
+    Returns:
+      str: the name of the step
+    """
+    if name in self._stepIndexes:
+      raise ValueError("RemoteScript already has a step named `{}`".format(
+        name
+      ))
+    conditions = list(self._conditionStack)
+    if condition is not None:
+      conditions.append(condition)
+    cwd = self._cwdStack[-1] if self._cwdStack else None
+    self._stepIndexes[name] = len(self._steps)
+    self._steps.append((name, command, conditions, cwd, stopOnFailure))
+    return name
+
+  @contextlib.contextmanager
+  def cd(self, path):
+    """Context manager; the steps added within it are run from `path`. Nested
+    relative paths are relative to the enclosing path, as with Fabric's `cd`.
+
+    Args:
+      path(str): Directory on the server
+    """
+    if self._cwdStack and not path.startswith("/") and \
+        _HOME_PREFIX_RE.match(path) is None:
+      path = "{}/{}".format(self._cwdStack[-1], path)
+    self._cwdStack.append(path)
+    try:
+      yield
+    finally:
+      self._cwdStack.pop()
+
+  @contextlib.contextmanager
+  def when(self, condition):
+    """Context manager; the steps added within it are only run if the shell
+    command `condition` exits with 0 (when the step is about to run).
+
+    Args:
+      condition(str): Shell command
+    """
+    self._conditionStack.append(condition)
+    try:
+      yield
+    finally:
+      self._conditionStack.pop()
+
+  def succeeded(self, name):
+    """Returns a shell condition which is true if a step added earlier was run
+    and succeeded; use it as the `condition` of a later step.
+
+    Args:
+      name(str): Name of the step
+
+    Returns:
+      str: the shell condition
+    """
+    return '[ "${{{}:-1}}" -eq 0 ]'.format(
+      _get_return_code_variable(self._stepIndexes[name])
+    )
+
+  def failed(self, name):
+    """Returns a shell condition which is true if a step added earlier was run
+    and failed; use it as the `condition` of a later step.
+
+    Args:
+      name(str): Name of the step
+
+    Returns:
+      str: the shell condition
+    """
+    return '[ "${{{}:-0}}" -ne 0 ]'.format(
+      _get_return_code_variable(self._stepIndexes[name])
+    )
+
+  def render(self, marker):
+    """Returns the shell script.
+
+    Args:
+      marker(str): Token printed at the start and end of each step, and for
+        each skipped step, to delimit the output of the steps
+
+    Returns:
+      str: the shell script
+    """
+    lines = ["{}=0".format(_FAILED_VARIABLE)]
+    for (idx, (name, command, conditions, cwd, stopOnFailure)) in \
+        enumerate(self._steps):
+      returnCodeVariable = _get_return_code_variable(idx)
+      testList = ["[ ${} -eq 0 ]".format(_FAILED_VARIABLE)]
+      testList.extend("{{ {}; }} >/dev/null 2>&1".format(c) for c in conditions)
+      if cwd is not None:
+        command = "cd {} && {}".format(quote_path(cwd), command)
+      lines.append("if {}; then".format(" && ".join(testList)))
+      lines.append("  echo '{} begin {}'".format(marker, idx))
+      lines.append("  ( {}\n  ) 2>&1".format(command))
+      lines.append("  {}=$?".format(returnCodeVariable))
+      lines.append("  echo '{} end {} '${}".format(marker, idx,
+        returnCodeVariable
+      ))
+      if stopOnFailure:
+        lines.append("  [ ${} -eq 0 ] || {}=1".format(returnCodeVariable,
+          _FAILED_VARIABLE
+        ))
+      lines.append("else")
+      lines.append("  echo '{} skip {}'".format(marker, idx))
+      lines.append("fi")
+    lines.append("exit ${}".format(_FAILED_VARIABLE))
+    return "\n".join(lines)
+
+  def _parse_output(self, output, marker):
+    """Splits the output of the script into the results of its steps."""
+    steps = collections.OrderedDict(
+      (step[0], { "ran": False, "return_code": None, "output": [] })
+      for step in self._steps
+    )
+    names = [step[0] for step in self._steps]
+    currentOutput = None
+    for line in output.splitlines():
+      markerIdx = line.find(marker)
+      if markerIdx == -1:
+        if currentOutput is not None:
+          currentOutput.append(line)
+        continue
+      # output of a step which does not end with a newline is followed by the
+      # marker on the same line
+      if markerIdx > 0 and currentOutput is not None:
+        currentOutput.append(line[:markerIdx])
+      fields = line[markerIdx + len(marker):].split()
+      stepResult = steps[names[int(fields[1])]]
+      if fields[0] == "begin":
+        stepResult["ran"] = True
+        currentOutput = stepResult["output"]
+      elif fields[0] == "end":
+        stepResult["return_code"] = int(fields[2])
+        currentOutput = None
+    return steps
+
+  @traced
+  def run(self, useSudo=False, showOutput=False):
+    """Runs the script on the server, in a single remote command.
+
+    Args:
+      useSudo(bool, optional): If `True`, the script is run using `sudo`
+
+      showOutput(bool, optional): If `True`, the output of the script is
+        printed as it runs. Defaults to `False`
+
+    Returns:
+      dict: with the keys `succeeded` (`True` if no step which stops the script
+        failed), `failed_step` (name of the step which stopped the script, or
+        `None`)
+        and `steps`, an `OrderedDict` of the step names (in the order they
+        were added) to dicts with the keys `ran` (whether the step was run),
+        `return_code` (exit code of the step, or `None` if it was not run) and
+        `output` (list of lines of output of the step)
+
+    >>> script.run()
+    { "succeeded": True, "failed_step": None,
+      "steps": OrderedDict([
+        ("clone", { "ran": False, "return_code": None, "output": [] }),
+        ("update", { "ran": True, "return_code": 0, "output": [
+          "Fetching origin"
+        ]}),
+        ...
+      ])
+    }
+    """
+    marker = "viki-script-{}".format(uuid.uuid4().hex)
+    hiddenGroups = ["running", "warnings"] if showOutput \
+      else ["running", "warnings", "stdout"]
+    with settings(hide(*hiddenGroups), warn_only=True):
+      result = (sudo if useSudo else run)(self.render(marker))
+    steps = self._parse_output(result, marker)
+    failedStep = None
+    for (name, command, conditions, cwd, stopOnFailure) in self._steps:
+      if stopOnFailure and steps[name]["ran"] and \
+          steps[name]["return_code"] != 0:
+        failedStep = name
+        break
+    return {
+      "succeeded": result.succeeded,
+      "failed_step": failedStep,
+      "steps": steps,
+    }
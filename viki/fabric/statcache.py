@@ -0,0 +1,302 @@
+import collections
+import posixpath
+
+from fabric.api import env
+from fabric.context_managers import hide, settings
+
+from viki.fabric.agent import get_agent
+from viki.fabric.config import get_module_config
+from viki.fabric.operations import exists, read_only, run
+from viki.fabric.script import quote_path
+
+# Default maximum number of entries of a directory listed when prefetching it;
+# larger directories are only partially cached
+_DEFAULT_MAX_PREFETCH_ENTRIES = 1000
+
+# Characters which make a path unsuitable for caching, as the shell would
+# expand them
+_UNCACHEABLE_PATH_CHARS = frozenset("$`~*?[\\\n\"'")
+
+# Token printed after the listing of a directory, followed by the exit code of
+# `find`
+_FIND_RETURN_CODE_TOKEN = "viki-statcache-rc"
+
+# Types of the paths of each host, keyed by host string; the values are dicts
+# mapping absolute paths to the type of the file they refer to (after
+# following symbolic links) as printed by `find -printf %Y`, such as "f" or
+# "d", or `None` if the path does not exist
+_PATH_TYPES = {}
+
+# Directories of each host, keyed by host string, whose entries are all in
+# `_PATH_TYPES`; paths in them which are not in `_PATH_TYPES` do not exist
+_COMPLETE_DIRS = {}
+
+# Number of lookups answered from the cache (`hits`), lookups which needed a
+# remote command (`misses`), and directories listed (`prefetches`)
+_STATS = collections.Counter()
+
+def _normalize_path(path):
+  """Returns the normalized form of a path if it can be cached (it is
+  absolute and has no characters the shell would expand), `None` otherwise.
+  """
+  if not path.startswith("/") or _UNCACHEABLE_PATH_CHARS.intersection(path):
+    return None
+  # `normpath` keeps a leading "//"
+  return "/" + posixpath.normpath(path).lstrip("/")
+
+def _lookup(hostString, path):
+  """Looks up the type of a normalized path in the cache.
+
+  Returns:
+    tuple: `(True, type)` if the cache knows the path (`type` being `None` if
+      the path does not exist), `(False, None)` otherwise
+  """
+  pathTypes = _PATH_TYPES.get(hostString, {})
+  if path in pathTypes:
+    return (True, pathTypes[path])
+  parentDir = posixpath.dirname(path)
+  if parentDir == path:
+    return (False, None)
+  if parentDir in _COMPLETE_DIRS.get(hostString, ()):
+    return (True, None)
+  # nothing exists under a path which does not exist or is not a directory
+  if parentDir in pathTypes and pathTypes[parentDir] != "d":
+    return (True, None)
+  return (False, None)
+
+def _prefetch_using_agent(agent, hostString, dirPath, maxEntries):
+  """Caches the type of a directory and of all its entries, using a single
+  request to the agent of the host (see `viki.fabric.agent`).
+  """
+  with settings(host_string=hostString):
+    listing = agent.call("list_dir", path=dirPath, limit=maxEntries)
+  _STATS["prefetches"] += 1
+  pathTypes = _PATH_TYPES.setdefault(hostString, {})
+  entryPrefix = dirPath.rstrip("/") + "/"
+  for (name, entryType) in listing["entries"].items():
+    pathTypes[entryPrefix + name] = entryType
+  pathTypes[dirPath] = listing["type"]
+  if listing["type"] == "d" and listing["complete"]:
+    _COMPLETE_DIRS.setdefault(hostString, set()).add(dirPath)
+
+def _prefetch(hostString, dirPath):
+  """Caches the type of a directory and of all its entries, using a single
+  remote command, or a single request to the agent of the host if it has one.
+  """
+  maxEntries = get_module_config("viki.fabric.statcache",
+    "max_prefetch_entries", _DEFAULT_MAX_PREFETCH_ENTRIES
+  )
+  agent = get_agent(hostString)
+  if agent is not None:
+    _prefetch_using_agent(agent, hostString, dirPath, maxEntries)
+    return
+  # the directory itself is listed first, then its entries, each with its type
+  # after and before following symbolic links; the exit code of `find` is only
+  # printed if the listing is not truncated. `-H` lists the entries of a
+  # symbolic link to a directory, like the agent does; without it only the link
+  # itself would be listed
+  with settings(hide("everything"), read_only(), host_string=hostString,
+      warn_only=True):
+    result = run(
+      ("{{ find -H {} -maxdepth 1 -printf '%Y%y %p\\n' 2>/dev/null;"
+       " echo \"{} $?\"; }} | head -n {}").format(quote_path(dirPath),
+        _FIND_RETURN_CODE_TOKEN, maxEntries + 2
+      )
+    )
+  _STATS["prefetches"] += 1
+  pathTypes = _PATH_TYPES.setdefault(hostString, {})
+  completeDirs = _COMPLETE_DIRS.setdefault(hostString, set())
+  dirType = None
+  dirListed = False
+  returnCode = None
+  entryPrefix = dirPath.rstrip("/") + "/"
+  for line in result.splitlines():
+    line = line.rstrip("\r")
+    if line.startswith(_FIND_RETURN_CODE_TOKEN + " "):
+      returnCode = line[len(_FIND_RETURN_CODE_TOKEN) + 1:].strip()
+      continue
+    # other lines may be output by the login shell of the host
+    if len(line) < 4 or line[2] != " ":
+      continue
+    (entryType, entryPath) = (line[0], line[3:])
+    if entryPath == dirPath:
+      dirType = entryType
+      # the entries of the directory were listed only if `find` followed the
+      # link to it
+      dirListed = line[1] == "d"
+    elif entryPath.startswith(entryPrefix) and \
+        "/" not in entryPath[len(entryPrefix):]:
+      # broken symbolic links and symbolic link loops do not exist for `test`
+      pathTypes[entryPath] = None if entryType in "NL?" else entryType
+  if returnCode is None:
+    # the listing was truncated, or the command failed
+    return
+  pathTypes[dirPath] = None if dirType in (None, "N", "L", "?") else dirType
+  if dirType == "d" and dirListed and returnCode == "0":
+    completeDirs.add(dirPath)
+
+def _get_path_type(path, hostString):
+  """Returns the type of a path of a host, using the cache and prefetching the
+  entries of its parent directory on a miss.
+
+  Returns:
+    tuple: `(True, type)` if the type could be determined (`type` being `None`
+      if the path does not exist), `(False, None)` otherwise
+  """
+  if not _is_statcache_enabled():
+    return (False, None)
+  normalizedPath = _normalize_path(path)
+  if normalizedPath is None:
+    return (False, None)
+  (known, pathType) = _lookup(hostString, normalizedPath)
+  if known:
+    _STATS["hits"] += 1
+    return (known, pathType)
+  _STATS["misses"] += 1
+  _prefetch(hostString, posixpath.dirname(normalizedPath))
+  return _lookup(hostString, normalizedPath)
+
+def _is_statcache_enabled():
+  """Returns `False` if the stat cache is turned off using the `enabled` key
+  of the `viki.fabric.statcache` dict in `viki_fabric_config.yml`.
+  """
+  return get_module_config("viki.fabric.statcache", "enabled", True)
+
+def remote_path_exists(path, hostString=None):
+  """Determines if a path exists on a host, like
+  `fabric.contrib.files.exists`, using the stat cache of the host.
+
+  On a miss, the types of all the entries of the parent directory of the path
+  are cached using a single remote command, so that checking sibling paths
+  afterwards does not contact the host. Paths which are not absolute, or which
+  contain characters the shell would expand (such as `$HOME`), are checked
+  without the cache.
+
+  The cache of a host is kept up to date when the library writes to it (see
+  `record_remote_write`); it is dropped whenever a command is run on the host
+  (such as `git clone`), since commands may write anywhere.
+
+  Args:
+    path(str): The path of interest
+
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    bool: True if the path exists, False otherwise
+
+  >>> remote_path_exists("/home/ubuntu/.ssh/id_rsa")
+  True
+  """
+  if hostString is None:
+    hostString = env.host_string
+  (known, pathType) = _get_path_type(path, hostString)
+  if known:
+    return pathType is not None
+  with settings(host_string=hostString):
+    return exists(path)
+
+def remote_path_is_dir(path, hostString=None):
+  """Determines if a path on a host is a directory (or a symbolic link to
+  one), using the stat cache of the host (see `remote_path_exists`).
+
+  Args:
+    path(str): The path of interest
+
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+
+  Returns:
+    bool: True if the path is a directory, False otherwise
+
+  >>> remote_path_is_dir("/home/ubuntu")
+  True
+  """
+  if hostString is None:
+    hostString = env.host_string
+  (known, pathType) = _get_path_type(path, hostString)
+  if known:
+    return pathType == "d"
+  with settings(hide("everything"), read_only(), host_string=hostString,
+      warn_only=True):
+    return run("[ -d {} ]".format(quote_path(path))).succeeded
+
+def record_remote_write(remotePath, localName=None, hostString=None):
+  """Updates the stat cache of a host after a file was written to it; the
+  operations wrappers in `viki.fabric.operations` call this for `put` and
+  `upload_template`.
+
+  Args:
+    remotePath(str): The path written to; if it is a directory, the file was
+      written inside it
+
+    localName(str, optional): Path of the local file, whose name is used if
+      `remotePath` is a directory
+
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if hostString not in _PATH_TYPES:
+    return
+  normalizedPath = _normalize_path(remotePath)
+  if normalizedPath is None:
+    return
+  (known, pathType) = _lookup(hostString, normalizedPath)
+  if known and pathType == "d" and isinstance(localName, basestring):
+    normalizedPath = posixpath.join(normalizedPath,
+      posixpath.basename(localName)
+    )
+    (known, pathType) = _lookup(hostString, normalizedPath)
+  if known and pathType in (None, "f"):
+    _PATH_TYPES[hostString][normalizedPath] = "f"
+  else:
+    invalidate_remote_paths([normalizedPath], hostString=hostString)
+
+def invalidate_remote_paths(paths=None, hostString=None):
+  """Drops paths from the stat cache of a host.
+
+  Args:
+    paths(list of str, optional): The paths to drop, along with everything
+      under them. Defaults to every path of the host
+
+    hostString(str, optional): The host of interest. Defaults to
+      `env.host_string`
+  """
+  if hostString is None:
+    hostString = env.host_string
+  if paths is None:
+    _PATH_TYPES.pop(hostString, None)
+    _COMPLETE_DIRS.pop(hostString, None)
+    return
+  pathTypes = _PATH_TYPES.get(hostString, {})
+  completeDirs = _COMPLETE_DIRS.get(hostString, set())
+  for path in paths:
+    normalizedPath = _normalize_path(path)
+    if normalizedPath is None:
+      # the path may be any path of the host
+      invalidate_remote_paths(hostString=hostString)
+      return
+    prefix = normalizedPath.rstrip("/") + "/"
+    for cachedPath in [p for p in pathTypes
+        if p == normalizedPath or p.startswith(prefix)]:
+      del pathTypes[cachedPath]
+    for cachedDir in [d for d in completeDirs
+        if d == normalizedPath or d.startswith(prefix)]:
+      completeDirs.discard(cachedDir)
+    # the parent directory may have gained or lost an entry
+    completeDirs.discard(posixpath.dirname(normalizedPath))
+
+def get_stat_cache_stats():
+  """Returns the number of lookups answered by the stat cache (`hits`), the
+  number of lookups which needed a remote command (`misses`), and the number
+  of directories listed (`prefetches`), in this process.
+
+  Returns:
+    dict: the counts
+
+  >>> get_stat_cache_stats()
+  {"hits": 5, "misses": 2, "prefetches": 2}
+  """
+  return dict((key, _STATS[key]) for key in ("hits", "misses", "prefetches"))
@@ -0,0 +1,257 @@
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+from fabric.api import env
+
+# Whether spans are being recorded. When `False`, `span` and functions
+# decorated with `traced` do next to nothing.
+_ENABLED = False
+
+# Recorded spans, in the order they ended; each is a dict with the keys `id`,
+# `parent_id`, `name`, `host`, `args`, `start`, `duration`, `stack`, `pid` and
+# `tid`
+_SPANS = []
+
+# Per-thread stack of the spans currently open
+_LOCAL = threading.local()
+
+# Source of span ids
+_SPAN_IDS = itertools.count(1)
+
+# Maximum length of the `repr` of an argument recorded in a span
+_MAX_ARG_REPR_LEN = 200
+
+def enable_tracing():
+  """Starts recording spans.
+
+  >>> enable_tracing()
+  >>> setup_vundle()
+  >>> export_chrome_trace("setup_vundle.trace.json")
+  """
+  global _ENABLED
+  _ENABLED = True
+
+def disable_tracing():
+  """Stops recording spans. Spans which have been recorded are kept."""
+  global _ENABLED
+  _ENABLED = False
+
+def is_tracing_enabled():
+  """Returns `True` if spans are being recorded, `False` otherwise."""
+  return _ENABLED
+
+def _get_open_spans():
+  """Returns the stack of spans currently open in this thread."""
+  openSpans = getattr(_LOCAL, "openSpans", None)
+  if openSpans is None:
+    openSpans = _LOCAL.openSpans = []
+  return openSpans
+
+def _format_arg(value):
+  """Returns a (possibly truncated) `repr` of an argument of a span."""
+  valueRepr = repr(value)
+  if len(valueRepr) > _MAX_ARG_REPR_LEN:
+    valueRepr = valueRepr[:_MAX_ARG_REPR_LEN] + "..."
+  return valueRepr
+
+class _Span(object):
+  """A span being recorded; use `span` to create one."""
+
+  def __init__(self, name, args):
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    openSpans = _get_open_spans()
+    self.id = next(_SPAN_IDS)
+    self.parentId = openSpans[-1].id if openSpans else None
+    self.stack = tuple(s.name for s in openSpans) + (self.name,)
+    self.host = env.host_string
+    openSpans.append(self)
+    self.start = time.time()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    duration = time.time() - self.start
+    _get_open_spans().pop()
+    args = dict((k, _format_arg(v)) for (k, v) in self.args.items())
+    if excType is not None:
+      args["error"] = _format_arg(excValue)
+    _SPANS.append({
+      "id": self.id,
+      "parent_id": self.parentId,
+      "name": self.name,
+      "host": self.host,
+      "args": args,
+      "start": self.start,
+      "duration": duration,
+      "stack": self.stack,
+      "pid": os.getpid(),
+      "tid": threading.current_thread().ident,
+    })
+    return False
+
+class _NullSpan(object):
+  """Stands in for a `_Span` when tracing is disabled."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(name, **args):
+  """Returns a context manager which records a span around the code it
+  wraps, if tracing is enabled. Spans opened inside the `with` block (in the
+  same thread) are nested under this span.
+
+  Args:
+    name(str): Name of the span
+
+    \*\*args: Arguments recorded with the span
+
+  >>> with span("deploy", release="v1.2.3"):
+        setup_server_for_git_clone()
+  """
+  if not _ENABLED:
+    return _NULL_SPAN
+  return _Span(name, args)
+
+def traced(f):
+  """A decorator which records a span around every call of the wrapped
+  function, named after the function (in `module.function` format), with the
+  arguments of the call. When tracing is disabled, the wrapped function is
+  called directly.
+  """
+  spanName = "{}.{}".format(f.__module__, f.__name__)
+  @functools.wraps(f)
+  def wrapper(*args, **kwargs):
+    if not _ENABLED:
+      return f(*args, **kwargs)
+    spanArgs = dict(("arg{}".format(i), arg) for (i, arg) in enumerate(args))
+    spanArgs.update(kwargs)
+    with _Span(spanName, spanArgs):
+      return f(*args, **kwargs)
+  return wrapper
+
+def get_spans():
+  """Returns the recorded spans.
+
+  Returns:
+    list of dict: The recorded spans, each a dict with the keys `id`,
+      `parent_id`, `name`, `host`, `args`, `start` (seconds since the epoch),
+      `duration` (seconds), `stack` (names of the enclosing spans and this
+      span), `pid` and `tid`
+  """
+  return list(_SPANS)
+
+def reset_spans():
+  """Discards all recorded spans."""
+  del _SPANS[:]
+
+def format_chrome_trace():
+  """Formats the recorded spans in the Chrome trace event format, which can
+  be loaded into `chrome://tracing`, Perfetto or speedscope.
+
+  Each process is named after the host it handled, so a parallel Fabric run
+  (one process per host) shows up as one track per host.
+
+  Returns:
+    dict: the trace, ready to be serialized as JSON
+  """
+  events = []
+  namedProcesses = set()
+  for s in _SPANS:
+    if s["pid"] not in namedProcesses and s["host"]:
+      namedProcesses.add(s["pid"])
+      events.append({ "name": "process_name", "ph": "M", "pid": s["pid"],
+        "tid": s["tid"], "args": { "name": s["host"] }
+      })
+    args = dict(s["args"])
+    args["host"] = s["host"]
+    events.append({
+      "name": s["name"],
+      "cat": "viki.fabric",
+      "ph": "X",
+      "ts": int(s["start"] * 1e6),
+      "dur": int(s["duration"] * 1e6),
+      "pid": s["pid"],
+      "tid": s["tid"],
+      "args": args,
+    })
+  return { "traceEvents": events, "displayTimeUnit": "ms" }
+
+def export_chrome_trace(path):
+  """Writes the recorded spans to a file in the Chrome trace event format.
+
+  Args:
+    path(str): Path of the trace file
+
+  >>> export_chrome_trace("deploy-{}.trace.json".format(env.host))
+  """
+  with open(path, "w") as f:
+    json.dump(format_chrome_trace(), f)
+
+def merge_chrome_traces(paths, outPath):
+  """Merges trace files written by `export_chrome_trace` into a single trace
+  file; use this to view the traces of a parallel Fabric run (where each host
+  is handled by a separate process) together.
+
+  Args:
+    paths(list of str): Paths of the trace files to merge
+
+    outPath(str): Path of the merged trace file
+
+  >>> merge_chrome_traces(glob.glob("deploy-*.trace.json"),
+        "deploy.trace.json")
+  """
+  events = []
+  for path in paths:
+    with open(path, "r") as f:
+      events.extend(json.load(f)["traceEvents"])
+  with open(outPath, "w") as f:
+    json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, f)
+
+def format_collapsed_stacks():
+  """Formats the recorded spans as collapsed stacks (one
+  `host;outer span;...;inner span value` line per distinct stack), which is the
+  input format of flamegraph.pl and speedscope. Values are the self time of the
+  stacks in microseconds.
+
+  Returns:
+    str: the collapsed stacks
+  """
+  childTime = {}
+  for s in _SPANS:
+    if s["parent_id"] is not None:
+      childTime[s["parent_id"]] = \
+        childTime.get(s["parent_id"], 0) + s["duration"]
+  selfTime = {}
+  for s in _SPANS:
+    frames = [s["host"] or "local"] + list(s["stack"])
+    # `;` separates frames in the collapsed stack format
+    key = ";".join(frame.replace(";", ",") for frame in frames)
+    selfTime[key] = selfTime.get(key, 0) + \
+      max(s["duration"] - childTime.get(s["id"], 0), 0)
+  return "".join("{} {}\n".format(key, int(value * 1e6))
+    for (key, value) in sorted(selfTime.items())
+  )
+
+def export_collapsed_stacks(path):
+  """Writes the recorded spans to a file as collapsed stacks (see
+  `format_collapsed_stacks`). Files written by several processes can simply be
+  concatenated.
+
+  Args:
+    path(str): Path of the collapsed stacks file
+
+  >>> export_collapsed_stacks("deploy.folded")
+  """
+  with open(path, "w") as f:
+    f.write(format_collapsed_stacks())
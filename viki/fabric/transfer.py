@@ -0,0 +1,479 @@
+import gzip
+import hashlib
+import os
+import os.path
+import pipes
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from distutils.spawn import find_executable
+
+from fabric.api import env
+from fabric.colors import blue
+from fabric.context_managers import hide, settings
+from fabric.decorators import parallel, task
+from fabric.tasks import execute
+
+from viki.fabric.backends import get_backend, render_template
+from viki.fabric.config import get_module_config
+from viki.fabric.deadlines import with_deadline
+from viki.fabric.operations import get, put, read_only, run, sudo, \
+  upload_template
+from viki.fabric.script import RemoteScript, quote_path
+
+# Default size (in bytes) from which files are compressed for transfer
+_DEFAULT_COMPRESSION_THRESHOLD = 64 * 1024
+
+# Extensions of files which are already compressed, and are never compressed
+# for transfer
+_COMPRESSED_EXTENSIONS = frozenset([
+  ".7z", ".br", ".bz2", ".deb", ".gif", ".gz", ".jar", ".jpeg", ".jpg",
+  ".lz4", ".lzma", ".mp3", ".mp4", ".png", ".rpm", ".tbz2", ".tgz", ".txz",
+  ".webp", ".whl", ".xz", ".zip", ".zst",
+])
+
+# Codecs in order of preference, with the suffix of compressed files, and the
+# shell commands compressing and decompressing a file to stdout
+_CODECS = [
+  ("zstd", ".zst", "zstd -qc", "zstd -qdc"),
+  ("gzip", ".gz", "gzip -c", "gzip -dc"),
+]
+
+# Codecs available on each host, keyed by host string
+_REMOTE_CODECS = {}
+
+# Statistics of the compressed transfers made by this process; see
+# `get_transfer_stats`
+_TRANSFER_STATS = []
+
+# Characters which are replaced in host strings to form directory names
+_UNSAFE_FILE_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+def should_compress(path, size):
+  """Determines if a file should be compressed for transfer to or from the
+  current host: compression is enabled, the file is at least as large as the
+  compression threshold, it is not already compressed (judging by its
+  extension), and the host is reached over the network.
+
+  Args:
+    path(str): Path of the file
+
+    size(int): Size of the file in bytes
+
+  Returns:
+    bool: True if the file should be compressed, False otherwise
+  """
+  if not get_module_config("viki.fabric.transfer", "compression", True):
+    return False
+  if size < get_module_config("viki.fabric.transfer", "compression_threshold",
+    _DEFAULT_COMPRESSION_THRESHOLD
+  ):
+    return False
+  if os.path.splitext(path)[1].lower() in _COMPRESSED_EXTENSIONS:
+    return False
+  return getattr(get_backend(), "transfersOverNetwork", True)
+
+def _get_codec():
+  """Returns the preferred codec available both here and on the current host
+  (as an element of `_CODECS`), or `None` if there is none. The codecs
+  available on a host are looked up once.
+  """
+  hostString = env.host_string
+  if hostString not in _REMOTE_CODECS:
+    with settings(hide("everything"), read_only(), warn_only=True):
+      result = run(" ; ".join(
+        "command -v {0} >/dev/null && echo {0}".format(codec[0])
+        for codec in _CODECS
+      ))
+    _REMOTE_CODECS[hostString] = set(result.split())
+  for codec in _CODECS:
+    # gzip is always available here, through the `gzip` module
+    if codec[0] in _REMOTE_CODECS[hostString] and \
+        (codec[0] == "gzip" or find_executable(codec[0])):
+      return codec
+  return None
+
+def _compress_local(sourcePath, destinationPath, codecName):
+  """Compresses a local file."""
+  if codecName == "gzip":
+    with open(sourcePath, "rb") as source:
+      with gzip.open(destinationPath, "wb", 6) as destination:
+        shutil.copyfileobj(source, destination, 1 << 16)
+  else:
+    with open(destinationPath, "wb") as destination:
+      subprocess.check_call([codecName, "-qc", sourcePath],
+        stdout=destination
+      )
+
+def _decompress_local(sourcePath, destinationPath, codecName):
+  """Decompresses a local file."""
+  if codecName == "gzip":
+    with gzip.open(sourcePath, "rb") as source:
+      with open(destinationPath, "wb") as destination:
+        shutil.copyfileobj(source, destination, 1 << 16)
+  else:
+    with open(destinationPath, "wb") as destination:
+      subprocess.check_call([codecName, "-qdc", sourcePath],
+        stdout=destination
+      )
+
+def _format_size(size):
+  """Formats a number of bytes for humans."""
+  for unit in ["B", "KB", "MB"]:
+    if size < 1024:
+      return "{:.1f} {}".format(size, unit)
+    size /= 1024.0
+  return "{:.1f} GB".format(size)
+
+def _record_transfer(direction, path, codecName, size, compressedSize,
+    codecTime, transferTime):
+  """Records and reports the statistics of a compressed transfer. The time
+  saved is estimated from the throughput of the transfer of the compressed
+  file.
+  """
+  throughput = compressedSize / max(transferTime, 1e-6)
+  timeSaved = size / throughput - transferTime - codecTime
+  stats = {
+    "direction": direction,
+    "path": path,
+    "host": env.host_string,
+    "codec": codecName,
+    "size": size,
+    "compressed_size": compressedSize,
+    "ratio": float(size) / max(compressedSize, 1),
+    "codec_time": codecTime,
+    "transfer_time": transferTime,
+    "time_saved": timeSaved,
+  }
+  _TRANSFER_STATS.append(stats)
+  print(blue(
+    ("{} `{}` compressed with {}: {} -> {} (ratio {:.1f}x), about {:.2f}s"
+     " saved").format("Uploaded" if direction == "put" else "Downloaded",
+      path, codecName, _format_size(size), _format_size(compressedSize),
+      stats["ratio"], timeSaved
+    )
+  ))
+
+def get_transfer_stats():
+  """Returns the statistics of the compressed transfers made so far.
+
+  Returns:
+    list of dict: one dict per transfer, with the keys `direction` ("put" or
+      "get"), `path` (on the host), `host`, `codec`, `size` and
+      `compressed_size` (in bytes), `ratio`, `codec_time` (seconds spent
+      compressing and decompressing), `transfer_time` (seconds) and
+      `time_saved` (estimated seconds saved by compressing)
+  """
+  return list(_TRANSFER_STATS)
+
+def put_file(localPath, remotePath, useSudo=False, mirrorLocalMode=False,
+    mode=None):
+  """Uploads a file to the server like `put`, compressing it for the transfer
+  if it is worth it (see `should_compress`), with zstd if it is available here
+  and on the server, otherwise with gzip.
+
+  Args:
+    localPath(str): Path of the local file
+
+    remotePath(str): Path of the file on the server, or of a directory on the
+      server to upload the file to
+
+    useSudo(bool, optional): If `True`, the file is written using sudo
+
+    mirrorLocalMode(bool, optional): If `True`, the mode of the file on the
+      server is set to that of the local file
+
+    mode(int, optional): Mode of the file on the server
+
+  >>> put_file("dumps/users.sql", "/tmp/users.sql")
+  """
+  size = os.path.getsize(localPath)
+  codec = _get_codec() if should_compress(localPath, size) else None
+  if codec is None:
+    put(localPath, remotePath, use_sudo=useSudo,
+      mirror_local_mode=mirrorLocalMode, mode=mode
+    )
+    return
+  (codecName, suffix, _, decompressCommand) = codec
+  if mirrorLocalMode and mode is None:
+    mode = os.stat(localPath).st_mode & 07777
+  (fd, compressedPath) = tempfile.mkstemp(suffix=suffix)
+  os.close(fd)
+  try:
+    start = time.time()
+    _compress_local(localPath, compressedPath, codecName)
+    codecTime = time.time() - start
+    compressedSize = os.path.getsize(compressedPath)
+    remoteCompressedPath = "/tmp/.viki-transfer-{}".format(
+      os.path.basename(compressedPath)
+    )
+    start = time.time()
+    put(compressedPath, remoteCompressedPath)
+    transferTime = time.time() - start
+  finally:
+    os.unlink(compressedPath)
+  # a directory as the destination means a file of the same name inside it
+  decompressScript = (
+    "d={0}; [ -d \"$d\" ] && d=\"$d\"/{1}; {2} {3} > \"$d\"; s=$?;"
+    " rm -f {3}; [ $s -eq 0 ]"
+  ).format(quote_path(remotePath), pipes.quote(os.path.basename(localPath)),
+    decompressCommand, pipes.quote(remoteCompressedPath)
+  )
+  if mode is not None:
+    decompressScript += " && chmod {:o} \"$d\"".format(mode)
+  start = time.time()
+  with settings(hide("running")):
+    (sudo if useSudo else run)(decompressScript)
+  codecTime += time.time() - start
+  _record_transfer("put", remotePath, codecName, size, compressedSize,
+    codecTime, transferTime
+  )
+
+def get_file(remotePath, localPath, useSudo=False):
+  """Downloads a file from the server to a local path like `get`, compressing
+  it for the transfer if it is worth it (see `should_compress`), with zstd if
+  it is available here and on the server, otherwise with gzip.
+
+  The size of the file is checked, and it is compressed if need be, with a
+  single remote command.
+
+  Args:
+    remotePath(str): Path of the file on the server
+
+    localPath(str): Path of the local file
+
+    useSudo(bool, optional): If `True`, the file is read using sudo
+
+  >>> get_file("/var/log/nginx/access.log", "access.log")
+  """
+  # the size of the file is not known yet, only whether files like it are
+  # ever compressed
+  if not should_compress(remotePath, float("inf")):
+    get(remotePath, localPath, use_sudo=useSudo)
+    return
+  codec = _get_codec()
+  if codec is None:
+    get(remotePath, localPath, use_sudo=useSudo)
+    return
+  (codecName, suffix, compressCommand, _) = codec
+  threshold = get_module_config("viki.fabric.transfer", "compression_threshold",
+    _DEFAULT_COMPRESSION_THRESHOLD
+  )
+  # prints the size of the file, and the path of the compressed copy if the
+  # file is large enough to be compressed, on lines starting with `size ` and
+  # `path `; the script delimits them from any other output of the shell
+  script = RemoteScript()
+  script.add_step("check", (
+    "s=$(stat -c %s {0}) && echo \"size $s\" && if [ $s -ge {1} ]; then"
+    " t=$(mktemp /tmp/.viki-transfer-XXXXXX) && {2} {0} > $t && chmod 644 $t"
+    " && echo \"path $t\"; fi"
+  ).format(quote_path(remotePath), threshold, compressCommand))
+  start = time.time()
+  stepResult = script.run(useSudo=useSudo)["steps"]["check"]
+  codecTime = time.time() - start
+  checkValues = dict(line.rstrip("\r").split(" ", 1)
+    for line in stepResult["output"] if line.startswith(("size ", "path "))
+  )
+  if stepResult["return_code"] != 0 or "path" not in checkValues:
+    get(remotePath, localPath, use_sudo=useSudo)
+    return
+  (size, remoteCompressedPath) = (int(checkValues["size"]),
+    checkValues["path"]
+  )
+  (fd, compressedPath) = tempfile.mkstemp(suffix=suffix)
+  os.close(fd)
+  try:
+    start = time.time()
+    get(remoteCompressedPath, compressedPath)
+    transferTime = time.time() - start
+    with settings(hide("everything"), warn_only=True):
+      (sudo if useSudo else run)("rm -f {}".format(
+        pipes.quote(remoteCompressedPath)
+      ))
+    compressedSize = os.path.getsize(compressedPath)
+    start = time.time()
+    _decompress_local(compressedPath, localPath, codecName)
+    codecTime += time.time() - start
+  finally:
+    os.unlink(compressedPath)
+  _record_transfer("get", remotePath, codecName, size, compressedSize,
+    codecTime, transferTime
+  )
+
+def upload_template_file(filename, destination, context=None,
+    useJinja=False, templateDir=None, useSudo=False, mode=None):
+  """Renders a template locally and uploads it to the server like
+  `upload_template`, compressing it for the transfer if it is worth it (see
+  `put_file`). Unlike `upload_template`, no backup of an existing destination
+  file is made.
+
+  Args:
+    filename(str): Name of the template
+
+    destination(str): Path of the file on the server
+
+    context(dict, optional): Variables of the template
+
+    useJinja(bool, optional): If `True`, the template is rendered with Jinja2,
+      otherwise with Python string interpolation
+
+    templateDir(str, optional): Directory holding the template
+
+    useSudo(bool, optional): If `True`, the file is written using sudo
+
+    mode(int, optional): Mode of the file on the server
+
+  >>> upload_template_file("nginx.conf", "/etc/nginx/nginx.conf",
+        context={ "workers": 4 }, useJinja=True, templateDir="templates",
+        useSudo=True
+      )
+  """
+  (rendered, _) = render_template(filename, context=context,
+    use_jinja=useJinja, template_dir=templateDir
+  )
+  if not should_compress(destination, len(rendered)):
+    upload_template(filename, destination, context=context,
+      use_jinja=useJinja, template_dir=templateDir, use_sudo=useSudo,
+      backup=False, mode=mode
+    )
+    return
+  (fd, renderedPath) = tempfile.mkstemp()
+  try:
+    with os.fdopen(fd, "w") as f:
+      f.write(rendered)
+    put_file(renderedPath, destination, useSudo=useSudo, mode=mode)
+  finally:
+    os.unlink(renderedPath)
+
+class _HashingWriter(object):
+  """File-like object which writes to a file while computing the SHA-256 and
+  size of what is written.
+  """
+
+  def __init__(self, f):
+    self._file = f
+    self._sha256 = hashlib.sha256()
+    self.size = 0
+
+  def write(self, data):
+    self._file.write(data)
+    self._sha256.update(data)
+    self.size += len(data)
+
+  def flush(self):
+    self._file.flush()
+
+  def hexdigest(self):
+    return self._sha256.hexdigest()
+
+@task
+@parallel
+def gather_host_files(remoteGlob, localDir):
+  """Fabric task which downloads the files matching a glob on the current
+  host into `localDir/<host string>/<remote path>`, and returns their
+  manifest.
+
+  This task is used by `gather_remote_files`; call that instead.
+
+  Returns:
+    list of dict: the manifest of the files of the host (see
+      `gather_remote_files`)
+  """
+  # list the files and their sizes in a single remote command
+  with settings(hide("running", "stdout"), warn_only=True):
+    listing = run(
+      "for f in {}; do [ -f \"$f\" ] && stat -c '%s %n' \"$f\"; done; true"
+      .format(remoteGlob)
+    )
+  hostDir = os.path.join(localDir,
+    _UNSAFE_FILE_NAME_CHARS.sub("_", env.host_string)
+  )
+  manifest = []
+  for line in listing.splitlines():
+    fields = line.strip().split(" ", 1)
+    if len(fields) != 2 or not fields[0].isdigit():
+      continue
+    (remoteSize, remotePath) = (int(fields[0]), fields[1])
+    localPath = os.path.join(hostDir, remotePath.lstrip("/"))
+    if not os.path.isdir(os.path.dirname(localPath)):
+      os.makedirs(os.path.dirname(localPath))
+    # the file is streamed straight to its final location, and hashed on the
+    # way
+    with open(localPath, "wb") as f:
+      writer = _HashingWriter(f)
+      with settings(hide("running")):
+        get(remotePath, writer)
+    manifest.append({
+      "remote_path": remotePath,
+      "local_path": localPath,
+      "size": writer.size,
+      "sha256": writer.hexdigest(),
+      "complete": writer.size == remoteSize,
+    })
+  return manifest
+
+def gather_remote_files(remoteGlob, localDir, hosts=None, roles=None,
+    poolSize=None):
+  """Downloads the files matching a glob from many hosts in parallel, into a
+  directory per host.
+
+  The file at `/var/log/app/web.log` on `ubuntu@hostOne` is downloaded to
+  `<localDir>/ubuntu_hostOne/var/log/app/web.log`. Files are written straight
+  to their final location, and their SHA-256 is computed as they are
+  downloaded.
+
+  **NOTE:** This function should not be called from within a Fabric task that
+  is itself being executed for many hosts.
+
+  Args:
+    remoteGlob(str): Shell glob of the files to download, such as
+      `/var/log/app/*.log`; it is expanded by the shell of each host
+
+    localDir(str): Local directory to download the files into
+
+    hosts(list of str, optional): Hosts to download files from. Defaults to
+      `env.hosts`
+
+    roles(list of str, optional): Roles whose hosts files are downloaded from.
+      Defaults to `env.roles`
+
+    poolSize(int, optional): Maximum number of hosts to download files from
+      concurrently. Defaults to `env.pool_size`
+
+  Returns:
+    dict: A dict whose keys are host strings and whose values are the
+      manifests of the files downloaded from the hosts: lists of dicts with
+      the keys `remote_path`, `local_path`, `size` (in bytes), `sha256` and
+      `complete` (whether the size matches that of the remote file when it was
+      listed). Hosts which failed map to the exception raised for them, and
+      hosts which timed out or were quarantined (see `viki.fabric.deadlines`)
+      map to `None`
+
+  >>> gather_remote_files("/var/log/app/*.log", "logs",
+        hosts=["hostOne", "hostTwo"], poolSize=20
+      )
+  {"hostOne": [{"remote_path": "/var/log/app/web.log",
+    "local_path": "logs/hostOne/var/log/app/web.log", "size": 5242880,
+    "sha256": "9f86d081...", "complete": True}], "hostTwo": [...]}
+  """
+  if hosts is None:
+    hosts = env.hosts
+  if roles is None:
+    roles = env.roles
+  taskToExecute = with_deadline()(gather_host_files.wrapped)
+  if poolSize is not None:
+    taskToExecute = parallel(pool_size=poolSize)(taskToExecute)
+  print(blue("Gathering `{}`...".format(remoteGlob)))
+  retVal = execute(taskToExecute, remoteGlob, localDir, hosts=hosts,
+    roles=roles
+  )
+  manifests = [m for m in retVal.values() if isinstance(m, list)]
+  print(blue("Gathered {} files ({}) from {} hosts".format(
+    sum(len(m) for m in manifests),
+    _format_size(sum(entry["size"] for m in manifests for entry in m)),
+    len(manifests)
+  )))
+  return retVal